@@ -0,0 +1,217 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+
+# Замеры производительности: разбор кадров, BCC, сериализация, поиск OBIS в имитаторе,
+# расчёт получасового профиля по тарифам и сеанс с имитатором по tcp.
+
+import sys, os, gc, time, json
+import socket
+import subprocess
+import argparse
+from datetime import datetime, timedelta
+from protocol import Mek61107, NevaMt3xx, Tariffs, Obis, Imitator
+import test_serial
+
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+DEFAULT_TOLERANCE = .2 # допустимое снижение ops/s относительно базовых значений
+
+PROFILE = '03977,03995,03997,04014,04031,04036,04038,04062,04078,04073,04068,04054,04034,03958,03928,03900,'\
+	'03889,03892,03897,03890,03860,03857,03844,03843,03827,03838,03847,03849,03846,03849,03847,03842,'\
+	'03857,03849,03847,03847,03870,03864,03846,03847,03852,03819,03835,03843,03825,03846,03876,03880'
+
+# OBIS коды имитатора, как в meter_imitator.sh
+IMITATOR_OBIS = [
+	'00.09.02*FF',
+	'00.09.01*FF',
+	'0A.01.64*FF:070001,230002,000000,000000,000000,000000,000000,000000',
+	'0B.00.00*FF:'+','.join(['000000']*32),
+	'0F.08.80*FF:000000.64,000000.55,000000.09,000000.00,000000.00',
+	'0F.80.80*[0..7F]:000400.84,000309.98,000090.86,000000.00,000000.00',
+	'10.07.00*FF:00015.4',
+	'60.01.00*FF:00000000',
+	'60.01.01*FF:9144',
+	'60.01.04*FF:000V0201',
+	'60.01.0A*FF:0000000000000000',
+	'60.09.00*FF:029',
+	'63.01.00*[0..7F]:'+PROFILE,
+]
+
+def get_obis_list():
+	return Imitator.ObisList.parse(IMITATOR_OBIS)
+
+
+class MemoryMeter:
+	"""Счётчик в памяти вместо сокета для NevaMt3xx_tcp: отвечает на R1 значениями obis_list"""
+
+	def __init__(self, obis_list):
+		self.meter = NevaMt3xx.NevaMt3xx()
+		self.decoder = self.meter.Decoder(self.meter)
+		self.obis_list = obis_list
+		self.rcv = []
+
+	def sendall(self, buff):
+		self.decoder.feed(buff)
+		cmd = self.decoder.get()
+		while cmd is not None:
+			if cmd.is_command and cmd.command == 'R1':
+				obis = cmd.data[:-2]
+				self.rcv.append(NevaMt3xx.NevaMt3xx.Message(obis+'('+str(self.obis_list.get_obis(obis))+')').serialize(
+					calculate_bcc_func=NevaMt3xx.NevaMt3xx.calculate_bcc_xor))
+			cmd = self.decoder.get()
+
+	def recv(self, size):
+		return self.rcv.pop(0) if len(self.rcv) > 0 else ''
+
+
+def measure(func, min_time=.2, repeat=3):
+	"""Возвращает [ops/s, net gc объектов на операцию]: лучший из repeat замеров длительностью не менее min_time.
+	net gc объекты - прирост len(gc.get_objects()) за count операций при выключенном сборщике, на операцию:
+	оставшиеся после операции контейнеры (list, dict, экземпляры; не str и int), например кэши и утечки.
+	Это не число выделений: временные объекты, освобождённые внутри операции, не учитываются,
+	а python 2 не даёт счётчика выделений памяти"""
+	best = 0.
+	count = 1
+	while True:
+		t = time.time()
+		for i in xrange(count):
+			func()
+		t = time.time()-t
+		if t >= min_time:
+			break
+		count *= 2
+	for i in xrange(repeat):
+		t = time.time()
+		for j in xrange(count):
+			func()
+		t = time.time()-t
+		best = max(best, count/t if t > 0 else 0.)
+	gc.collect()
+	gc.disable()
+	objects = len(gc.get_objects())
+	for i in xrange(count):
+		func()
+	objects = len(gc.get_objects())-objects
+	gc.enable()
+	return best, float(objects)/count
+
+def get_benchmarks():
+	P = NevaMt3xx.NevaMt3xx
+	protocol = P()
+	ack = '\x06'
+	# профиль счётчика с двумя значениями на получас: ~600 байт
+	profile = P.Message('63010000('+PROFILE+','+PROFILE+')').serialize(calculate_bcc_func=P.calculate_bcc_xor)
+	profile_data = profile[1:-1]
+	decoder = protocol.Decoder(protocol)
+	def decode(buff):
+		decoder.feed(buff)
+		return decoder.get()
+	command = P.Command('R1', '630100FF()')
+	command_data = command.serialize(calculate_bcc_func=P.calculate_bcc_xor)[1:-1]
+	obis_list = get_obis_list()
+	synthetic_list = Imitator.ObisList.parse(['63.01.00*[0..7F]:@profile'])
+	synthetic_meter = Imitator.Meter('TPC', 'NEVAMT324.2303', '', '00000000', synthetic_list)
+	def calculate_half_hours():
+		test_serial.protocol = NevaMt3xx.NevaMt3xx_tcp(MemoryMeter(obis_list))
+		start = datetime.now()
+		start = datetime(start.year, start.month, start.day)
+		stop = start-timedelta(days=127)
+		return test_serial.calculate_half_hours(start=start, stop=datetime(stop.year, stop.month, stop.day, 23, 59, 59))
+	energy_buffs = ['000400.84,000309.98,000090.86,000000.00,000000.00']*128
+	energies = Tariffs.make_energies(energy_buffs)
+	profiles = Tariffs.make_profiles([PROFILE]*128)
+	tariff_indexes = Tariffs.make_tariff_indexes([1]*14+[2]*32+[1]*2, [None]*128)
+	return [
+		['parse ACK', lambda: protocol.parse(ack)],
+		['parse 63.01.00 ({} bytes)'.format(len(profile)), lambda: protocol.parse(profile)],
+		['decode ACK', lambda: decode(ack)],
+		['decode 63.01.00 ({} bytes)'.format(len(profile)), lambda: decode(profile)],
+		['calculate_bcc_xor R1 ({} bytes)'.format(len(command_data)), lambda: P.calculate_bcc_xor(command_data)],
+		['calculate_bcc_iso1155 R1 ({} bytes)'.format(len(command_data)), lambda: Mek61107.Mek61107.calculate_bcc_iso1155(command_data)],
+		['calculate_bcc_xor ({} bytes)'.format(len(profile_data)), lambda: P.calculate_bcc_xor(profile_data)],
+		['calculate_bcc_iso1155 ({} bytes)'.format(len(profile_data)), lambda: Mek61107.Mek61107.calculate_bcc_iso1155(profile_data)],
+		['Command.serialize', lambda: command.serialize(calculate_bcc_func=P.calculate_bcc_xor)],
+		['ObisList.get_obis 00.09.02*FF', lambda: obis_list.get_obis('00.09.02*FF')],
+		['ObisList.get_obis 63.01.00*7F', lambda: obis_list.get_obis('63.01.00*7F')],
+		['ObisList.get_frame 63.01.00*7F', lambda: obis_list.get_frame('6301007F', P.calculate_bcc_xor)],
+		['ObisList.get_obis 63.01.00*7F @profile', lambda: synthetic_list.get_obis('6301007F', synthetic_meter)],
+		['Tariffs.make_profiles 128 days', lambda: Tariffs.make_profiles([PROFILE]*128)],
+		['Tariffs.make_energies 128 days', lambda: Tariffs.make_energies(energy_buffs)],
+		['Obis.normalize 63.01.00*7F', lambda: Obis.normalize('63.01.00*7F')],
+		['Obis.decode 0F.80.80', lambda: Obis.decode('0F.80.80*00', energy_buffs[0])],
+		['Tariffs.accumulate 128 days', lambda: Tariffs.accumulate(energies, profiles, tariff_indexes)],
+		['calculate_half_hours 128 days', calculate_half_hours],
+	]
+
+def measure_session(count):
+	"""Замер сеансов connect, login, R1, B0 с имитатором, подключенным по tcp к localhost.
+	Возвращает список длительностей сеансов, с"""
+	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	server.bind(('127.0.0.1', 0))
+	server.listen(1)
+	imitator_args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'meter_imitator.py'),
+		'--server-ip', '127.0.0.1', '--server-port', str(server.getsockname()[1]), '-o']+IMITATOR_OBIS
+	with open(os.devnull, 'w') as devnull:
+		imitator = subprocess.Popen(imitator_args, stdout=devnull, stderr=devnull)
+	try:
+		server.settimeout(10)
+		connection, address = server.accept()
+		connection.settimeout(5)
+		protocol = NevaMt3xx.NevaMt3xx_tcp(connection)
+		ret = []
+		for i in xrange(count):
+			t = time.time()
+			protocol.connect()
+			if not protocol.login('00000000'):
+				raise Exception('Access denied')
+			protocol.read_obis('00.09.02*FF')
+			protocol.logout()
+			ret.append(time.time()-t)
+		connection.close()
+		return ret
+	finally:
+		imitator.kill()
+		server.close()
+
+def pase_args():
+	parser = argparse.ArgumentParser(description=u'Замеры производительности библиотеки и утилит.', formatter_class=argparse.RawTextHelpFormatter)
+	parser.add_argument('--baseline',metavar='FILE',default=DEFAULT_BASELINE,
+		help=u'файл базовых значений (JSON); по умолчанию: '+DEFAULT_BASELINE)
+	parser.add_argument('--save',action='store_true',help=u'сохранить результаты как базовые значения')
+	parser.add_argument('--tolerance',metavar='FRACTION',type=float,default=DEFAULT_TOLERANCE,
+		help=u'допустимое снижение ops/s относительно базовых значений; по умолчанию: '+str(DEFAULT_TOLERANCE))
+	parser.add_argument('--sessions',metavar='COUNT',type=int,default=20,
+		help=u'число сеансов с имитатором по tcp; 0 - не замерять; по умолчанию: 20')
+	parser.add_argument('-k',metavar='SUBSTRING',help=u'только замеры, содержащие SUBSTRING в названии')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = pase_args()
+	results = {}
+	for name, func in get_benchmarks():
+		if args.k is not None and args.k not in name:
+			continue
+		ops, objects = measure(func)
+		results[name] = ops
+		print '{:<40} {:>14.1f} ops/s {:>8.1f} net gc objects/op'.format(name, ops, objects)
+	if args.sessions > 0 and (args.k is None or 'session' in args.k):
+		durations = sorted(measure_session(args.sessions))
+		name = 'imitator session over tcp'
+		results[name] = len(durations)/sum(durations)
+		print '{:<40} {:>14.1f} ops/s  median {:.2f} ms, max {:.2f} ms'.format(name, results[name],
+			durations[len(durations)/2]*1000, durations[-1]*1000)
+	if args.save:
+		with open(args.baseline, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+		print 'Baseline saved: '+args.baseline
+	elif os.path.exists(args.baseline):
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = [name for name in sorted(results) if name in baseline and
+			results[name] < baseline[name]*(1-args.tolerance)]
+		for name in regressions:
+			print 'REGRESSION: {}: {:.1f} ops/s; baseline {:.1f} ops/s'.format(name, results[name], baseline[name])
+		if len(regressions) > 0:
+			sys.exit(1)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+
+# Имитатор парка счётчиков: тысячи счётчиков за модемами в одном цикле событий
+
+import sys, traceback
+from datetime import datetime
+import argparse
+from protocol import NevaMt3xx, NevaMt3xxAsync, Imitator, Synthetic
+
+
+METER_DEFAULT_COMPANY = 'TPC'
+METER_DEFAULT_DEVICE = 'NEVAMT324.{:05}'
+METER_DEFAULT_PASSWORD = '00000000' # MEK 61107 password
+MODEM_SERVER_DEFAULT_PORT = 25535 # TCP port to connect to
+LISTEN_DEFAULT_PORT = 30000 # TCP port of the first line
+DEFAULT_OBIS = [
+	'00.09.02*FF',
+	'00.09.01*FF',
+	'0A.01.64*FF:'+Synthetic.DEFAULT_SCHEDULE,
+	'0F.08.80*FF:@month_energies',
+	'0F.08.80*[0..C]:@month_energies',
+	'0F.80.80*FF:@day_energies',
+	'0F.80.80*[0..7F]:@day_energies',
+	'10.07.00*FF:@power',
+	'60.01.04*FF:000V0201',
+	'63.01.00*[0..7F]:@profile',
+]
+
+def dump(message):
+	sys.stderr.write(datetime.now().strftime('%H:%M:%S.%f ')+message+'\n')
+
+class log(NevaMt3xx.LogBase):
+	def log_rcv(self, data):
+		dump(' >> '+data.decode('latin').encode('unicode_escape'))
+	def log_snd(self, data):
+		dump(' << '+data.decode('latin').encode('unicode_escape'))
+	def log_rcv_frame(self, cmd):
+		dump(' >> '+str(cmd))
+	def log_snd_frame(self, cmd):
+		dump(' << '+str(cmd))
+
+def pase_args():
+	parser = argparse.ArgumentParser(description=u'Имитатор парка счётчиков электроэнергии типа НЕВА МТ 3xx:\n'
+		u'счётчики за модемами - клиентами сервера опроса или за TCP портами, в одном цикле событий.',
+		formatter_class=argparse.RawTextHelpFormatter)
+	parser.add_argument('-n','--count',metavar='COUNT',type=int,default=1,
+		help=u'число счётчиков; по умолчанию: 1')
+	parser.add_argument('--per-line',metavar='COUNT',type=int,default=1,
+		help=u'счётчиков на линии (модеме) с адресами 1..COUNT; по умолчанию: 1 - без адреса')
+	parser.add_argument('--meters',metavar='FILE',
+		help=u'список счётчиков (JSON) вместо --count: [{"modem": "host:port" или "listen": "host:port",\n'
+			u'"company": "TPC", "device": "NEVAMT324.2303", "address": "9144", "password": "00000000",\n'
+			u'"obis": ["60.01.04*FF:000V0201", ...]}, ...]')
+	parser.add_argument('--server-ip',metavar='IP_ADDRESS',
+		help=u'IP адрес сервера опроса: линии подключаются к нему как модемы')
+	parser.add_argument('--server-port',metavar='TCP_PORT',type=int,default=MODEM_SERVER_DEFAULT_PORT,
+		help=u'TCP порт сервера опроса; по умолчанию: '+str(MODEM_SERVER_DEFAULT_PORT))
+	parser.add_argument('--listen-ip',metavar='IP_ADDRESS',default='',
+		help=u'IP адрес ожидания подключений без --server-ip; по умолчанию: все адреса')
+	parser.add_argument('--listen-port',metavar='TCP_PORT',type=int,default=LISTEN_DEFAULT_PORT,
+		help=u'TCP порт первой линии без --server-ip, следующие линии - по порядку; по умолчанию: '+str(LISTEN_DEFAULT_PORT))
+	parser.add_argument('--company',metavar='3_CHARS',default=METER_DEFAULT_COMPANY,
+		help=u'трёхбуквенный код производителя; по умолчанию: '+str(METER_DEFAULT_COMPANY))
+	parser.add_argument('--device',metavar='FORMAT',default=METER_DEFAULT_DEVICE,
+		help=u'идентификатор счётчика (не более 16 символов), {} - номер счётчика; по умолчанию: '+str(METER_DEFAULT_DEVICE))
+	parser.add_argument('--password',metavar='PASSWORD',default=METER_DEFAULT_PASSWORD,
+		help=u'пароль для работы со счётчиком; по умолчанию: "'+str(METER_DEFAULT_PASSWORD)+'"')
+	parser.add_argument('-o', '--obis',metavar='OBIS:VALUE',type=str,nargs='*',default=DEFAULT_OBIS,
+		help=u'OBIS код и значение, как у meter_imitator.py; общие для всех счётчиков;\n'
+			u'значение генератора (@'+', @'.join(sorted(Synthetic.GENERATORS))+u') - своё для каждого счётчика;\n'
+			u'по умолчанию: '+' '.join(DEFAULT_OBIS))
+	parser.add_argument('--init-data',metavar='STRING',
+		help=u'данные для передачи модемом сразу после подключения к серверу опроса; например: "imei:080255635\\nversion:1.0\\nD<<10 0 0<<\\n"')
+	parser.add_argument('--session-timeout',metavar='SECONDS',type=float,default=Imitator.Imitator.SESSION_TIMEOUT,
+		help=u'время ожидания запроса в сеансе обмена, с; по умолчанию: '+str(Imitator.Imitator.SESSION_TIMEOUT))
+	parser.add_argument('--stats',metavar='SECONDS',type=float,default=10.,
+		help=u'период вывода статистики в stderr, с; 0 - не выводить; по умолчанию: 10')
+	parser.add_argument('-v',action='count',default=0,help='verbose level: -v (frames) or -vv (bytes)')
+	return parser.parse_args()
+
+def get_lines(args, obis_list):
+	"""Возвращает [[линия, [Meter]]] по --count и --per-line; линия - см. Imitator.load_meters"""
+	lines = []
+	for line_index in xrange((args.count+args.per_line-1)//args.per_line):
+		if args.server_ip is not None:
+			line = ['modem', (args.server_ip, args.server_port)]
+		else:
+			line = ['listen', (args.listen_ip, args.listen_port+line_index)]
+		meters = []
+		for index in xrange(line_index*args.per_line, min(args.count, (line_index+1)*args.per_line)):
+			address = '' if args.per_line == 1 else str(index-line_index*args.per_line+1)
+			meters.append(Imitator.Meter(args.company, args.device.format(index), address, args.password, obis_list))
+		lines.append([line, meters])
+	return lines
+
+def dump_stats(imitator, period):
+	while True:
+		yield NevaMt3xxAsync.Sleep(period)
+		dump(' '.join(['{}: {};'.format(key, value) for key, value in sorted(imitator.get_stats().items())]))
+
+
+if __name__ == '__main__':
+	args = pase_args()
+	try:
+		obis_list = Imitator.ObisList.parse(args.obis)
+		init_data = None if args.init_data is None else args.init_data.decode('string_escape')
+		imitator = Imitator.Imitator(log=log() if args.v > 0 else None, log_bytes=args.v > 1,
+			session_timeout=args.session_timeout)
+		if args.meters is not None:
+			lines = Imitator.load_meters(args.meters, obis_list)
+		else:
+			lines = get_lines(args, obis_list)
+		for [mode, address], meters in lines:
+			if mode == 'modem':
+				imitator.add_client(address, meters, init_data)
+			else:
+				imitator.add_server(address, meters)
+		dump('Imitate {} meters on {} lines'.format(imitator.meters_count, imitator.lines_count))
+		if args.stats > 0:
+			imitator.loop.spawn(dump_stats(imitator, args.stats))
+		imitator.run()
+	except KeyboardInterrupt:
+		pass
+	except Exception as e:
+		print >>sys.stderr, u'ERROR: '+str(e)
+		exc_type, exc_value, exc_traceback = sys.exc_info()
+		traceback.print_tb(exc_traceback, file=sys.stderr)
+		sys.exit(-1)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+
+import sys, json, traceback
+from datetime import datetime
+import serial
+import argparse
+from protocol import Mek61107, NevaMt3xx, Metrics, Fleet
+
+
+DEFAULT_TIMEOUT = 2
+DEFAULT_PROFILE = ['00.09.02*FF', '00.09.01*FF', '0F.08.80*FF']
+
+def dump(message):
+	sys.stderr.write(datetime.now().strftime('%H:%M:%S.%f ')+message+'\n')
+
+def pase_args():
+	parser = argparse.ArgumentParser(description=u'Опрос парка счётчиков электроэнергии типа НЕВА МТ 3xx:\n'
+		u'счётчики разных COM портов и модемов опрашиваются параллельно.', formatter_class=argparse.RawTextHelpFormatter)
+	parser.add_argument('inventory',metavar='FILE',
+		help=u'список счётчиков (JSON): [{"port": "/dev/ttyUSB0" или "modem": "host:port",\n'
+			u'"address": "9144", "password": "00000000", "profile": ["0F.80.80*[00..7F]", ...]}, ...]')
+	parser.add_argument('--profile',metavar='SPEC',nargs='*',default=DEFAULT_PROFILE,
+		help=u'OBIS коды и диапазоны архивов счётчиков без своего профиля; по умолчанию: '+' '.join(DEFAULT_PROFILE))
+	parser.add_argument('--max-connections',metavar='COUNT',type=int,default=Fleet.Fleet.MAX_CONNECTIONS,
+		help=u'наибольшее число одновременных соединений с модемами; по умолчанию: '+str(Fleet.Fleet.MAX_CONNECTIONS))
+	parser.add_argument('--timeout',metavar='SECONDS',type=float,default=DEFAULT_TIMEOUT,
+		help=u'таймаут ответа счётчика, с; с --retries - наибольший; по умолчанию: '+str(DEFAULT_TIMEOUT))
+	parser.add_argument('--retries',metavar='COUNT',type=int,
+		help=u'повторов запроса OBIS при ошибке BCC, NAK или отсутствии ответа; по умолчанию: без повторов')
+	parser.add_argument('--output',metavar='FILE',
+		help=u'файл результатов (JSON Lines, по счётчику на строку); по умолчанию: stdout')
+	parser.add_argument('--metrics',action='store_true',
+		help=u'вывести метрики обмена в stderr по завершении')
+	parser.add_argument('-q','--quiet',action='store_true',help=u'не выводить ход опроса в stderr')
+	return parser.parse_args()
+
+def open_port(port_name):
+	port = serial.Serial(
+		port=port_name,
+		baudrate=9600,
+		timeout=args.timeout,
+		bytesize=serial.SEVENBITS,
+		parity=serial.PARITY_EVEN,
+		stopbits=serial.STOPBITS_ONE)
+	if not port.is_open:
+		port.open()
+	return port
+
+def get_record(meter, result, error):
+	record = {'meter': str(meter), 'address': meter.address, 'device': meter.device}
+	if error is None:
+		record['date'] = None if result['date'] is None else result['date'].isoformat()
+		record['values'] = result['values']
+	else:
+		record['error'] = str(error) or repr(error)
+	return record
+
+
+if __name__ == '__main__':
+	args = pase_args()
+	metrics = Metrics.Metrics() if args.metrics else None
+	retry_policy = None
+	if args.retries is not None:
+		retry_policy = NevaMt3xx.RetryPolicy(max_timeout=args.timeout, retries=args.retries)
+	output = sys.stdout if args.output is None else open(args.output, 'w')
+	try:
+		meters = Fleet.load_inventory(args.inventory, args.profile)
+		fleet = Fleet.Fleet(meters, open_port, max_connections=args.max_connections, timeout=args.timeout,
+			metrics=metrics, retry_policy=retry_policy)
+		if not args.quiet:
+			dump('Poll {} meters: {} ports, {} modems'.format(len(meters), len(fleet.get_lines(False)), len(fleet.get_lines(True))))
+		count = 0
+		for meter, result, error in fleet.poll():
+			count += 1
+			output.write(json.dumps(get_record(meter, result, error), sort_keys=True)+'\n')
+			output.flush()
+			if not args.quiet:
+				dump('[{}/{}] {}: {}; {:.1f} meters/min'.format(count, len(meters), meter,
+					'ok' if error is None else 'ERROR '+(str(error) or repr(error)), fleet.get_throughput()))
+		if not args.quiet:
+			dump('done: {} ok, {} failed'.format(fleet.polled_count, fleet.failed_count))
+	except Exception as e:
+		print >>sys.stderr, u'ERROR: '+str(e)
+		exc_type, exc_value, exc_traceback = sys.exc_info()
+		traceback.print_tb(exc_traceback, file=sys.stderr)
+		sys.exit(-1)
+	finally:
+		if args.output is not None:
+			output.close()
+		if metrics is not None:
+			sys.stderr.write(metrics.dump())
+	sys.exit(0 if fleet.failed_count == 0 else 1)
@@ -5,6 +5,7 @@ python meter_imitator.py -vv \
 	0A.01.64*FF:070001,230002,000000,000000,000000,000000,000000,000000 \
 	0B.00.00*FF \
 	0F.08.80*FF:000000.64,000000.55,000000.09,000000.00,000000.00 \
+	0F.08.80*[0..C]:000000.64,000000.55,000000.09,000000.00,000000.00 \
 	0F.80.80*[0..7F]:000400.84,000309.98,000090.86,000000.00,000000.00 \
 	10.07.00*FF:00015.4 \
 	60.01.00*FF:00000000 \
@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Архив суточных профилей счётчиков: сжатые блоки суток и индекс фиксированного размера для mmap
+
+import os
+import re
+import mmap
+import zlib
+import array
+import struct
+from datetime import timedelta
+import Mek61107
+from Mek61107 import numpy
+
+
+INDEX_MAGIC = 'NMTIDX\x00\x01' # заголовок индекса
+INDEX_HEADER = struct.Struct('<8sIHH') # MAGIC, номер первых суток (date.toordinal), строк и столбцов суток
+INDEX_RECORD = struct.Struct('<QI') # запись суток: смещение блока в файле данных, длина блока; 0 - суток нет
+DATA_MAGIC = 'NMTDAT\x00\x01' # заголовок файла данных; далее блоки суток
+
+
+class WrongArchive(Mek61107.Mek61107.Mek61107Exception):
+	pass
+
+
+def encode_day(values, columns=1):
+	"""Возвращает блок суток: разности значений values со значениями предыдущей строки
+	(по столбцам, первая строка - сами значения), int32, сжатые zlib"""
+	deltas = [values[i]-values[i-columns] if i >= columns else values[i] for i in xrange(len(values))]
+	return zlib.compress(struct.pack('<{}i'.format(len(deltas)), *deltas))
+
+
+def decode_day(buff, count, columns=1):
+	"""Возвращает значения суток (count целых) по блоку encode_day"""
+	values = list(struct.unpack('<{}i'.format(count), zlib.decompress(buff)))
+	for i in xrange(columns, count):
+		values[i] += values[i-columns]
+	return values
+
+
+class ArchiveFile:
+	"""Архив суток одного счётчика: файл индекса file_name.idx и файл данных file_name.dat.
+
+	Данные только дописываются: блок суток (encode_day) добавляется в конец файла данных,
+	повторная запись суток с другими значениями добавляет новый блок. Индекс - записи INDEX_RECORD фиксированного размера
+	по суткам подряд от первых суток архива, поэтому сутки находятся по дате за O(1);
+	индекс и данные читаются через mmap без разбора текста."""
+
+	def __init__(self, file_name, rows, columns):
+		self.index_name = file_name+'.idx'
+		self.data_name = file_name+'.dat'
+		self.rows = rows
+		self.columns = columns
+		self.count = rows*columns
+		self.first_day = None # номер первых суток индекса (date.toordinal)
+		if os.path.exists(self.index_name):
+			self.index = open(self.index_name, 'r+b')
+			magic, first_day, archive_rows, archive_columns = INDEX_HEADER.unpack(self.index.read(INDEX_HEADER.size))
+			if magic != INDEX_MAGIC or archive_rows != rows or archive_columns != columns:
+				raise WrongArchive('Wrong archive: '+file_name)
+			self.first_day = first_day or None
+			self.data = open(self.data_name, 'r+b')
+			if self.data.read(len(DATA_MAGIC)) != DATA_MAGIC:
+				raise WrongArchive('Wrong archive: '+file_name)
+		else:
+			self.index = open(self.index_name, 'w+b')
+			self.write_header()
+			self.data = open(self.data_name, 'w+b')
+			self.data.write(DATA_MAGIC)
+			self.data.flush()
+		self.index_map = None
+		self.data_map = None
+
+	def close(self):
+		self.unmap()
+		self.index.close()
+		self.data.close()
+
+	def unmap(self):
+		for m in (self.index_map, self.data_map):
+			if m is not None:
+				m.close()
+		self.index_map = self.data_map = None
+
+	def write_header(self):
+		self.index.seek(0)
+		self.index.write(INDEX_HEADER.pack(INDEX_MAGIC, self.first_day or 0, self.rows, self.columns))
+
+	def get_record_offset(self, day):
+		return INDEX_HEADER.size+(day-self.first_day)*INDEX_RECORD.size
+
+	def move_start(self, day):
+		"""Переносит начало индекса на более ранние сутки day: записи сдвигаются, данные не меняются"""
+		self.unmap()
+		self.index.seek(INDEX_HEADER.size)
+		records = self.index.read()
+		self.first_day, shift = day, self.first_day-day
+		self.write_header()
+		self.index.write('\x00'*(shift*INDEX_RECORD.size)+records)
+		self.index.flush()
+
+	def put(self, day_date, values):
+		"""Дописывает сутки day_date: values - rows*columns целых; сутки с теми же значениями не дописываются,
+		поэтому повторное считывание тех же суток не увеличивает файл данных"""
+		if len(values) != self.count:
+			raise WrongArchive('Wrong day values count: {} ({} expected)'.format(len(values), self.count))
+		if self.get(day_date) == list(values):
+			return
+		day = day_date.toordinal()
+		if self.first_day is None:
+			self.first_day = day
+			self.write_header()
+		elif day < self.first_day:
+			self.move_start(day)
+		buff = encode_day(values, self.columns)
+		self.data.seek(0, os.SEEK_END)
+		offset = self.data.tell()
+		self.data.write(buff)
+		self.data.flush()
+		# индекс - после данных: запись индекса всегда указывает на целый блок
+		self.index.seek(self.get_record_offset(day))
+		self.index.write(INDEX_RECORD.pack(offset, len(buff)))
+		self.index.flush()
+
+	@staticmethod
+	def get_map(m, f, size):
+		"""Возвращает mmap файла f не короче size байт или None, если файл короче"""
+		if m is not None and len(m) >= size:
+			return m
+		if m is not None:
+			m.close()
+		if os.fstat(f.fileno()).st_size < size:
+			return None
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def get(self, day_date):
+		"""Возвращает значения суток day_date или None, если суток нет в архиве"""
+		if self.first_day is None:
+			return None
+		offset = self.get_record_offset(day_date.toordinal())
+		if offset < INDEX_HEADER.size:
+			return None
+		self.index_map = self.get_map(self.index_map, self.index, offset+INDEX_RECORD.size)
+		if self.index_map is None:
+			return None
+		data_offset, size = INDEX_RECORD.unpack_from(self.index_map, offset)
+		if size == 0:
+			return None
+		self.data_map = self.get_map(self.data_map, self.data, data_offset+size)
+		return decode_day(self.data_map[data_offset:data_offset+size], self.count, self.columns)
+
+
+class Archive:
+	"""Архив суточных значений счётчиков name ('63.01.00' - профиль, 48 строк) в каталоге directory:
+	по файлам индекса и данных (ArchiveFile) на счётчик. Сутки - rows строк по columns целых;
+	строки суток хранятся разностями (delta) и сжимаются, поэтому архив за годы занимает мало места.
+
+	Example:
+	archive = Archive.Archive('archive', '63.01.00')
+	archive.put(device, date, [int(value) for value in buff.split(',')])
+	print archive.get(device, date)
+	profiles = archive.get_array(device, dates) # Tariffs.make_profiles без разбора текста
+	"""
+
+	def __init__(self, directory, name='63.01.00', rows=48, columns=1):
+		self.directory = directory
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.name = name
+		self.rows = rows
+		self.columns = columns
+		self.files = {} # счётчик -> ArchiveFile
+
+	def get_file(self, device):
+		f = self.files.get(device)
+		if f is None:
+			file_name = os.path.join(self.directory, re.sub(r'[^0-9A-Za-z._-]', '_', device+'.'+self.name))
+			f = self.files[device] = ArchiveFile(file_name, self.rows, self.columns)
+		return f
+
+	def put(self, device, day_date, values):
+		self.get_file(device).put(day_date, values)
+
+	def get(self, device, day_date):
+		return self.get_file(device).get(day_date)
+
+	def get_days(self, device, start, stop):
+		"""Генератор [дата, значения или None] суток от start до stop включительно"""
+		f = self.get_file(device)
+		for i in xrange((stop-start).days+1):
+			day_date = start+timedelta(days=i)
+			yield [day_date, f.get(day_date)]
+
+	def get_array(self, device, dates):
+		"""Возвращает значения суток dates: numpy массив days×rows×columns (days×rows при одном столбце)
+		или, без numpy, array('l') длиной days*rows*columns, как Tariffs.make_profiles;
+		отсутствующие сутки - WrongArchive"""
+		values = []
+		f = self.get_file(device)
+		for day_date in dates:
+			day = f.get(day_date)
+			if day is None:
+				raise WrongArchive('No day {} in archive of {}'.format(day_date, device))
+			values.append(day)
+		if numpy is None:
+			return array.array('l', [value for day in values for value in day])
+		shape = (len(values), self.rows) if self.columns == 1 else (len(values), self.rows, self.columns)
+		return numpy.array(values, dtype=numpy.int64).reshape(shape)
+
+	def close(self):
+		for f in self.files.values():
+			f.close()
+		self.files = {}
@@ -0,0 +1,181 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Запись обмена со счётчиком в двоичный файл
+
+import io
+import time
+import struct
+import Mek61107
+import NevaMt3xx
+
+
+MAGIC = 'NMTCAP\x00\x01' # заголовок файла
+RECORD = struct.Struct('<dBI') # запись: время time.time(), направление, длина данных; далее данные
+RCV, SND = 0, 1 # направление: принято, передано
+
+
+class CaptureLog(NevaMt3xx.LogBase):
+	"""Журнал, записывающий принятые и переданные данные в файл file_name:
+	заголовок MAGIC, далее записи RECORD с данными.
+	Файл пишется через буфер, поэтому запись не влияет на время обмена по линии.
+	Протокол должен передавать данные: log_bytes=True.
+	Текстовые сообщения и кадры передаются журналу log; данные - только если log_bytes.
+
+	Example:
+	capture = Capture.CaptureLog('session.cap', log=logger)
+	protocol = NevaMt3xx.NevaMt3xx_com(port, log=capture, log_bytes=True)
+	...
+	capture.close()
+	"""
+
+	BUFFER_SIZE = 65536
+
+	def __init__(self, file_name, log=None, log_bytes=False):
+		self.file = io.open(file_name, 'wb', buffering=self.BUFFER_SIZE)
+		self.file.write(MAGIC)
+		self.log = log
+		self.log_bytes = log_bytes
+
+	def write(self, direction, data):
+		self.file.write(RECORD.pack(time.time(), direction, len(data)))
+		self.file.write(data)
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+	def log_rcv(self, data):
+		if self.log is not None:
+			self.log.log_rcv(data)
+	def log_snd(self, data):
+		if self.log is not None:
+			self.log.log_snd(data)
+	def log_rcv_frame(self, cmd):
+		if self.log is not None:
+			self.log.log_rcv_frame(cmd)
+	def log_snd_frame(self, cmd):
+		if self.log is not None:
+			self.log.log_snd_frame(cmd)
+	def log_rcv_bytes(self, data):
+		self.write(RCV, data)
+		if self.log is not None and self.log_bytes:
+			self.log.log_rcv_bytes(data)
+	def log_snd_bytes(self, data):
+		self.write(SND, data)
+		if self.log is not None and self.log_bytes:
+			self.log.log_snd_bytes(data)
+
+
+def read_capture(file_name):
+	"""Генератор записей файла, записанного CaptureLog: [время, направление RCV/SND, данные]"""
+	with io.open(file_name, 'rb') as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise Mek61107.Mek61107.Mek61107Exception('Wrong capture file: '+str(file_name))
+		while True:
+			buff = f.read(RECORD.size)
+			if len(buff) < RECORD.size:
+				return
+			t, direction, size = RECORD.unpack(buff)
+			yield [t, direction, f.read(size)]
+
+
+class Replay:
+	"""Воспроизведение записанного обмена вместо счётчика.
+
+	Принятые данные (RCV) выдаются порциями в том виде, в котором они были записаны;
+	когда данные закончились, чтение возвращает пустую строку, как по таймауту.
+	strict -- сверять переданные данные с записанными (SND): Mek61107Exception при расхождении.
+	realtime -- выдавать принятые данные не раньше записанного времени от начала воспроизведения.
+	"""
+
+	def __init__(self, records, strict=False, realtime=False):
+		if isinstance(records, basestring):
+			records = read_capture(records)
+		records = list(records)
+		self.start_time = records[0][0] if len(records) > 0 else time.time() # время начала записи
+		self.rcv = [[t, data] for t, direction, data in records if direction == RCV and len(data) > 0]
+		self.snd = ''.join([data for t, direction, data in records if direction == SND])
+		self.snd_index = 0
+		self.strict = strict
+		self.realtime = realtime
+		self.replay_time = None
+
+	def wait(self):
+		"""Ожидание записанного времени приёма очередной порции данных"""
+		if self.replay_time is None:
+			self.replay_time = time.time()
+		if self.realtime and len(self.rcv) > 0:
+			delay = self.rcv[0][0]-self.start_time-(time.time()-self.replay_time)
+			if delay > 0:
+				time.sleep(delay)
+
+	def read(self, size=1):
+		if len(self.rcv) == 0:
+			return ''
+		self.wait()
+		data = self.rcv[0][1]
+		if len(data) <= size:
+			del self.rcv[0]
+			return data
+		self.rcv[0][1] = data[size:]
+		return data[:size]
+
+	def write(self, data):
+		if self.strict and self.snd[self.snd_index:self.snd_index+len(data)] != data:
+			raise Mek61107.Mek61107.Mek61107Exception('Replay: unexpected data: '+
+				data.decode('latin').encode('unicode_escape'))
+		self.snd_index += len(data)
+		return len(data)
+
+	def close(self):
+		pass
+
+
+class ReplayPort(Replay):
+	"""Воспроизведение записанного обмена вместо COM порта (serial.Serial) для NevaMt3xx_com
+
+	Example:
+	protocol = NevaMt3xx.NevaMt3xx_com(Capture.ReplayPort('session.cap'))
+	"""
+
+	BAUDRATES = Mek61107.Mek61107.BAUDRATES
+
+	def __init__(self, records, strict=False, realtime=False, baudrate=9600):
+		Replay.__init__(self, records, strict=strict, realtime=realtime)
+		self.baudrate = baudrate
+		self.timeout = None
+		self.inter_byte_timeout = None
+		self.is_open = True
+
+	@property
+	def in_waiting(self):
+		return len(self.rcv[0][1]) if len(self.rcv) > 0 else 0
+
+	def flush(self):
+		pass
+
+	def isOpen(self):
+		return self.is_open
+
+	def close(self):
+		self.is_open = False
+
+
+class ReplayConnection(Replay):
+	"""Воспроизведение записанного обмена вместо сокета для NevaMt3xx_tcp
+
+	Example:
+	protocol = NevaMt3xx.NevaMt3xx_tcp(Capture.ReplayConnection('session.cap'))
+	"""
+
+	def recv(self, size):
+		return self.read(size)
+
+	def sendall(self, data):
+		self.write(data)
+
+	def settimeout(self, timeout):
+		pass
@@ -0,0 +1,135 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Потоковая выгрузка показаний: CSV, JSON Lines, двоичный столбцовый формат
+
+import csv
+import json
+import struct
+import calendar
+from datetime import datetime, timedelta
+import Mek61107
+
+
+FORMATS = ('csv', 'jsonl', 'columnar')
+
+MAGIC = 'NMTCOL\x00\x01' # заголовок столбцового файла
+COLUMNS = struct.Struct('<H') # число столбцов; далее имена: длина (B) и имя
+BLOCK = struct.Struct('<Iq') # блок: число строк, время первой строки (с от 1970, время счётчика);
+# далее смещения времени строк от первой (i), с, и значения столбцов по столбцу (i) на все строки блока
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_time(t):
+	return calendar.timegm(t.timetuple())
+
+
+class WriterBase:
+	"""Запись строк [datetime, значения столбцов...] в file по одной, без накопления в памяти.
+	columns -- имена столбцов, включая первый столбец времени"""
+
+	def __init__(self, file, columns):
+		self.file = file
+		self.columns = list(columns)
+
+	def write(self, row):
+		pass
+
+	def write_rows(self, rows):
+		for row in rows:
+			self.write(row)
+
+	def close(self):
+		self.file.flush()
+
+
+class CsvWriter(WriterBase):
+	"""CSV: строка заголовка с именами столбцов, время в ISO 8601"""
+
+	def __init__(self, file, columns):
+		WriterBase.__init__(self, file, columns)
+		self.writer = csv.writer(file, lineterminator='\n')
+		self.writer.writerow(self.columns)
+
+	def write(self, row):
+		self.writer.writerow([row[0].isoformat()]+list(row[1:]))
+
+
+class JsonLinesWriter(WriterBase):
+	"""JSON Lines: объект {столбец: значение} на строку, время в ISO 8601"""
+
+	def write(self, row):
+		self.file.write(json.dumps(dict(zip(self.columns, [row[0].isoformat()]+[int(v) for v in row[1:]])),
+			sort_keys=True)+'\n')
+
+
+class ColumnarWriter(WriterBase):
+	"""Двоичный столбцовый формат: заголовок MAGIC, COLUMNS с именами столбцов, далее блоки BLOCK
+	до block_size строк: время строк смещениями от первой строки блока и целые значения столбцов,
+	каждый столбец подряд. В памяти хранится только текущий блок.
+	Значения - целые числа (Вт*ч); читается read_columnar"""
+
+	BLOCK_SIZE = 1024 # строк
+
+	def __init__(self, file, columns, block_size=BLOCK_SIZE):
+		WriterBase.__init__(self, file, columns)
+		self.block_size = block_size
+		self.rows = []
+		file.write(MAGIC)
+		file.write(COLUMNS.pack(len(self.columns)))
+		for name in self.columns:
+			file.write(struct.pack('<B', len(name))+name)
+
+	def write(self, row):
+		self.rows.append(row)
+		if len(self.rows) >= self.block_size:
+			self.write_block()
+
+	def write_block(self):
+		if len(self.rows) == 0:
+			return
+		size = len(self.rows)
+		times = [get_time(row[0]) for row in self.rows]
+		self.file.write(BLOCK.pack(size, times[0]))
+		values = struct.Struct('<{}i'.format(size))
+		self.file.write(values.pack(*[t-times[0] for t in times]))
+		for i in xrange(1, len(self.columns)):
+			self.file.write(values.pack(*[int(row[i]) for row in self.rows]))
+		self.rows = []
+
+	def close(self):
+		self.write_block()
+		WriterBase.close(self)
+
+
+def get_writer(format, file, columns):
+	"""Возвращает запись формата format (FORMATS) в file"""
+	if format == 'csv':
+		return CsvWriter(file, columns)
+	if format == 'jsonl':
+		return JsonLinesWriter(file, columns)
+	if format == 'columnar':
+		return ColumnarWriter(file, columns)
+	raise Mek61107.Mek61107.Mek61107Exception('Unknown export format: '+str(format))
+
+
+def read_columnar(file):
+	"""Генератор строк файла, записанного ColumnarWriter: [datetime, значения столбцов...].
+	Первая строка - имена столбцов"""
+	if file.read(len(MAGIC)) != MAGIC:
+		raise Mek61107.Mek61107.Mek61107Exception('Wrong columnar file')
+	count, = COLUMNS.unpack(file.read(COLUMNS.size))
+	columns = []
+	for i in xrange(count):
+		size, = struct.unpack('<B', file.read(1))
+		columns.append(file.read(size))
+	yield columns
+	while True:
+		buff = file.read(BLOCK.size)
+		if len(buff) < BLOCK.size:
+			return
+		size, start = BLOCK.unpack(buff)
+		values = struct.Struct('<{}i'.format(size))
+		data = [values.unpack(file.read(values.size)) for i in xrange(count)]
+		for j in xrange(size):
+			yield [EPOCH+timedelta(seconds=start+data[0][j])]+[data[i][j] for i in xrange(1, count)]
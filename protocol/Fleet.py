@@ -0,0 +1,206 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Опрос парка счётчиков: поток на COM порт, ограниченный пул соединений с модемами
+
+import json
+import time
+import Queue
+import threading
+import collections
+import Mek61107
+import NevaMt3xx
+import NevaMt3xxBus
+import NevaMt3xxAsync
+import MeterClock
+import Snapshot
+import Obis
+
+
+class FleetMeter(NevaMt3xxBus.Meter):
+	"""Счётчик парка: на COM порту port или за модемом modem (host, port), адрес на линии,
+	пароль и профиль снимка (Snapshot) для считывания"""
+
+	def __init__(self, port=None, modem=None, address='', password='00000000', profile=()):
+		self.snapshot = Snapshot.Snapshot(profile)
+		NevaMt3xxBus.Meter.__init__(self, address, password, self.snapshot.get_obis_list())
+		if (port is None) == (modem is None):
+			raise Mek61107.Mek61107.Mek61107Exception('Meter {}: port or modem expected'.format(address))
+		self.port = port
+		self.modem = modem
+
+	def __str__(self):
+		line = self.port if self.port is not None else '{}:{}'.format(*self.modem)
+		return '{} {}'.format(line, self.address) if len(self.address) > 0 else line
+
+	def get_line(self):
+		"""Линия счётчика: счётчики одной линии опрашиваются по очереди"""
+		return self.port if self.port is not None else tuple(self.modem)
+
+	def read(self, protocol):
+		return self.snapshot.read(protocol)
+
+	def read_async(self, protocol):
+		"""Операция NevaMt3xx_async: read; диапазоны архивов - в одних сутках счётчика
+		по дате до и после считывания"""
+		if not self.snapshot.is_archive():
+			values = yield protocol.read_many(self.obis_list)
+			raise NevaMt3xxAsync.Return(self.snapshot.get_result(None, values))
+		for i in xrange(MeterClock.MeterClock.DATE_TRIES):
+			values = yield protocol.read_many([Obis.DATE.get_code()]+self.obis_list+[Obis.DATE.get_code()])
+			if values[0] == values[-1]:
+				raise NevaMt3xxAsync.Return(self.snapshot.get_result(Obis.decode_date(values[0]), values[1:-1]))
+		raise Mek61107.Mek61107.Mek61107Exception('Can\'t read meter date')
+
+
+def load_inventory(file_name, profile=()):
+	"""Возвращает список FleetMeter по файлу JSON: список счётчиков
+	{"port": "/dev/ttyUSB0" или "modem": "host:port", "address": "9144", "password": "00000000",
+	"profile": ["0F.80.80*[00..7F]", ...]}; profile - профиль счётчиков без своего профиля"""
+	with open(file_name) as f:
+		items = json.load(f)
+	ret = []
+	for item in items:
+		modem = item.get('modem')
+		if modem is not None:
+			host, port = modem.rsplit(':', 1)
+			modem = (host, int(port))
+		ret.append(FleetMeter(item.get('port'), modem, str(item.get('address', '')),
+			str(item.get('password', '00000000')), item.get('profile', profile)))
+	return ret
+
+
+class Fleet:
+	"""Опрос парка счётчиков meters (FleetMeter) с параллельной работой линий:
+	- счётчики COM портов - через NevaMt3xx_com и NevaMt3xxBus.Bus, поток на порт;
+	- счётчики за модемами - через NevaMt3xx_async в одном цикле событий,
+	не более max_connections соединений одновременно; счётчики одного модема - по очереди.
+	Скорость опроса ограничивается линиями, а не очерёдностью опроса в одном процессе.
+	open_port(имя) открывает COM порт (serial.Serial).
+
+	Example:
+	fleet = Fleet.Fleet(Fleet.load_inventory('meters.json'), open_port)
+	for meter, result, error in fleet.poll():
+		print meter, result if error is None else error
+	"""
+
+	MAX_CONNECTIONS = 32
+	RESULT_TIMEOUT = 1. # период ожидания результатов, с: поток опроса прерывается по Ctrl+C
+
+	def __init__(self, meters, open_port=None, max_connections=MAX_CONNECTIONS, timeout=NevaMt3xxAsync.NevaMt3xx_async.TIMEOUT,
+		metrics=None, retry_policy=None, baudrate_policy=None, turnaround=NevaMt3xxBus.Bus.TURNAROUND):
+		"""timeout -- время ожидания ответа счётчика за модемом, с
+		metrics, retry_policy, baudrate_policy -- см. NevaMt3xx_com; metrics - общие для всех линий"""
+		self.meters = list(meters)
+		self.open_port = open_port
+		self.max_connections = max_connections
+		self.timeout = timeout
+		self.metrics = metrics
+		self.retry_policy = retry_policy
+		self.baudrate_policy = baudrate_policy
+		self.turnaround = turnaround
+		self.start_time = None
+		self.polled_count = 0
+		self.failed_count = 0
+
+	def get_lines(self, is_modem):
+		"""Возвращает [[линия, [счётчики]]] в порядке meters"""
+		lines = collections.OrderedDict()
+		for meter in self.meters:
+			if (meter.modem is not None) == is_modem:
+				lines.setdefault(meter.get_line(), []).append(meter)
+		return lines.items()
+
+	def poll_port(self, port_name, meters, results):
+		done = 0
+		try:
+			port = self.open_port(port_name)
+			try:
+				protocol = NevaMt3xx.NevaMt3xx_com(port, baudrate_policy=self.baudrate_policy,
+					metrics=self.metrics, retry_policy=self.retry_policy)
+				for ret in NevaMt3xxBus.Bus(protocol, meters, turnaround=self.turnaround).iter_poll():
+					results.put(ret)
+					done += 1
+			finally:
+				port.close()
+		except Exception as e:
+			# порт недоступен: ошибка для неопрошенных счётчиков
+			for meter in meters[done:]:
+				results.put([meter, None, e])
+
+	def poll_modem(self, loop, address, meters, results):
+		protocol = NevaMt3xxAsync.NevaMt3xx_async(loop, timeout=self.timeout, metrics=self.metrics,
+			retry_policy=self.retry_policy)
+		done = 0
+		try:
+			yield protocol.open_connection(address)
+			for meter in meters:
+				if done > 0 and self.turnaround > 0:
+					yield NevaMt3xxAsync.Sleep(self.turnaround)
+				try:
+					meter.company, meter.device = yield protocol.connect(device_number=meter.address)
+					if not (yield protocol.login(meter.password)):
+						raise Mek61107.Mek61107.Mek61107Exception('Access denied')
+					meter.values = yield meter.read_async(protocol)
+					yield protocol.logout()
+					meter.last_poll_time = time.time()
+					results.put([meter, meter.values, None])
+				except Mek61107.Mek61107.Mek61107Exception as e:
+					if protocol.is_closed:
+						raise
+					# счётчик мог остаться в режиме обмена - вернуть в исходное состояние
+					yield protocol.logout()
+					results.put([meter, None, e])
+				done += 1
+		except Exception as e:
+			# модем недоступен или соединение разорвано: ошибка для неопрошенных счётчиков
+			for meter in meters[done:]:
+				results.put([meter, None, e])
+		finally:
+			protocol.close()
+
+	def poll_modems(self, lines, results):
+		loop = NevaMt3xxAsync.Loop()
+		lines = collections.deque(lines)
+		def spawn(task=None):
+			if len(lines) > 0:
+				address, meters = lines.popleft()
+				loop.spawn(self.poll_modem(loop, address, meters, results), spawn)
+		for i in xrange(min(self.max_connections, len(lines))):
+			spawn()
+		loop.run()
+
+	def poll(self):
+		"""Генератор [meter, result, error] по мере опроса всех счётчиков:
+		result - Snapshot.read или None, если ошибка error"""
+		self.start_time = time.time()
+		results = Queue.Queue()
+		threads = [threading.Thread(target=self.poll_port, args=(port_name, meters, results))
+			for port_name, meters in self.get_lines(False)]
+		modems = self.get_lines(True)
+		if len(modems) > 0:
+			threads.append(threading.Thread(target=self.poll_modems, args=(modems, results)))
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		for i in xrange(len(self.meters)):
+			while True:
+				try:
+					ret = results.get(timeout=self.RESULT_TIMEOUT)
+					break
+				except Queue.Empty:
+					pass
+			if ret[2] is None:
+				self.polled_count += 1
+			else:
+				self.failed_count += 1
+			yield ret
+		for thread in threads:
+			thread.join()
+
+	def get_throughput(self):
+		"""Возвращает скорость опроса: опрошено счётчиков в минуту с начала опроса"""
+		if self.start_time is None:
+			return 0.
+		elapsed = time.time()-self.start_time
+		return self.polled_count*60./elapsed if elapsed > 0 else 0.
@@ -0,0 +1,460 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Имитация счётчиков НЕВА МТ3XХ: таблица OBIS значений и парк счётчиков в цикле событий (asyncore):
+# один процесс имитирует тысячи счётчиков за модемами для нагрузочных прогонов сервера опроса.
+
+import json
+import bisect
+import socket
+import asyncore
+import collections
+from datetime import datetime
+import Mek61107
+import NevaMt3xx
+import NevaMt3xxAsync
+import Synthetic
+
+
+class Obis():
+	def __init__(self, obis, data=None):
+		self.begin_index = obis.find('[')
+		if self.begin_index >= 0:
+			obis2 = obis[:self.begin_index].replace('.', '').replace('*', '')
+			buff = obis[self.begin_index+1:-1]
+			obis = obis2
+			self.begin_index = len(obis)
+			buff = buff.partition('..')
+			self.begin_value = int(buff[0], 16)
+			self.end_value = int(buff[2], 16)
+		else:
+			obis = obis.replace('.', '').replace('*', '')
+		self.obis = obis
+		self.data = data
+		self.generator = None # Synthetic: значение '@имя' вычисляется при запросе
+		if data is not None and data.startswith('@'):
+			self.generator = Synthetic.get_generator(data[1:])
+	def __str__(self):
+		return self.obis+('' if self.begin_index < 0 else '[{:02X}..{:02X}]'.format(self.begin_value,self.end_value))+': '+str(self.data)
+	def match(self, obis):
+		if self.begin_index < 0:
+			return self.obis == obis
+		if self.obis[:self.begin_index] != obis[:self.begin_index]:
+			return False
+		return self.begin_value <= int(obis[self.begin_index:], 16) <= self.end_value
+	def get_value(self, obis, meter=None):
+		"""Возвращает значение для нормализованного кода запроса obis: вычисленное генератором
+		по данным счётчика meter (Meter.get_data), заданное или, без значения, текущие дата и время"""
+		if self.generator is not None:
+			index = int(obis[self.begin_index:] if self.begin_index >= 0 else obis[-2:], 16)
+			data = Synthetic.MeterData('') if meter is None else meter.get_data()
+			return self.generator(data, index, datetime.now())
+		if self.data is not None:
+			return self.data
+		if self.obis == '000902FF': # Дата: ГГММДД
+			return datetime.now().strftime('%y%m%d')
+		if self.obis == '000901FF': # Время: ЧЧММСС
+			return datetime.now().strftime('%H%M%S')
+		return ''
+	def is_static(self):
+		"""Значение не меняется: ответ можно сформировать один раз"""
+		return self.data is not None and self.generator is None
+
+class ObisList(list):
+	"""Таблица OBIS значений имитатора: Obis в порядке приоритета - при пересечении кодов
+	отвечает первый подходящий.
+
+	Поиск по индексу, который строится при первом запросе после изменения списка:
+	- точные коды - словарь по нормализованному коду;
+	- диапазоны ('63.01.00*[0..7F]') - словарь по префиксу кода и отрезки номеров без пересечений,
+	номер ищется делением пополам (bisect);
+	- кадры ответов (get_frame) со значением, заданным строкой, сериализуются один раз на код.
+	После изменения элементов списка не через методы list - reindex()."""
+
+	def __init__(self, *args):
+		list.__init__(self, *args)
+		self.reindex()
+	@staticmethod
+	def parse(obis_values):
+		"""Возвращает ObisList по списку 'OBIS:значение' ('60.01.04*FF:000V0201', '63.01.00*[0..7F]:03977,...');
+		без значения - текущие дата и время для 00.09.02*FF и 00.09.01*FF, иначе пустое значение;
+		значение '@имя' - генератор Synthetic.GENERATORS ('63.01.00*[0..7F]:@profile')"""
+		obis_list = ObisList()
+		for obis_value in obis_values:
+			buff = obis_value.partition(':')
+			obis_list.append(Obis(buff[0], buff[2] if buff[1] == ':' else None))
+		return obis_list
+	def reindex(self):
+		self.index = None # [точные коды, {длина префикса: {префикс: [начала отрезков, [конец, позиция, Obis]]}}]
+		self.found = {} # код запроса -> [нормализованный код, Obis]
+		self.frames = {} # [код запроса, функция BCC] -> кадр ответа с неизменным значением
+	def append(self, obis):
+		list.append(self, obis)
+		self.reindex()
+	def extend(self, obis_list):
+		list.extend(self, obis_list)
+		self.reindex()
+	def insert(self, index, obis):
+		list.insert(self, index, obis)
+		self.reindex()
+	def __setitem__(self, index, obis):
+		list.__setitem__(self, index, obis)
+		self.reindex()
+	def __delitem__(self, index):
+		list.__delitem__(self, index)
+		self.reindex()
+	def __setslice__(self, i, j, obis_list):
+		list.__setslice__(self, i, j, obis_list)
+		self.reindex()
+	def __delslice__(self, i, j):
+		list.__delslice__(self, i, j)
+		self.reindex()
+	def __iadd__(self, obis_list):
+		list.__iadd__(self, obis_list)
+		self.reindex()
+		return self
+	def __imul__(self, count):
+		list.__imul__(self, count)
+		self.reindex()
+		return self
+	def pop(self, *args):
+		obis = list.pop(self, *args)
+		self.reindex()
+		return obis
+	def remove(self, obis):
+		list.remove(self, obis)
+		self.reindex()
+	def sort(self, *args, **kwargs):
+		list.sort(self, *args, **kwargs)
+		self.reindex()
+	def reverse(self):
+		list.reverse(self)
+		self.reindex()
+	@staticmethod
+	def get_segments(ranges):
+		"""Возвращает [начала, [конец, позиция, Obis]] отрезков без пересечений для диапазонов ranges
+		одного префикса ([позиция, Obis] в порядке позиций): номер отрезка принадлежит первому диапазону"""
+		bounds = sorted(set([obis.begin_value for position, obis in ranges]+[obis.end_value+1 for position, obis in ranges]))
+		begins, segments = [], []
+		for begin, next_begin in zip(bounds, bounds[1:]):
+			owner = None
+			for position, obis in ranges:
+				if obis.begin_value <= begin <= obis.end_value:
+					owner = [position, obis]
+					break
+			if owner is None:
+				continue
+			if len(segments) > 0 and segments[-1][1] == owner[0] and segments[-1][0] == begin-1:
+				segments[-1][0] = next_begin-1
+			else:
+				begins.append(begin)
+				segments.append([next_begin-1]+owner)
+		return [begins, segments]
+	def build_index(self):
+		exact = {}
+		ranges = {}
+		for position, obis in enumerate(self):
+			if obis.begin_index < 0:
+				exact.setdefault(obis.obis, [position, obis])
+			else:
+				ranges.setdefault(obis.begin_index, {}).setdefault(obis.obis[:obis.begin_index], []).append([position, obis])
+		for prefixes in ranges.values():
+			for prefix, items in prefixes.items():
+				prefixes[prefix] = self.get_segments(items)
+		self.index = [exact, ranges]
+	def find(self, obis):
+		"""Возвращает [позицию, Obis] первого элемента, подходящего нормализованному коду obis, или None"""
+		if self.index is None:
+			self.build_index()
+		exact, ranges = self.index
+		ret = exact.get(obis)
+		for length, prefixes in ranges.iteritems():
+			segments = prefixes.get(obis[:length])
+			if segments is None:
+				continue
+			try:
+				value = int(obis[length:], 16)
+			except ValueError:
+				continue
+			begins, items = segments
+			i = bisect.bisect_right(begins, value)-1
+			if i >= 0 and value <= items[i][0] and (ret is None or items[i][1] < ret[0]):
+				ret = items[i][1:]
+		return ret
+	def get_item(self, obis):
+		"""Возвращает [нормализованный код, Obis] для кода запроса obis; результат поиска запоминается по коду"""
+		found = self.found.get(obis)
+		if found is None:
+			code = obis.replace('.', '').replace('*', '') if '.' in obis or '*' in obis else obis
+			found = self.find(code)
+			if found is None:
+				raise Exception('OBIS not found: '+str(code))
+			found = self.found[obis] = [code, found[1]]
+		return found
+	def get_obis(self, obis, meter=None):
+		"""Возвращает значение кода запроса obis; meter - счётчик (Meter) для значений генераторов"""
+		code, item = self.get_item(obis)
+		return item.get_value(code, meter)
+	def get_frame(self, obis, calculate_bcc_func, meter=None):
+		"""Возвращает сериализованный кадр ответа на R1 кода obis (нормализованного, как в запросе);
+		кадры неизменных значений запоминаются по коду и функции BCC"""
+		key = (obis, calculate_bcc_func)
+		frame = self.frames.get(key)
+		if frame is None:
+			code, item = self.get_item(obis)
+			frame = Mek61107.Mek61107.Message(obis+'('+str(item.get_value(code, meter))+')').serialize(calculate_bcc_func)
+			if item.is_static():
+				self.frames[key] = frame
+		return frame
+	def get_day_schedule(self):
+		"""Возвращает суточное тарифное расписание таблицы (0A.01.64*FF) для генераторов"""
+		try:
+			code, item = self.get_item('0A0164FF')
+		except Exception:
+			return Synthetic.DEFAULT_SCHEDULE
+		return item.data if item.is_static() else Synthetic.DEFAULT_SCHEDULE
+
+
+class Meter:
+	"""Имитируемый счётчик: код производителя company, идентификатор device (не более 16 символов),
+	адрес на линии address, пароль password и таблица OBIS значений obis_list (ObisList);
+	значения генераторов таблицы - свои для счётчика (get_data)"""
+
+	def __init__(self, company, device, address, password, obis_list):
+		self.company = company
+		self.device = device
+		self.address = address
+		self.password = password
+		self.obis_list = obis_list
+		self.data = None # Synthetic.MeterData: создаются при первом запросе значения генератора
+
+	def get_data(self):
+		if self.data is None:
+			self.data = Synthetic.MeterData(str(self), self.obis_list.get_day_schedule())
+		return self.data
+
+	def __str__(self):
+		return '{}{}'.format(self.company, self.device) if len(self.address) == 0 else \
+			'{}/{}{}'.format(self.address, self.company, self.device)
+
+
+class Listener(asyncore.dispatcher):
+	"""Слушающий сокет линии в цикле событий loop (NevaMt3xxAsync.Loop)"""
+
+	BACKLOG = 5
+
+	def __init__(self, loop, address):
+		asyncore.dispatcher.__init__(self, map=loop.map)
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.set_reuse_addr()
+		self.bind(address)
+		self.listen(self.BACKLOG)
+		self.connections = collections.deque() # принятые, ещё не обслуживаемые подключения
+		self.wait = None
+
+	def writable(self):
+		return False
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is not None:
+			self.connections.append(pair[0])
+			if self.wait is not None and self.wait.task is not None:
+				self.wait.check()
+
+	def accept_connection(self):
+		"""Операция: ожидание подключения; результат - подключенный сокет"""
+		return WaitAccept(self)
+
+
+class WaitAccept(NevaMt3xxAsync.Wait):
+	def __init__(self, listener):
+		NevaMt3xxAsync.Wait.__init__(self)
+		self.listener = listener
+	def start(self, task):
+		self.listener.wait = self
+		NevaMt3xxAsync.Wait.start(self, task)
+	def check(self):
+		if len(self.listener.connections) > 0:
+			self.complete(self.listener.connections.popleft())
+
+
+class Imitator:
+	"""Парк имитируемых счётчиков в одном цикле событий NevaMt3xxAsync.Loop.
+
+	Счётчики объединены в линии (модемы): на линии один сеанс обмена за раз, счётчик выбирается
+	адресом в сообщении запроса ('/?адрес!'), пустой адрес - первый счётчик линии. Линия:
+	- клиент модема (add_client): подключается к серверу опроса, передаёт init_data
+	и обслуживает запросы; при разрыве соединения подключается снова через RECONNECT_DELAY;
+	- сервер (add_server): ожидает подключения сервера опроса на своём TCP порту.
+	Память на линию ограничена буферами протокола (NevaMt3xx_async), таблицы OBIS значений
+	могут быть общими для счётчиков.
+
+	Example:
+	imitator = Imitator.Imitator()
+	for i in xrange(1000):
+		meter = Imitator.Meter('TPC', 'NEVAMT324.{:05}'.format(i), '', '00000000', obis_list)
+		imitator.add_server(('', 30000+i), [meter])
+	imitator.run()
+	"""
+
+	SESSION_TIMEOUT = 60. # время ожидания запроса в сеансе обмена, с; затем сеанс завершается
+	RECONNECT_DELAY = 5. # пауза перед повторным подключением клиента модема, с
+	ERROR_ANSWER = '(3)' # ответ на запрос неизвестного OBIS кода
+
+	def __init__(self, loop=None, log=None, log_bytes=False, session_timeout=SESSION_TIMEOUT,
+		reconnect_delay=RECONNECT_DELAY):
+		self.loop = NevaMt3xxAsync.Loop() if loop is None else loop
+		self.log = log
+		self.log_bytes = log_bytes
+		self.session_timeout = session_timeout
+		self.reconnect_delay = reconnect_delay
+		self.lines_count = 0
+		self.meters_count = 0
+		self.connections = 0 # установленных соединений
+		self.sessions = 0 # сеансов обмена (вход по паролю)
+		self.requests = 0 # ответов на R1
+		self.errors = 0 # ошибок: неверный пароль, неизвестный OBIS код, ошибка обмена
+
+	def add_client(self, address, meters, init_data=None):
+		"""Добавляет линию - клиент модема, подключающийся к серверу опроса по адресу address (host, port)"""
+		self.add_line(meters)
+		return self.loop.spawn(self.run_client(address, self.get_meters(meters), init_data))
+
+	def add_server(self, address, meters):
+		"""Добавляет линию, ожидающую подключений на адресе address (host, port)"""
+		self.add_line(meters)
+		listener = Listener(self.loop, address)
+		return self.loop.spawn(self.run_server(listener, self.get_meters(meters)))
+
+	def add_line(self, meters):
+		self.lines_count += 1
+		self.meters_count += len(meters)
+
+	@staticmethod
+	def get_meters(meters):
+		"""Возвращает {адрес: счётчик} линии; первый счётчик линии - также по пустому адресу"""
+		ret = dict([[meter.address, meter] for meter in meters])
+		ret.setdefault('', meters[0])
+		return ret
+
+	def run(self):
+		self.loop.run()
+
+	def get_protocol(self, connection=None):
+		return NevaMt3xxAsync.NevaMt3xx_async(self.loop, connection, self.log, self.log_bytes,
+			timeout=self.session_timeout)
+
+	def run_client(self, address, meters, init_data):
+		while True:
+			protocol = self.get_protocol()
+			try:
+				yield protocol.open_connection(address)
+				self.connections += 1
+				if init_data is not None:
+					protocol.write(init_data)
+				yield self.serve(protocol, meters)
+			except Mek61107.Mek61107.Mek61107Exception:
+				self.errors += 1
+			finally:
+				protocol.close()
+			yield NevaMt3xxAsync.Sleep(self.reconnect_delay)
+
+	def run_server(self, listener, meters):
+		while True:
+			connection = yield listener.accept_connection()
+			self.connections += 1
+			protocol = self.get_protocol(connection)
+			try:
+				yield self.serve(protocol, meters)
+			except Mek61107.Mek61107.Mek61107Exception:
+				self.errors += 1
+			finally:
+				protocol.close()
+
+	def serve(self, protocol, meters):
+		"""Операция: обслуживание сеансов обмена до закрытия соединения"""
+		while not protocol.is_closed:
+			line = yield protocol.receive_line()
+			if len(line) == 0:
+				# нет запроса: соединение закрыто или ожидание следующего запроса
+				protocol.error = None
+				continue
+			try:
+				meter = meters.get(protocol.get_request(line))
+			except Mek61107.Mek61107.Mek61107Exception:
+				# не сообщение запроса: например, данные модема
+				continue
+			if meter is None:
+				# запрос другому счётчику линии: счётчик молчит
+				continue
+			yield self.serve_session(protocol, meter)
+			protocol.decoder.clear()
+			protocol.error = None
+
+	def serve_session(self, protocol, meter):
+		"""Операция: сеанс обмена счётчика meter после сообщения запроса"""
+		protocol.write(protocol.make_id_message(meter.company, 9600, meter.device))
+		buff = yield protocol.receive_line()
+		if len(buff) == 0:
+			return
+		baudrate, v, y = protocol.get_ack_message(buff)
+		if baudrate != 9600:
+			raise Mek61107.Mek61107.WrongBaudrate('Baudrate 9600 not acknowledged: '+str(baudrate))
+		protocol.send(NevaMt3xx.NevaMt3xx.Command('P0', '(00000000)'))
+		cmd = yield protocol.receive()
+		if not cmd.is_command or cmd.command != 'P1' or cmd.data != '('+meter.password+')':
+			self.errors += 1
+			protocol.send(NevaMt3xx.NevaMt3xx.Nak())
+			return
+		protocol.send(NevaMt3xx.NevaMt3xx.Ack())
+		self.sessions += 1
+		while True:
+			cmd = yield protocol.receive()
+			if cmd.is_timeout:
+				return
+			if not cmd.is_command:
+				continue
+			if cmd.command == 'R1':
+				obis = cmd.data[:-2]
+				try:
+					if protocol.log is None:
+						# без журнала - готовый кадр ответа
+						protocol.write(meter.obis_list.get_frame(obis, protocol.bcc.calculate, meter))
+					else:
+						protocol.send(NevaMt3xx.NevaMt3xx.Message(obis+'('+str(meter.obis_list.get_obis(obis, meter))+')'))
+					self.requests += 1
+				except Exception:
+					self.errors += 1
+					protocol.send(NevaMt3xx.NevaMt3xx.Message(self.ERROR_ANSWER))
+			elif cmd.command == 'B0':
+				return
+
+	def get_stats(self):
+		return {
+			'lines': self.lines_count,
+			'meters': self.meters_count,
+			'connections': self.connections,
+			'sessions': self.sessions,
+			'requests': self.requests,
+			'errors': self.errors,
+		}
+
+
+def load_meters(file_name, obis_list=None):
+	"""Возвращает [[линия, [Meter]]] по файлу JSON: список счётчиков
+	{"modem": "host:port" или "listen": "host:port", "company": "TPC", "device": "NEVAMT324.2303",
+	"address": "9144", "password": "00000000", "obis": ["60.01.04*FF:000V0201", ...]};
+	линия - ['modem' или 'listen', (host, port)]; счётчики одной линии - в порядке файла;
+	obis_list - таблица счётчиков без своего "obis"."""
+	with open(file_name) as f:
+		items = json.load(f)
+	lines = collections.OrderedDict()
+	for item in items:
+		mode = 'modem' if 'modem' in item else 'listen'
+		host, port = str(item[mode]).rsplit(':', 1)
+		obis = item.get('obis')
+		meter = Meter(str(item.get('company', 'TPC')), str(item.get('device', '')), str(item.get('address', '')),
+			str(item.get('password', '00000000')), obis_list if obis is None else ObisList.parse([str(o) for o in obis]))
+		lines.setdefault((mode, (host, int(port))), []).append(meter)
+	return lines.items()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Часы счётчика: смещение от часов компьютера вместо считывания даты при каждом запросе
+
+import time
+from datetime import datetime
+import Mek61107
+import Obis
+
+
+class MeterClock:
+	"""Часы счётчика, считанные через protocol (NevaMt3xx) один раз за сеанс:
+	дата и время (00.09.02*FF, 00.09.01*FF) и их смещение от часов компьютера.
+
+	Номера суток в OBIS кодах профилей (XX - дней назад) отсчитываются от даты счётчика,
+	поэтому считывание, попавшее на полночь счётчика, вернуло бы значения соседних суток.
+	read считывает запросы без проверки даты, если по смещению часов считывание
+	заканчивается до полуночи счётчика с запасом margin даже при наибольшей длительности запросов
+	(protocol.get_max_request_time: таймауты и повторы, а не среднее время ответа);
+	иначе - считывает дату и время до считывания и дату после, повторяя считывание при смене суток.
+
+	Example:
+	clock = MeterClock.MeterClock(protocol)
+	date, values = clock.read(lambda date: ['63.01.00*{:02X}'.format((date-day).days) for day in days])
+	"""
+
+	DATE_OBIS = '00.09.02*FF' # дата: ГГММДД
+	TIME_OBIS = '00.09.01*FF' # время: ЧЧММСС
+	MARGIN = 5. # запас на точность смещения: дискретность часов счётчика, время ответа, с
+	DATE_TRIES = 3
+	DAY = 24*3600 # с
+
+	def __init__(self, protocol, margin=MARGIN):
+		self.protocol = protocol
+		self.margin = margin
+		self.offset = None # timedelta: время счётчика - время компьютера
+
+	@staticmethod
+	def get_date(buff):
+		return Obis.decode_date(buff)
+
+	@staticmethod
+	def get_seconds(t):
+		"""Возвращает число секунд от начала суток t (datetime)"""
+		return t.hour*3600+t.minute*60+t.second+t.microsecond/1e6
+
+	def sync(self):
+		"""Считывает дату и время счётчика и запоминает смещение от часов компьютера"""
+		for i in xrange(self.DATE_TRIES):
+			send_time = time.time()
+			date, meter_time = self.protocol.read_many([self.DATE_OBIS, self.TIME_OBIS])
+			receive_time = time.time()
+			meter_time = datetime.strptime(date+meter_time, '%y%m%d%H%M%S')
+			self.offset = meter_time-datetime.fromtimestamp((send_time+receive_time)/2)
+			seconds = self.get_seconds(meter_time)
+			if self.margin <= seconds < self.DAY-self.margin:
+				return
+			# дата и время могли быть считаны в разных сутках: повтор после полуночи счётчика
+			time.sleep(self.margin-seconds if seconds < self.margin else self.DAY-seconds+self.margin)
+		raise Mek61107.Mek61107.Mek61107Exception('Can\'t read meter date')
+
+	def now(self):
+		"""Возвращает время счётчика по смещению его часов (datetime)"""
+		if self.offset is None:
+			self.sync()
+		return datetime.now()+self.offset
+
+	def get_duration(self, count):
+		"""Возвращает наибольшую длительность считывания count OBIS кодов, с; None - не ограничена"""
+		request_time = self.protocol.get_max_request_time()
+		return None if request_time is None else count*request_time
+
+	def is_safe(self, meter_time, duration):
+		"""Возвращает True - считывание длительностью не более duration, с (None - не ограничена),
+		начатое во время счётчика meter_time, заканчивается в тех же сутках счётчика с запасом margin"""
+		if duration is None:
+			return False
+		seconds = self.get_seconds(meter_time)
+		return self.margin <= seconds and seconds+duration+self.margin < self.DAY
+
+	def read(self, get_obis_list, window=None):
+		"""Считывает OBIS коды get_obis_list(дата счётчика) через protocol.read_many в одних сутках счётчика.
+		Возвращает [дата счётчика, значения].
+		Может вызвать исключения: Mek61107Exception"""
+
+		for i in xrange(self.DATE_TRIES):
+			meter_time = self.now()
+			date = meter_time.date()
+			obis_list = get_obis_list(date)
+			if self.is_safe(meter_time, self.get_duration(len(obis_list))):
+				return date, self.protocol.read_many(obis_list, window=window)
+			# считывание может попасть на полночь счётчика: контроль даты до и после
+			self.sync()
+			date = self.now().date()
+			obis_list = get_obis_list(date)
+			values = self.protocol.read_many(obis_list+[self.DATE_OBIS], window=window)
+			if self.get_date(values[-1]) == date:
+				return date, values[:-1]
+		raise Mek61107.Mek61107.Mek61107Exception('Can\'t read meter date')
@@ -0,0 +1,186 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Метрики обмена со счётчиками: время ответа, объём данных, ошибки
+
+import sys
+import time
+import bisect
+import threading
+
+
+class Histogram:
+	"""Гистограмма длительностей, с: число значений не больше каждой из границ bounds,
+	а также число, сумма, минимум и максимум всех значений"""
+
+	BOUNDS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+	def __init__(self, bounds=BOUNDS):
+		self.bounds = tuple(bounds)
+		self.counts = [0]*(len(self.bounds)+1) # последний элемент - значения больше всех границ
+		self.count = 0
+		self.sum = 0.
+		self.min = None
+		self.max = None
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+	def get_mean(self):
+		return self.sum/self.count if self.count > 0 else None
+
+	def get_quantile(self, q):
+		"""Возвращает оценку сверху квантиля q (0..1): границу интервала, в который он попадает"""
+		if self.count == 0:
+			return None
+		rank = q*self.count
+		total = 0
+		for i in xrange(len(self.bounds)):
+			total += self.counts[i]
+			if total >= rank:
+				return min(self.bounds[i], self.max)
+		return self.max
+
+	def get(self):
+		return {
+			'bounds': list(self.bounds),
+			'counts': list(self.counts),
+			'count': self.count,
+			'sum': self.sum,
+			'min': self.min,
+			'max': self.max,
+		}
+
+
+class Metrics:
+	"""Метрики обмена со счётчиками, собираемые протоколом (NevaMt3xx_com, NevaMt3xx_tcp, NevaMt3xx_async).
+
+	Значения учитываются по ключу [счётчик, команда, OBIS код]:
+	- rtt: гистограмма времени от посылки запроса до ответа, с;
+	- counters: requests, bytes_out, bytes_in, bcc_errors, timeouts, naks, retries;
+	- durations: гистограммы длительности handshake (connect) и login по счётчикам.
+	Счётчик - company+id после connect; команда и OBIS код - запроса, на который получен ответ.
+
+	Значения можно получить вызовом get (pull) или в текстовом виде dump,
+	в том числе периодически: start_dump.
+
+	Example:
+	metrics = Metrics.Metrics()
+	protocol = NevaMt3xx.NevaMt3xx_com(port, metrics=metrics)
+	metrics.start_dump(60, sys.stderr)
+	...
+	print metrics.get()['rtt'][('NEV9144', 'R1', '000902FF')].get_quantile(.9)
+	"""
+
+	COUNTERS = ('requests', 'bytes_out', 'bytes_in', 'bcc_errors', 'timeouts', 'naks', 'retries')
+	DURATIONS = ('handshake', 'login')
+
+	def __init__(self, bounds=Histogram.BOUNDS):
+		self.bounds = bounds
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.start_time = time.time()
+			self.rtt = {}
+			self.counters = dict([[name, {}] for name in self.COUNTERS])
+			self.durations = dict([[name, {}] for name in self.DURATIONS])
+
+	def add(self, name, device, command='', obis='', value=1):
+		"""Увеличивает счётчик name (COUNTERS) на value"""
+		key = (device or '', command, obis)
+		with self.lock:
+			counter = self.counters[name]
+			counter[key] = counter.get(key, 0)+value
+
+	def observe_rtt(self, device, command, obis, rtt):
+		key = (device or '', command, obis)
+		with self.lock:
+			histogram = self.rtt.get(key)
+			if histogram is None:
+				histogram = self.rtt[key] = Histogram(self.bounds)
+			histogram.observe(rtt)
+
+	def observe_duration(self, name, device, duration):
+		"""Учитывает длительность name (DURATIONS) для счётчика device"""
+		key = device or ''
+		with self.lock:
+			durations = self.durations[name]
+			histogram = durations.get(key)
+			if histogram is None:
+				histogram = durations[key] = Histogram(self.bounds)
+			histogram.observe(duration)
+
+	def get(self):
+		"""Возвращает копию метрик: {'time': с начала сбора, с, 'rtt': {ключ: Histogram},
+		'counters': {имя: {ключ: значение}}, 'durations': {имя: {счётчик: Histogram}}}"""
+		def copy(histogram):
+			ret = Histogram(histogram.bounds)
+			ret.counts = list(histogram.counts)
+			ret.count, ret.sum, ret.min, ret.max = histogram.count, histogram.sum, histogram.min, histogram.max
+			return ret
+		with self.lock:
+			return {
+				'time': time.time()-self.start_time,
+				'rtt': dict([[key, copy(h)] for key, h in self.rtt.iteritems()]),
+				'counters': dict([[name, dict(counter)] for name, counter in self.counters.iteritems()]),
+				'durations': dict([[name, dict([[key, copy(h)] for key, h in durations.iteritems()])]
+					for name, durations in self.durations.iteritems()]),
+			}
+
+	@staticmethod
+	def format_labels(key, **kwargs):
+		labels = ['device="{}"'.format(key[0]), 'command="{}"'.format(key[1]), 'obis="{}"'.format(key[2])] \
+			if isinstance(key, tuple) else ['device="{}"'.format(key)]
+		labels += ['{}="{}"'.format(name, value) for name, value in sorted(kwargs.iteritems())]
+		return '{'+','.join(labels)+'}'
+
+	@staticmethod
+	def format_histogram(name, labels_key, histogram):
+		lines = []
+		total = 0
+		for bound, count in zip(histogram.bounds, histogram.counts):
+			total += count
+			lines.append('{}_bucket{} {}'.format(name, Metrics.format_labels(labels_key, le=repr(bound)), total))
+		lines.append('{}_bucket{} {}'.format(name, Metrics.format_labels(labels_key, le='+Inf'), histogram.count))
+		lines.append('{}_sum{} {:.6f}'.format(name, Metrics.format_labels(labels_key), histogram.sum))
+		lines.append('{}_count{} {}'.format(name, Metrics.format_labels(labels_key), histogram.count))
+		return lines
+
+	def dump(self):
+		"""Возвращает метрики в текстовом виде (формат экспозиции Prometheus)"""
+		metrics = self.get()
+		lines = ['# metrics for {:.1f} s'.format(metrics['time'])]
+		lines.append('# TYPE neva_rtt_seconds histogram')
+		for key in sorted(metrics['rtt']):
+			lines += self.format_histogram('neva_rtt_seconds', key, metrics['rtt'][key])
+		for name in self.COUNTERS:
+			counter = metrics['counters'][name]
+			lines.append('# TYPE neva_{}_total counter'.format(name))
+			for key in sorted(counter):
+				lines.append('neva_{}_total{} {}'.format(name, self.format_labels(key), counter[key]))
+		for name in self.DURATIONS:
+			lines.append('# TYPE neva_{}_seconds histogram'.format(name))
+			durations = metrics['durations'][name]
+			for key in sorted(durations):
+				lines += self.format_histogram('neva_{}_seconds'.format(name), key, durations[key])
+		return '\n'.join(lines)+'\n'
+
+	def start_dump(self, interval, file=sys.stdout):
+		"""Запускает периодическую (interval, с) запись dump в file в отдельном потоке"""
+		def run():
+			while True:
+				time.sleep(interval)
+				file.write(self.dump())
+				file.flush()
+		thread = threading.Thread(target=run)
+		thread.daemon = True
+		thread.start()
+		return thread
@@ -1,29 +1,452 @@
 #!/usr/bin/env python2
 # coding: utf-8
 
+import os
+import json
+import time
+import socket
+import threading
+import collections
 import Mek61107
+import Obis
 
 
 class NevaMt3xx(Mek61107.Mek61107):
 	"""Протокол работы со счётчиками НЕВА МТ3XХ"""
 
-	def __init__(self, initial_baudrate=9600):
+	class BccXor(Mek61107.Mek61107.BccBase):
+		"""BCC счётчиков НЕВА МТ3XХ: XOR всех байт (не соответствует ISO 1155) - вычисление BccBase"""
+		pass
+
+	class WrongObis(Mek61107.Mek61107.Mek61107Exception):
+		pass
+
+	bcc = BccXor()
+
+	def __init__(self, initial_baudrate=9600, read_window=1, metrics=None, retry_policy=None):
+		"""metrics -- Metrics.Metrics: сбор метрик обмена; None - не собирать
+		retry_policy -- RetryPolicy: таймаут ответа по измеренному RTT и повтор R1; None - таймаут соединения, без повторов"""
 		Mek61107.Mek61107.__init__(self, initial_baudrate=initial_baudrate)
+		self.read_window = read_window # число запросов R1, посылаемых без ожидания ответа; 1 - ожидать каждый ответ (полудуплексная линия)
+		self.metrics = metrics
+		self.retry_policy = retry_policy
+		self.device = None # company+id счётчика после connect
+		self.request_key = ('', '') # команда и OBIS код последнего запроса для metrics
+
+	@staticmethod
+	def get_device(company, device, device_number=''):
+		"""Возвращает идентификатор счётчика: company+id, с адресом device_number - 'адрес/company+id'"""
+		return company+device if len(device_number) == 0 else device_number+'/'+company+device
+
+	def on_send(self, cmd, size):
+		"""Учёт в metrics посланного кадра cmd размером size байт"""
+		if self.metrics is None:
+			return
+		self.request_key = (cmd.command, cmd.data.partition('(')[0]) if cmd.is_command else ('', '')
+		command, obis = self.request_key
+		self.metrics.add('requests', self.device, command, obis)
+		self.metrics.add('bytes_out', self.device, command, obis, value=size)
+
+	def on_receive(self, cmd):
+		"""Учёт в metrics принятого кадра cmd; CommandBase() - таймаут"""
+		if self.metrics is None:
+			return
+		command, obis = self.request_key
+		if cmd.is_command:
+			command, obis = cmd.command, ''
+			size = len(cmd.data)+6 # SOH, команда, STX, ETX, BCC
+		elif cmd.is_message:
+			if command == 'R1':
+				# при посылке нескольких R1 ответ относится к своему OBIS коду
+				obis = cmd.data.partition('(')[0]
+			size = len(cmd.data)+3 # STX, ETX, BCC
+		elif cmd.is_ack or cmd.is_nak:
+			size = 1
+			if cmd.is_nak:
+				self.metrics.add('naks', self.device, command, obis)
+		else:
+			self.metrics.add('timeouts', self.device, command, obis)
+			return
+		self.metrics.add('bytes_in', self.device, command, obis, value=size)
+
+	def on_receive_error(self, e):
+		"""Учёт в metrics ошибки разбора принятых данных e"""
+		if self.metrics is not None and isinstance(e, Mek61107.Mek61107.WrongBcc):
+			command, obis = self.request_key
+			self.metrics.add('bcc_errors', self.device, command, obis)
+
+	def observe_rtt(self, command, obis, send_time, is_retry=False):
+		"""Учёт времени ответа на запрос, посланный в send_time;
+		is_retry -- запрос повторный: ответ мог быть на предыдущий, RTT для retry_policy не учитывается"""
+		rtt = time.time()-send_time
+		if self.metrics is not None:
+			self.metrics.observe_rtt(self.device, command, obis, rtt)
+		if self.retry_policy is not None and not is_retry:
+			self.retry_policy.observe(self.device, rtt)
+
+	def get_timeout(self, attempt=0):
+		"""Возвращает таймаут ожидания ответа после attempt повторов, с; None - таймаут соединения"""
+		if self.retry_policy is None:
+			return None
+		return self.retry_policy.get_timeout(self.device, attempt)
+
+	def can_retry(self, attempt):
+		return self.retry_policy is not None and attempt < self.retry_policy.retries
+
+	def get_max_request_time(self):
+		"""Возвращает наибольшую длительность запроса R1 с повторами, с: таймаут каждой попытки
+		и паузы перед повторами; None - не ограничена (таймаут соединения не задан)"""
+		if self.retry_policy is None:
+			return getattr(self, 'timeout', None)
+		policy = self.retry_policy
+		return policy.max_timeout*(policy.retries+1)+sum([policy.get_backoff(attempt) for attempt in xrange(1, policy.retries+1)])
+
+	def set_timeout(self, timeout):
+		"""Задаёт таймаут приёма, с; None - таймаут соединения. Наследник переопределяет"""
+		pass
+
+	def read(self):
+		"""Наследник переопределяет: возвращает очередную порцию принятых данных; пустая строка - таймаут"""
+		return ''
+
+	def discard(self, duration):
+		"""Отбрасывает данные, принятые в течение duration, с: запоздавшие ответы перед повтором запросов"""
+		deadline = time.time()+duration
+		while True:
+			timeout = deadline-time.time()
+			if timeout <= 0:
+				break
+			self.set_timeout(timeout)
+			buff = self.read()
+			if len(buff) > 0 and self.log is not None and self.log_bytes:
+				self.log.log_rcv_bytes(buff)
+		self.set_timeout(None)
+		self.decoder.clear()
+
+	def retry(self, attempt, obis):
+		"""Пауза перед повтором attempt (1..) запросов после ошибки ответа на запрос obis"""
+		if self.metrics is not None:
+			self.metrics.add('retries', self.device, 'R1', obis)
+		self.discard(self.retry_policy.get_backoff(attempt))
+
+	def observe_duration(self, name, start_time):
+		if self.metrics is not None:
+			self.metrics.observe_duration(name, self.device, time.time()-start_time)
+
+	def read_obis(self, obis):
+		"""Возвращает значение OBIS кода obis; см. read_many"""
+		return self.read_many([obis], window=1)[0]
+
+	def read_many(self, obis_list, window=None):
+		"""Возвращает список значений OBIS кодов obis_list, считанных за один проход.
+		window -- число запросов R1, посылаемых без ожидания ответа; по умолчанию read_window.
+		Ответы сопоставляются запросам по OBIS коду, поэтому счётчик может отвечать в любом порядке.
+		С retry_policy при ошибке BCC, NAK или отсутствии ответа запросы без ответа посылаются повторно.
+		Может вызвать исключения: WrongObis, WrongBcc, SohOrStxExpected, Timeout"""
+
+		batch = ReadBatch(self, obis_list, window)
+		while not batch.is_done():
+			batch.send_requests()
+			cmd = None
+			try:
+				cmd = self.receive(timeout=batch.get_timeout())
+			except Mek61107.Mek61107.WrongBcc:
+				if not batch.can_retry():
+					raise
+			if batch.on_answer(cmd):
+				continue
+			self.retry(batch.attempt, batch.get_failed_obis())
+			batch.resend()
+		return batch.values
+
+	@staticmethod
+	def set_obis_value(obis_list, values, pending, cmd):
+		"""Сопоставляет ответ cmd одному из ожидающих ответа запросов pending (индексы obis_list),
+		записывает значение в values и удаляет запрос из pending; возвращает индекс запроса; см. read_many.
+		Может вызвать исключения: WrongObis"""
+
+		if not cmd.is_message:
+			raise NevaMt3xx.WrongObis('OBIS {} expected'.format(obis_list[pending[0]]))
+		for i in xrange(len(pending)):
+			obis = obis_list[pending[i]]
+			if cmd.data.startswith(obis+'('):
+				index = pending[i]
+				values[index] = cmd.data[len(obis):].strip('()')
+				del pending[i]
+				return index
+		raise NevaMt3xx.WrongObis('Wrong OBIS, expected {}: {}'.format(obis_list[pending[0]], cmd.data))
+
+	def write_obis(self, obis, data):
+		"""Записывает значение data OBIS кода obis.
+		Может вызвать исключения: WrongObis, Timeout"""
+
+		obis = Obis.normalize(obis)
+		send_time = time.time()
+		self.send(NevaMt3xx.Command('W1', obis+'('+data+')'))
+		cmd = self.receive(timeout=self.get_timeout())
+		self.observe_rtt('W1', obis, send_time)
+		return self.check_write_answer(obis, cmd)
+
+	@staticmethod
+	def check_write_answer(obis, cmd):
+		"""Возвращает ответ cmd на запись W1 кода obis, если это ACK; см. write_obis.
+		Может вызвать исключения: WrongObis, Timeout"""
+
+		if cmd.is_timeout:
+			raise Mek61107.Mek61107.Timeout('Write OBIS {} answer expected'.format(obis))
+		if cmd.is_message:
+			raise NevaMt3xx.WrongObis('Write OBIS {} error: {}'.format(obis, cmd.data))
+		if not cmd.is_ack:
+			raise NevaMt3xx.WrongObis('Write OBIS {} error'.format(obis))
+		return cmd
+
+	def login(self, password):
+		"""Вход после connect: приём P0, посылка пароля P1; возвращает True - доступ разрешён"""
+		start_time = time.time()
+		cmd = self.receive()
+		if not cmd.is_command or cmd.command != 'P0':
+			raise Mek61107.Mek61107.Mek61107Exception('Command "P0" expected')
+		send_time = time.time()
+		self.send(NevaMt3xx.Command('P1', '('+password+')'))
+		cmd = self.receive()
+		self.observe_rtt('P1', '', send_time)
+		self.observe_duration('login', start_time)
+		return cmd.is_ack
+
+	def logout(self):
+		"""Завершение сеанса: счётчик переходит в исходное состояние"""
+		self.send(NevaMt3xx.Command('B0', ''))
 
 	def is_bcc_correct(self, buff, end_index, start_index=1):
-		return NevaMt3xx.calculate_bcc_xor(buff[1:end_index+1]) == ord(buff[end_index+1])
+		return self.bcc.calculate(buff[1:end_index+1]) == ord(buff[end_index+1])
 
 	@staticmethod
 	def calculate_bcc_xor(buff):
-		ret = 0
-		for b in buff:
-			ret ^= ord(b)
-		return ret
+		return NevaMt3xx.bcc.calculate(buff)
+
+
+class BaudratePolicy:
+	"""Выбор скорости обмена для NevaMt3xx_com.
+
+	Выбирается наибольшая скорость, поддерживаемая и счётчиком, и адаптером (baudrates).
+	При ошибках обмена (BCC) скорость понижается: fallback.
+	Рабочая скорость запоминается по идентификатору счётчика в файле cache_file (JSON),
+	поэтому следующие сеансы сразу работают на подобранной скорости.
+
+	Example:
+	policy = NevaMt3xx.BaudratePolicy(baudrates=port.BAUDRATES, cache_file='baudrates.json')
+	protocol = NevaMt3xx.NevaMt3xx_com(port, baudrate_policy=policy)
+	"""
+
+	def __init__(self, baudrates=Mek61107.Mek61107.BAUDRATES, cache_file=None):
+		self.baudrates = sorted(set(baudrates) & set(Mek61107.Mek61107.BAUDRATES))
+		self.cache_file = cache_file
+		self.cache = {}
+		# Один экземпляр используют потоки разных портов (Fleet)
+		self.lock = threading.RLock()
+		if cache_file is not None and os.path.exists(cache_file):
+			with open(cache_file) as f:
+				self.cache = json.load(f)
+
+	def save(self):
+		if self.cache_file is None:
+			return
+		with self.lock:
+			with open(self.cache_file+'.tmp', 'w') as f:
+				json.dump(self.cache, f, indent=1, sort_keys=True)
+			os.rename(self.cache_file+'.tmp', self.cache_file)
+
+	def select(self, device, baudrate):
+		"""Возвращает скорость обмена со счётчиком device, поддерживающим скорость до baudrate"""
+		baudrates = [b for b in self.baudrates if b <= baudrate]
+		if len(baudrates) == 0:
+			raise Mek61107.Mek61107.WrongBaudrate(str(baudrate))
+		with self.lock:
+			cached = self.cache.get(device)
+		if cached in baudrates:
+			return cached
+		return baudrates[-1]
+
+	def fallback(self, device, baudrate):
+		"""Понижает скорость обмена со счётчиком device после ошибки на скорости baudrate.
+		Возвращает новую скорость или None - понижать некуда"""
+		baudrates = [b for b in self.baudrates if b < baudrate]
+		with self.lock:
+			if len(baudrates) == 0:
+				if self.cache.pop(device, None) is not None:
+					self.save()
+				return None
+			self.cache[device] = baudrates[-1]
+			self.save()
+		return baudrates[-1]
+
+	def confirm(self, device, baudrate):
+		"""Запоминает скорость baudrate как рабочую для счётчика device"""
+		with self.lock:
+			if self.cache.get(device) != baudrate:
+				self.cache[device] = baudrate
+				self.save()
+
+
+class RttEstimator:
+	"""Оценка времени ответа (RTT) по RFC 6298: сглаженное значение srtt и отклонение rttvar"""
+
+	ALPHA = 1/8.
+	BETA = 1/4.
+	K = 4
+
+	def __init__(self):
+		self.srtt = None
+		self.rttvar = None
+
+	def observe(self, rtt):
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt/2.
+		else:
+			self.rttvar = (1-self.BETA)*self.rttvar+self.BETA*abs(self.srtt-rtt)
+			self.srtt = (1-self.ALPHA)*self.srtt+self.ALPHA*rtt
+
+	def get_timeout(self):
+		"""Возвращает таймаут ответа: srtt+K*rttvar; None - нет измерений"""
+		if self.srtt is None:
+			return None
+		return self.srtt+self.K*self.rttvar
+
+
+class RetryPolicy:
+	"""Таймаут ожидания ответа и повтор запросов для протоколов NevaMt3xx.
+
+	Таймаут считается по RTT, измеренному для каждого счётчика линии (RttEstimator),
+	в пределах min_timeout..max_timeout; до первого измерения - max_timeout.
+	Поэтому хорошая линия не ждёт max_timeout, а плохая не задерживает цикл опроса дольше него.
+	При ошибке BCC, NAK или отсутствии ответа запросы R1 повторяются до retries раз подряд:
+	перед повтором attempt - пауза backoff_base*2^(attempt-1), но не более backoff_max,
+	данные, принятые во время паузы, отбрасываются; таймаут повтора удваивается.
+
+	Example:
+	protocol = NevaMt3xx.NevaMt3xx_com(port, retry_policy=NevaMt3xx.RetryPolicy(max_timeout=port.timeout))
+	"""
+
+	MIN_TIMEOUT = .1 # с
+	MAX_TIMEOUT = 2. # с
+	RETRIES = 2
+	BACKOFF_BASE = .1 # с
+	BACKOFF_MAX = 1. # с
+
+	def __init__(self, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT, retries=RETRIES,
+		backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+		self.min_timeout = min_timeout
+		self.max_timeout = max_timeout
+		self.retries = retries
+		self.backoff_base = backoff_base
+		self.backoff_max = backoff_max
+		self.estimators = {} # счётчик -> RttEstimator
+
+	def get_estimator(self, device):
+		estimator = self.estimators.get(device)
+		if estimator is None:
+			estimator = self.estimators[device] = RttEstimator()
+		return estimator
+
+	def observe(self, device, rtt):
+		self.get_estimator(device).observe(rtt)
+
+	def get_timeout(self, device, attempt=0):
+		"""Возвращает таймаут ожидания ответа счётчика device после attempt повторов, с"""
+		timeout = self.get_estimator(device).get_timeout()
+		if timeout is None:
+			return self.max_timeout
+		return min(self.max_timeout, max(self.min_timeout, timeout)*2**attempt)
+
+	def get_backoff(self, attempt):
+		"""Возвращает паузу перед повтором attempt (1..), с"""
+		return min(self.backoff_max, self.backoff_base*2**(attempt-1))
+
+
+class ReadBatch:
+	"""Учёт запросов R1 одного read_many: окно запросов без ответа, сопоставление ответов запросам,
+	RTT и повторы по retry_policy протокола. Общий для NevaMt3xx.read_many и NevaMt3xx_async.read_many,
+	которые только посылают запросы и ожидают ответы:
+
+	batch = ReadBatch(protocol, obis_list, window)
+	while not batch.is_done():
+		batch.send_requests()
+		cmd = protocol.receive(timeout=batch.get_timeout()) # WrongBcc без batch.can_retry() - передаётся вызывающему
+		if not batch.on_answer(cmd): # None - ошибка BCC
+			protocol.retry(batch.attempt, batch.get_failed_obis())
+			batch.resend()
+	return batch.values
+	"""
+
+	def __init__(self, protocol, obis_list, window=None):
+		self.protocol = protocol
+		self.window = max(1, protocol.read_window if window is None else window)
+		self.obis_list = [Obis.normalize(obis) for obis in obis_list]
+		self.values = [None]*len(self.obis_list)
+		self.send_times = [None]*len(self.obis_list)
+		self.send_counts = [0]*len(self.obis_list)
+		self.queue = collections.deque(xrange(len(self.obis_list))) # индексы запросов к посылке
+		self.pending = [] # индексы посланных запросов в порядке посылки
+		self.attempt = 0 # повторов после последнего ответа
+
+	def is_done(self):
+		return len(self.queue) == 0 and len(self.pending) == 0
+
+	def send_requests(self):
+		"""Посылает запросы из очереди, пока окно не заполнено"""
+		while len(self.queue) > 0 and len(self.pending) < self.window:
+			index = self.queue.popleft()
+			self.send_times[index] = time.time()
+			self.send_counts[index] += 1
+			self.protocol.send(NevaMt3xx.Command('R1', self.obis_list[index]+'()'))
+			self.pending.append(index)
+
+	def get_timeout(self):
+		return self.protocol.get_timeout(self.attempt)
+
+	def can_retry(self):
+		return self.protocol.can_retry(self.attempt)
+
+	def on_answer(self, cmd):
+		"""Обрабатывает ответ cmd (None - ошибка BCC); возвращает True - значение принято,
+		False - нужен повтор: пауза protocol.retry(attempt, get_failed_obis()), затем resend.
+		Может вызвать исключения: WrongObis, Timeout"""
+
+		if cmd is not None and not cmd.is_nak and not cmd.is_timeout:
+			index = NevaMt3xx.set_obis_value(self.obis_list, self.values, self.pending, cmd)
+			self.protocol.observe_rtt('R1', self.obis_list[index], self.send_times[index],
+				is_retry=self.send_counts[index] > 1)
+			self.attempt = 0
+			return True
+		if cmd is not None and not self.can_retry():
+			if cmd.is_timeout:
+				raise Mek61107.Mek61107.Timeout('OBIS {} expected'.format(self.get_failed_obis()))
+			NevaMt3xx.set_obis_value(self.obis_list, self.values, self.pending, cmd)
+		self.attempt += 1
+		return False
+
+	def get_failed_obis(self):
+		"""Код первого запроса без ответа"""
+		return self.obis_list[self.pending[0]]
+
+	def resend(self):
+		"""Возвращает запросы без ответа в начало очереди после паузы повтора"""
+		self.queue.extendleft(reversed(self.pending))
+		self.pending = []
 
 
 class LogBase:
 	"""Abstract (interface) class. Used by NevaMt3xx_com & NevaMt3xx_tcp
 
+	Protocol calls:
+	- log_rcv, log_snd: text messages;
+	- log_rcv_frame, log_snd_frame: frames (Mek61107.CommandBase); the frame is
+	  formatted by str() only inside the logger, so a logger may skip the formatting;
+	- log_rcv_bytes, log_snd_bytes: raw data, only if log_bytes is set (and raw
+	  request and ack lines of connect).
+	With log=None nothing is called or formatted.
+
 	Example:
 	from datetime import datetime
 	from protocol import NevaMt3xx
@@ -41,6 +464,14 @@ class LogBase:
 		pass
 	def log_snd(self, data):
 		pass
+	def log_rcv_frame(self, cmd):
+		self.log_rcv(str(cmd))
+	def log_snd_frame(self, cmd):
+		self.log_snd(str(cmd))
+	def log_rcv_bytes(self, data):
+		self.log_rcv(data)
+	def log_snd_bytes(self, data):
+		self.log_snd(data)
 
 
 class NevaMt3xx_com(NevaMt3xx):
@@ -78,70 +509,149 @@ class NevaMt3xx_com(NevaMt3xx):
 		print u'ERROR: '+str(e)
 	"""
 
-	def __init__(self, port, log=None, log_bytes=False):
-		NevaMt3xx.__init__(self)
+	POLL_INTERVAL = .002 # период проверки буфера порта в пределах межсимвольного таймаута, с
+
+	def __init__(self, port, log=None, log_bytes=False, baudrate_policy=None, metrics=None, retry_policy=None):
+		"""baudrate_policy -- BaudratePolicy; None - скорость, сообщённая счётчиком
+		metrics -- Metrics.Metrics; None - не собирать метрики
+		retry_policy -- RetryPolicy; None - таймаут порта, без повторов"""
+		NevaMt3xx.__init__(self, metrics=metrics, retry_policy=retry_policy)
 		self.port = port
+		self.timeout = port.timeout # таймаут порта по умолчанию
+		self.decoder = self.Decoder(self)
 		self.log = log
 		self.log_bytes = log_bytes
+		self.baudrate_policy = baudrate_policy
+
+	def fallback_baudrate(self):
+		"""Понижает скорость обмена после ошибки обмена (BCC) для следующего connect.
+		Возвращает False - скорость не выбирается или понижать некуда"""
+		if self.baudrate_policy is None or self.device is None:
+			return False
+		return self.baudrate_policy.fallback(self.device, self.port.baudrate) is not None
+
+	def confirm_baudrate(self):
+		"""Запоминает текущую скорость обмена как рабочую после успешного обмена"""
+		if self.baudrate_policy is not None and self.device is not None:
+			self.baudrate_policy.confirm(self.device, self.port.baudrate)
+
+	def set_timeout(self, timeout):
+		if timeout is None:
+			timeout = self.timeout
+		if self.port.timeout != timeout:
+			self.port.timeout = timeout
+
+	def read(self):
+		"""Возвращает очередную порцию принятых данных; пустая строка - таймаут.
+		Ожидает первый байт не дольше таймаута порта, затем забирает накопленные в буфере порта данные
+		(in_waiting), а если у порта задан межсимвольный таймаут (inter_byte_timeout) - продолжает,
+		пока в буфер не перестанут поступать данные в течение межсимвольного таймаута.
+		Читается только накопленное: read(n) больше in_waiting ждал бы полный таймаут порта
+		(pyserial POSIX ждёт в select() оставшийся таймаут порта, а не межсимвольный)"""
+		buff = self.port.read(1)
+		if len(buff) == 0:
+			return buff
+		interval = getattr(self.port, 'inter_byte_timeout', None)
+		last_time = time.time()
+		while True:
+			size = self.port.in_waiting
+			if size > 0:
+				buff += self.port.read(size)
+				last_time = time.time()
+				continue
+			if interval is None:
+				return buff
+			delay = last_time+interval-time.time()
+			if delay <= 0:
+				return buff
+			time.sleep(min(delay, self.POLL_INTERVAL))
 
 	def receive_line(self):
 		buff = ''
 		while True:
-			buff2 = self.port.read(1)
+			buff2 = self.read()
 			if len(buff2) == 0:
 				return ''
 			if self.log is not None and self.log_bytes:
-				self.log.log_rcv(buff2)
+				self.log.log_rcv_bytes(buff2)
 			buff += buff2
 			buff2 = self.get_line(buff)
 			if len(buff2) > 0:
 				if self.log is not None:
 					self.log.log_rcv(buff)
+				if len(buff) > len(buff2)+2:
+					# данные после строки - начало следующего кадра
+					self.decoder.feed(buff[len(buff2)+2:])
 				return buff2
 
-	def connect(self, y='1', v='0'):
+	def connect(self, y='1', v='0', device_number=''):
+		start_time = time.time()
 		buff = ''
+		self.decoder.clear()
+		self.set_timeout(None)
 		# посылка запроса
 		if self.port.baudrate != self.initial_baudrate:
 			self.port.baudrate = self.initial_baudrate
-		buff = NevaMt3xx.make_request()
+		buff = NevaMt3xx.make_request(device_number)
 		if self.log is not None:
-			self.log.log_snd(buff)
+			self.log.log_snd_bytes(buff)
 		self.port.write(buff)
 		# приём индификационного сообщения
 		buff = self.receive_line()
 		company, baudrate, device = self.get_id_message(buff)
 		if self.log is not None:
 			self.log.log_rcv('Code: {}; baudrate: {}; id: {}'.format(company, baudrate, device))
+		self.device = self.get_device(company, device, device_number)
+		if self.baudrate_policy is not None:
+			baudrate = self.baudrate_policy.select(self.device, baudrate)
 		# посылка сообщения подтверждения/выбора опций
 		buff = NevaMt3xx.make_ack_message(baudrate, v=v, y=y)
 		if self.log is not None:
-			self.log.log_snd(buff)
+			self.log.log_snd_bytes(buff)
 		self.port.write(buff)
 		# обмен сообщениями
+		self.port.flush() # сообщение выбора опций передаётся на начальной скорости
 		if self.port.baudrate != baudrate:
 			self.port.baudrate = baudrate
+		self.observe_duration('handshake', start_time)
 		return company, device
 
-	def receive(self):
-		buff = ''
-		while True:
-			buff2 = self.port.read(1)
-			if len(buff2) == 0:
-				return Mek61107.Mek61107.CommandBase()
-			if self.log is not None and self.log_bytes:
-				self.log.log_rcv(buff2)
-			buff += buff2
-			cmd = self.parse(buff)
-			if cmd is not None:
-				if self.log is not None:
-					self.log.log_rcv(str(cmd))
+	def receive(self, timeout=None):
+		"""Возвращает принятый кадр; NoAnswer - нет ответа в течение timeout, с; None - таймаут порта"""
+		cmd = self.decoder.get()
+		if cmd is None:
+			self.set_timeout(timeout)
+		while cmd is None:
+			buff = self.read()
+			if len(buff) == 0:
+				cmd = Mek61107.Mek61107.NoAnswer()
+				self.on_receive(cmd)
 				return cmd
+			if self.log is not None and self.log_bytes:
+				self.log.log_rcv_bytes(buff)
+			try:
+				self.decoder.feed(buff)
+			except Mek61107.Mek61107.SohOrStxExpected as e:
+				# шум перед кадром: кадр, принятый в той же порции, не теряется
+				self.on_receive_error(e)
+				if len(self.decoder.frames) == 0:
+					raise
+			except Mek61107.Mek61107.Mek61107Exception as e:
+				self.on_receive_error(e)
+				raise
+			cmd = self.decoder.get()
+		self.on_receive(cmd)
+		if self.log is not None:
+			self.log.log_rcv_frame(cmd)
+		return cmd
 
 	def send(self, cmd):
-		buff = cmd.serialize(calculate_bcc_func=NevaMt3xx.calculate_bcc_xor)
+		buff = cmd.serialize(calculate_bcc_func=self.bcc.calculate)
+		self.on_send(cmd, len(buff))
 		if self.log is not None:
-			self.log.log_snd(str(cmd))
+			if self.log_bytes:
+				self.log.log_snd_bytes(buff)
+			self.log.log_snd_frame(cmd)
 		self.port.write(buff)
 
 
@@ -179,11 +689,33 @@ class NevaMt3xx_tcp(NevaMt3xx):
 		print u'ERROR: '+str(e)
 	"""
 
-	def __init__(self, connection, log=None, log_bytes=True):
-		NevaMt3xx.__init__(self)
+	READ_SIZE = 512
+
+	def __init__(self, connection, log=None, log_bytes=False, metrics=None, retry_policy=None):
+		"""metrics -- Metrics.Metrics; None - не собирать метрики
+		retry_policy -- RetryPolicy; None - таймаут соединения, без повторов"""
+		NevaMt3xx.__init__(self, metrics=metrics, retry_policy=retry_policy)
 		self.connection = connection
+		self.decoder = self.Decoder(self)
 		self.log = log
 		self.log_bytes = log_bytes
+		# таймаут соединения по умолчанию
+		self.timeout = connection.gettimeout() if hasattr(connection, 'gettimeout') else None
+		self.current_timeout = self.timeout
+
+	def set_timeout(self, timeout):
+		if timeout is None:
+			timeout = self.timeout
+		if self.current_timeout != timeout:
+			self.connection.settimeout(timeout)
+			self.current_timeout = timeout
+
+	def read(self):
+		"""Возвращает очередную порцию принятых данных; пустая строка - таймаут или соединение закрыто"""
+		try:
+			return self.connection.recv(self.READ_SIZE)
+		except socket.timeout:
+			return ''
 
 	def receive_line(self):
 		buff = ''
@@ -192,53 +724,206 @@ class NevaMt3xx_tcp(NevaMt3xx):
 			if len(buff2) == 0:
 				return ''
 			if self.log is not None and self.log_bytes:
-				self.log.log_rcv(buff2)
+				self.log.log_rcv_bytes(buff2)
 			buff += buff2
 			buff2 = self.get_line(buff)
 			if len(buff2) > 0:
 				if self.log is not None:
 					self.log.log_rcv(buff)
+				if len(buff) > len(buff2)+2:
+					# данные после строки - начало следующего кадра
+					self.decoder.feed(buff[len(buff2)+2:])
 				return buff2
 
-	def connect(self, y='1', v='0'):
+	def connect(self, y='1', v='0', device_number=''):
+		start_time = time.time()
 		buff = ''
+		self.decoder.clear()
+		self.set_timeout(None)
 		# посылка запроса
-		buff = NevaMt3xx.make_request()
+		buff = NevaMt3xx.make_request(device_number)
 		if self.log is not None:
-			self.log.log_snd(buff)
+			self.log.log_snd_bytes(buff)
 		self.connection.sendall(buff)
 		# приём индификационного сообщения
 		buff = self.receive_line()
 		company, baudrate, device = self.get_id_message(buff)
 		if self.log is not None:
 			self.log.log_rcv('Code: {}; baudrate: {}; id: {}'.format(company, baudrate, device))
+		self.device = self.get_device(company, device, device_number)
 		# посылка сообщения подтверждения/выбора опций
 		buff = NevaMt3xx.make_ack_message(baudrate, v=v, y=y)
 		if self.log is not None:
-			self.log.log_snd(buff)
+			self.log.log_snd_bytes(buff)
 		self.connection.sendall(buff)
 		# обмен сообщениями
+		self.observe_duration('handshake', start_time)
 		return company, device
 
-	def receive(self):
-		buff = ''
-		while True:
-			buff2 = self.connection.recv(512)
-			if len(buff2) == 0:
-				return Mek61107.Mek61107.CommandBase()
-			if self.log is not None and self.log_bytes:
-				self.log.log_rcv(buff2)
-			buff += buff2
-			cmd = self.parse(buff)
-			if cmd is not None:
-				if self.log is not None:
-					self.log.log_rcv(str(cmd))
+	def receive(self, timeout=None):
+		"""Возвращает принятый кадр; NoAnswer - нет ответа в течение timeout, с; None - таймаут соединения"""
+		cmd = self.decoder.get()
+		if cmd is None:
+			self.set_timeout(timeout)
+		while cmd is None:
+			buff = self.read()
+			if len(buff) == 0:
+				cmd = Mek61107.Mek61107.NoAnswer()
+				self.on_receive(cmd)
 				return cmd
+			if self.log is not None and self.log_bytes:
+				self.log.log_rcv_bytes(buff)
+			try:
+				self.decoder.feed(buff)
+			except Mek61107.Mek61107.SohOrStxExpected as e:
+				# шум перед кадром: кадр, принятый в той же порции, не теряется
+				self.on_receive_error(e)
+				if len(self.decoder.frames) == 0:
+					raise
+			except Mek61107.Mek61107.Mek61107Exception as e:
+				self.on_receive_error(e)
+				raise
+			cmd = self.decoder.get()
+		self.on_receive(cmd)
+		if self.log is not None:
+			self.log.log_rcv_frame(cmd)
+		return cmd
 
 	def send(self, cmd):
-		buff = cmd.serialize(calculate_bcc_func=NevaMt3xx.calculate_bcc_xor)
+		buff = cmd.serialize(calculate_bcc_func=self.bcc.calculate)
+		self.on_send(cmd, len(buff))
 		if self.log is not None:
 			if self.log_bytes:
-				self.log.log_snd(buff)
-			self.log.log_snd(str(cmd))
+				self.log.log_snd_bytes(buff)
+			self.log.log_snd_frame(cmd)
 		self.connection.sendall(buff)
+
+
+class Session:
+	"""Сеанс работы со счётчиком через NevaMt3xx_com или NevaMt3xx_tcp.
+
+	Сеанс остаётся в режиме обмена между запросами: connect и login выполняются один раз.
+	До истечения таймаута неактивности счётчика посылается запрос keep_alive_obis,
+	а если счётчик всё же вернулся в исходное состояние (нет ответа - Timeout),
+	то connect и login выполняются повторно и запрос повторяется. Прочие ошибки (WrongObis
+	неподдерживаемого кода, WrongBcc) передаются вызывающему без повторного входа:
+	счётчик, ответивший на запрос, остаётся в режиме обмена.
+
+	Example:
+	session = NevaMt3xx.Session(NevaMt3xx.NevaMt3xx_com(port), '00000000')
+	session.start_keep_alive() # поддержка сеанса в отдельном потоке
+	try:
+		while True:
+			print session.read_many(['00.09.02*FF', '00.09.01*FF', '10.07.00*FF'])
+			time.sleep(60)
+	finally:
+		session.close()
+	"""
+
+	INACTIVITY_TIMEOUT = 60 # таймаут неактивности счётчика, с
+	RESTART_DELAY = .5 # пауза после B0 перед повторным connect, с
+
+	def __init__(self, protocol, password, inactivity_timeout=INACTIVITY_TIMEOUT,
+		keep_alive_interval=None, keep_alive_obis='00.09.02*FF', address=''):
+		"""keep_alive_interval -- период поддержки сеанса при отсутствии запросов, с;
+		по умолчанию: половина inactivity_timeout
+		address -- адрес счётчика; см. Mek61107.make_request"""
+		self.protocol = protocol
+		self.password = password
+		self.address = address
+		self.inactivity_timeout = inactivity_timeout
+		self.keep_alive_interval = keep_alive_interval if keep_alive_interval is not None else inactivity_timeout/2.
+		self.keep_alive_obis = keep_alive_obis
+		self.is_logged_in = False
+		self.last_exchange_time = 0
+		self.company, self.device = None, None
+		self.lock = threading.RLock()
+		self.keep_alive_thread = None
+		self.is_closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def is_expired(self):
+		"""Возвращает True - счётчик мог вернуться в исходное состояние по таймауту неактивности"""
+		return time.time()-self.last_exchange_time >= self.inactivity_timeout
+
+	def open(self):
+		"""Выполняет connect и login, если сеанс не установлен"""
+		with self.lock:
+			if self.is_logged_in and not self.is_expired():
+				return
+			self.is_logged_in = False
+			self.company, self.device = self.protocol.connect(device_number=self.address)
+			if not self.protocol.login(self.password):
+				raise Mek61107.Mek61107.Mek61107Exception('Access denied')
+			self.is_logged_in = True
+			self.last_exchange_time = time.time()
+
+	def restart(self):
+		"""Завершает текущий сеанс и устанавливает новый"""
+		with self.lock:
+			self.is_logged_in = False
+			self.protocol.logout()
+			time.sleep(self.RESTART_DELAY)
+			self.open()
+
+	def close(self):
+		with self.lock:
+			self.is_closed = True
+			if self.is_logged_in:
+				self.is_logged_in = False
+				self.protocol.logout()
+
+	def call(self, func, *args, **kwargs):
+		"""Выполняет func(*args, **kwargs) в установленном сеансе; если счётчик не ответил (Timeout) -
+		вернулся в исходное состояние, устанавливает сеанс повторно и повторяет вызов один раз"""
+		with self.lock:
+			self.open()
+			try:
+				ret = func(*args, **kwargs)
+			except Mek61107.Mek61107.Timeout:
+				if self.protocol.metrics is not None:
+					self.protocol.metrics.add('retries', self.protocol.device)
+				self.restart()
+				ret = func(*args, **kwargs)
+			self.last_exchange_time = time.time()
+			return ret
+
+	def read_obis(self, obis):
+		return self.call(self.protocol.read_obis, obis)
+
+	def read_many(self, obis_list, window=None):
+		return self.call(self.protocol.read_many, obis_list, window=window)
+
+	def write_obis(self, obis, data):
+		return self.call(self.protocol.write_obis, obis, data)
+
+	def get_max_request_time(self):
+		return self.protocol.get_max_request_time()
+
+	def keep_alive(self):
+		"""Поддерживает сеанс: вызывается периодически между запросами"""
+		with self.lock:
+			if not self.is_logged_in:
+				return
+			if self.is_expired():
+				self.is_logged_in = False # установить повторно при следующем запросе
+			elif time.time()-self.last_exchange_time >= self.keep_alive_interval:
+				self.read_obis(self.keep_alive_obis)
+
+	def start_keep_alive(self):
+		"""Запускает поддержку сеанса в отдельном потоке до close"""
+		def run():
+			while not self.is_closed:
+				time.sleep(min(1., self.keep_alive_interval))
+				try:
+					self.keep_alive()
+				except Exception:
+					self.is_logged_in = False
+		self.keep_alive_thread = threading.Thread(target=run)
+		self.keep_alive_thread.daemon = True
+		self.keep_alive_thread.start()
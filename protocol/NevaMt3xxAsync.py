@@ -0,0 +1,468 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Работа со счётчиками НЕВА МТ3XХ по tcp соединению в цикле событий (asyncore):
+# один поток опрашивает тысячи модемов одновременно.
+
+import time
+import heapq
+import socket
+import asyncore
+import collections
+import Mek61107
+import NevaMt3xx
+import Obis
+
+
+class Return(Exception):
+	"""Результат операции-генератора: raise Return(value)"""
+	def __init__(self, value=None):
+		Exception.__init__(self)
+		self.value = value
+
+
+class Wait:
+	"""Ожидание события, на котором задача (генератор) приостанавливается через yield.
+	Наследник переопределяет check и expire."""
+
+	def __init__(self, timeout=None):
+		self.timeout = timeout
+		self.deadline = None
+		self.task = None
+
+	def start(self, task):
+		self.task = task
+		if self.timeout is not None:
+			self.deadline = time.time()+self.timeout
+			task.loop.add_deadline(self)
+		self.check()
+
+	def check(self):
+		"""Завершает ожидание, если событие уже произошло"""
+		pass
+
+	def expire(self):
+		"""Вызывается по истечении timeout"""
+		self.complete()
+
+	def complete(self, value=None, exception=None):
+		if self.task is None:
+			return
+		task, self.task = self.task, None
+		task.loop.schedule(task, value, exception)
+
+
+class Sleep(Wait):
+	"""Пауза задачи: yield Sleep(seconds)"""
+	pass
+
+
+class Task:
+	"""Задача цикла событий: генератор, приостанавливающийся на yield операции (Wait)
+	или вложенного генератора, результат которого возвращается в точку yield."""
+
+	def __init__(self, loop, coroutine, callback=None):
+		self.loop = loop
+		self.stack = [coroutine]
+		self.callback = callback # callback(task) по завершении
+		self.result = None
+		self.exception = None
+		self.is_done = False
+
+	def step(self, value=None, exception=None):
+		while len(self.stack) > 0:
+			coroutine = self.stack[-1]
+			try:
+				if exception is not None:
+					exception, e = None, exception
+					ret = coroutine.throw(e)
+				else:
+					ret = coroutine.send(value)
+			except Return as r:
+				self.stack.pop()
+				value = r.value
+				continue
+			except StopIteration:
+				self.stack.pop()
+				value = None
+				continue
+			except Exception as e:
+				self.stack.pop()
+				exception = e
+				continue
+			if isinstance(ret, Wait):
+				ret.start(self)
+				return
+			if hasattr(ret, 'send') and hasattr(ret, 'throw'):
+				# вложенный генератор
+				self.stack.append(ret)
+				value = None
+				continue
+			value = ret
+		self.is_done = True
+		self.result, self.exception = value, exception
+		self.loop.task_done(self)
+
+
+class Loop:
+	"""Цикл событий: сокеты asyncore, задачи и таймауты.
+
+	Example:
+	loop = NevaMt3xxAsync.Loop()
+	task = loop.spawn(poll(NevaMt3xxAsync.NevaMt3xx_async(loop)))
+	loop.run()
+	print task.result, task.exception
+	"""
+
+	POLL_TIMEOUT = 1. # наибольшее время ожидания событий сокетов, с
+
+	def __init__(self, use_poll=hasattr(asyncore.select, 'poll')):
+		self.map = {} # сокеты asyncore этого цикла
+		self.use_poll = use_poll # poll вместо select: без ограничения FD_SETSIZE
+		self.ready = collections.deque()
+		self.deadlines = [] # heap: (deadline, counter, Wait)
+		self.counter = 0
+		self.tasks_count = 0
+
+	def spawn(self, coroutine, callback=None):
+		task = Task(self, coroutine, callback)
+		self.tasks_count += 1
+		self.schedule(task)
+		return task
+
+	def schedule(self, task, value=None, exception=None):
+		self.ready.append((task, value, exception))
+
+	def task_done(self, task):
+		self.tasks_count -= 1
+		if task.callback is not None:
+			task.callback(task)
+
+	def add_deadline(self, wait):
+		self.counter += 1
+		heapq.heappush(self.deadlines, (wait.deadline, self.counter, wait))
+
+	def run_once(self, timeout=POLL_TIMEOUT):
+		while len(self.ready) > 0:
+			task, value, exception = self.ready.popleft()
+			task.step(value, exception)
+		if len(self.deadlines) > 0:
+			timeout = max(0, min(timeout, self.deadlines[0][0]-time.time()))
+		if self.tasks_count > 0:
+			if len(self.map) > 0:
+				asyncore.loop(timeout=timeout, use_poll=self.use_poll, map=self.map, count=1)
+			else:
+				time.sleep(timeout)
+		now = time.time()
+		while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+			wait = heapq.heappop(self.deadlines)[2]
+			if wait.task is not None:
+				wait.expire()
+
+	def run(self):
+		"""Выполняет цикл до завершения всех задач"""
+		while self.tasks_count > 0 or len(self.ready) > 0:
+			self.run_once()
+
+
+class Channel(asyncore.dispatcher):
+	"""Сокет NevaMt3xx_async в цикле asyncore"""
+
+	READ_SIZE = 512
+
+	def __init__(self, protocol, connection=None):
+		asyncore.dispatcher.__init__(self, connection, protocol.loop.map)
+		self.protocol = protocol
+		self.out_buff = ''
+
+	def writable(self):
+		return len(self.out_buff) > 0 or not self.connected
+
+	def handle_connect(self):
+		# asyncore отмечает подключение после handle_connect: WaitConnect проверяет connected
+		self.connected = True
+		self.protocol.on_event()
+
+	def handle_read(self):
+		buff = self.recv(self.READ_SIZE)
+		if len(buff) > 0:
+			self.protocol.on_data(buff)
+
+	def handle_write(self):
+		if len(self.out_buff) > 0:
+			size = self.send(self.out_buff)
+			self.out_buff = self.out_buff[size:]
+			if len(self.out_buff) == 0:
+				self.protocol.on_event()
+
+	def handle_close(self):
+		self.close()
+		self.protocol.on_close()
+
+	def handle_error(self):
+		self.close()
+		self.protocol.on_close(error=Mek61107.Mek61107.Mek61107Exception('Connection error'))
+
+
+class WaitConnect(Wait):
+	def __init__(self, protocol, timeout=None):
+		"""timeout -- None - таймаут протокола"""
+		Wait.__init__(self, protocol.timeout if timeout is None else timeout)
+		self.protocol = protocol
+	def start(self, task):
+		self.protocol.wait = self
+		Wait.start(self, task)
+	def check(self):
+		if self.protocol.error is not None:
+			self.complete(exception=self.protocol.error)
+		elif self.protocol.is_closed:
+			self.complete(exception=Mek61107.Mek61107.Mek61107Exception('Connection closed'))
+		elif self.protocol.channel.connected:
+			self.complete(True)
+	def expire(self):
+		self.complete(exception=Mek61107.Mek61107.Mek61107Exception('Connection timeout'))
+
+
+class WaitSent(WaitConnect):
+	def check(self):
+		if self.protocol.error is not None or self.protocol.is_closed:
+			self.complete(False)
+		elif len(self.protocol.channel.out_buff) == 0:
+			self.complete(True)
+	def expire(self):
+		self.complete(False)
+
+
+class WaitFrame(WaitConnect):
+	def check(self):
+		if self.protocol.error is not None:
+			error, self.protocol.error = self.protocol.error, None
+			self.complete(exception=error)
+			return
+		cmd = self.protocol.decoder.get()
+		if cmd is not None:
+			self.protocol.on_receive(cmd)
+			if self.protocol.log is not None:
+				self.protocol.log.log_rcv_frame(cmd)
+			self.complete(cmd)
+		elif self.protocol.is_closed:
+			self.expire()
+	def expire(self):
+		cmd = Mek61107.Mek61107.NoAnswer()
+		self.protocol.on_receive(cmd)
+		self.complete(cmd)
+
+
+class WaitLine(WaitConnect):
+	def check(self):
+		line = self.protocol.get_line(self.protocol.line_buff)
+		if len(line) > 0:
+			if self.protocol.log is not None:
+				self.protocol.log.log_rcv(self.protocol.line_buff)
+			buff = self.protocol.line_buff[len(line)+2:]
+			self.protocol.line_buff = None
+			self.complete(line)
+			if len(buff) > 0:
+				# данные после строки - начало следующего кадра
+				self.protocol.on_data(buff)
+		elif self.protocol.is_closed or self.protocol.error is not None:
+			self.complete('')
+	def expire(self):
+		self.complete('')
+
+
+class NevaMt3xx_async(NevaMt3xx.NevaMt3xx):
+	"""Протокол работы со счётчиками НЕВА МТ3XХ по tcp соединению в цикле событий Loop
+
+	Операции connect, login, read_obis, read_many, write_obis, logout - генераторы:
+	задача опроса получает их результат через yield. Память на соединение ограничена
+	размером кадра (Decoder.MAX_FRAME_SIZE) и строки (MAX_LINE_SIZE).
+
+	Example:
+	from protocol import NevaMt3xxAsync
+	def poll(protocol, address):
+		yield protocol.open_connection(address)
+		try:
+			company, device = yield protocol.connect()
+			if not (yield protocol.login('00000000')):
+				raise Exception('Access denied')
+			date = yield protocol.read_obis('00.09.02*FF')
+			yield protocol.logout()
+		finally:
+			protocol.close()
+		raise NevaMt3xxAsync.Return(date)
+	loop = NevaMt3xxAsync.Loop()
+	for address in modems:
+		loop.spawn(poll(NevaMt3xxAsync.NevaMt3xx_async(loop), address))
+	loop.run()
+	"""
+
+	TIMEOUT = 10 # время ожидания ответа, с
+	MAX_LINE_SIZE = 256
+
+	def __init__(self, loop, connection=None, log=None, log_bytes=False, timeout=TIMEOUT, metrics=None, retry_policy=None):
+		"""connection -- подключенный сокет; None - подключение через open_connection
+		metrics -- Metrics.Metrics; None - не собирать метрики
+		retry_policy -- NevaMt3xx.RetryPolicy: таймаут ответа по RTT и повтор R1; None - timeout, без повторов"""
+		NevaMt3xx.NevaMt3xx.__init__(self, metrics=metrics, retry_policy=retry_policy)
+		self.loop = loop
+		self.log = log
+		self.log_bytes = log_bytes
+		self.timeout = timeout
+		self.decoder = self.Decoder(self)
+		self.line_buff = None # принимаемая строка; None - приём кадров
+		self.wait = None # текущее ожидание
+		self.error = None
+		self.is_closed = False
+		self.channel = None
+		if connection is not None:
+			connection.setblocking(0)
+			self.channel = Channel(self, connection)
+
+	def open_connection(self, address):
+		"""Операция: подключение к модему по адресу (host, port)"""
+		self.channel = Channel(self)
+		self.channel.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.is_closed = False
+		self.error = None
+		self.channel.connect(address)
+		return WaitConnect(self)
+
+	def close(self):
+		if self.channel is not None:
+			self.channel.close()
+		self.on_close()
+
+	def on_event(self):
+		if self.wait is not None and self.wait.task is not None:
+			self.wait.check()
+
+	def on_data(self, buff):
+		if self.log is not None and self.log_bytes:
+			self.log.log_rcv_bytes(buff)
+		if self.line_buff is not None:
+			self.line_buff += buff
+			if len(self.line_buff) > self.MAX_LINE_SIZE:
+				self.line_buff = ''
+				self.error = Mek61107.Mek61107.WrongIdMessage('line too long')
+		else:
+			try:
+				self.decoder.feed(buff)
+			except Mek61107.Mek61107.Mek61107Exception as e:
+				self.on_receive_error(e)
+				self.error = e
+		self.on_event()
+
+	def on_close(self, error=None):
+		self.is_closed = True
+		if error is not None:
+			self.error = error
+		self.on_event()
+
+	def write(self, buff):
+		if self.is_closed:
+			raise Mek61107.Mek61107.Mek61107Exception('Connection closed')
+		self.channel.out_buff += buff
+
+	def flush(self):
+		"""Операция: ожидание передачи всех данных"""
+		return WaitSent(self)
+
+	def receive(self, timeout=None):
+		"""Операция: приём кадра; по таймауту - NoAnswer; timeout -- None - таймаут протокола"""
+		return WaitFrame(self, timeout)
+
+	def discard(self, duration):
+		"""Операция: отбрасывает данные, принятые в течение duration, с"""
+		yield Sleep(duration)
+		self.decoder.clear()
+		self.error = None
+
+	def retry(self, attempt, obis):
+		"""Операция: пауза перед повтором attempt (1..) запросов после ошибки ответа на запрос obis"""
+		if self.metrics is not None:
+			self.metrics.add('retries', self.device, 'R1', obis)
+		yield self.discard(self.retry_policy.get_backoff(attempt))
+
+	def receive_line(self):
+		"""Операция: приём строки; по таймауту - пустая строка"""
+		if self.line_buff is None:
+			self.line_buff = ''
+		return WaitLine(self)
+
+	def send(self, cmd):
+		buff = cmd.serialize(calculate_bcc_func=self.bcc.calculate)
+		self.on_send(cmd, len(buff))
+		if self.log is not None:
+			if self.log_bytes:
+				self.log.log_snd_bytes(buff)
+			self.log.log_snd_frame(cmd)
+		self.write(buff)
+
+	def connect(self, y='1', v='0', device_number=''):
+		start_time = time.time()
+		self.decoder.clear()
+		self.error = None
+		# посылка запроса
+		self.line_buff = ''
+		buff = NevaMt3xx.NevaMt3xx.make_request(device_number)
+		if self.log is not None:
+			self.log.log_snd_bytes(buff)
+		self.write(buff)
+		# приём индификационного сообщения
+		buff = yield self.receive_line()
+		company, baudrate, device = self.get_id_message(buff)
+		if self.log is not None:
+			self.log.log_rcv('Code: {}; baudrate: {}; id: {}'.format(company, baudrate, device))
+		self.device = self.get_device(company, device, device_number)
+		# посылка сообщения подтверждения/выбора опций
+		buff = NevaMt3xx.NevaMt3xx.make_ack_message(baudrate, v=v, y=y)
+		if self.log is not None:
+			self.log.log_snd_bytes(buff)
+		self.write(buff)
+		self.observe_duration('handshake', start_time)
+		raise Return((company, device))
+
+	def login(self, password):
+		start_time = time.time()
+		cmd = yield self.receive()
+		if not cmd.is_command or cmd.command != 'P0':
+			raise Mek61107.Mek61107.Mek61107Exception('Command "P0" expected')
+		send_time = time.time()
+		self.send(NevaMt3xx.NevaMt3xx.Command('P1', '('+password+')'))
+		cmd = yield self.receive()
+		self.observe_rtt('P1', '', send_time)
+		self.observe_duration('login', start_time)
+		raise Return(cmd.is_ack)
+
+	def logout(self):
+		self.send(NevaMt3xx.NevaMt3xx.Command('B0', ''))
+		yield self.flush()
+
+	def read_obis(self, obis):
+		values = yield self.read_many([obis], window=1)
+		raise Return(values[0])
+
+	def read_many(self, obis_list, window=None):
+		batch = NevaMt3xx.ReadBatch(self, obis_list, window)
+		while not batch.is_done():
+			batch.send_requests()
+			cmd = None
+			try:
+				cmd = yield self.receive(batch.get_timeout())
+			except Mek61107.Mek61107.WrongBcc:
+				if not batch.can_retry():
+					raise
+			if batch.on_answer(cmd):
+				continue
+			yield self.retry(batch.attempt, batch.get_failed_obis())
+			batch.resend()
+		raise Return(batch.values)
+
+	def write_obis(self, obis, data):
+		obis = Obis.normalize(obis)
+		send_time = time.time()
+		self.send(NevaMt3xx.NevaMt3xx.Command('W1', obis+'('+data+')'))
+		cmd = yield self.receive(self.get_timeout())
+		self.observe_rtt('W1', obis, send_time)
+		raise Return(self.check_write_answer(obis, cmd))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Опрос нескольких счётчиков НЕВА МТ3XХ с адресами на одной линии RS-485
+
+import time
+import Mek61107
+import NevaMt3xx
+
+
+class Meter:
+	"""Счётчик на линии: адрес, пароль, список OBIS кодов для считывания и состояние опроса"""
+
+	def __init__(self, address, password='00000000', obis_list=()):
+		self.address = address
+		self.password = password
+		self.obis_list = list(obis_list)
+		self.company, self.device = None, None
+		self.failures = 0 # число ошибок опроса подряд
+		self.next_poll_time = 0 # время, до которого счётчик пропускается после ошибки
+		self.last_error = None
+		self.values = None # значения obis_list последнего успешного опроса
+		self.last_poll_time = None
+
+	def __str__(self):
+		return 'Meter {}'.format(self.address)
+
+	def read(self, protocol):
+		"""Считывает значения счётчика после login; по умолчанию - obis_list одним проходом"""
+		return protocol.read_many(self.obis_list)
+
+
+class Bus:
+	"""Поочерёдный опрос счётчиков meters (Meter) на одной линии через NevaMt3xx_com:
+	connect с адресом -> login -> read_many -> B0.
+	Счётчик, не ответивший при опросе или с ошибкой порта (EnvironmentError), пропускается
+	с экспоненциальным нарастанием паузы: backoff_base*2^(ошибок подряд - 1), но не более backoff_max.
+
+	Example:
+	bus = NevaMt3xxBus.Bus(NevaMt3xx.NevaMt3xx_com(port),
+		[NevaMt3xxBus.Meter(address, obis_list=['00.09.02*FF', '0F.80.80*00']) for address in ('9144', '9145')])
+	while True:
+		for meter, values, error in bus.poll():
+			print meter.address, values if error is None else error
+		print '{:.1f} meters/min'.format(bus.get_throughput())
+	"""
+
+	BACKOFF_BASE = 10. # с
+	BACKOFF_MAX = 3600. # с
+	TURNAROUND = .02 # пауза после B0 перед обращением к следующему счётчику, с: наименьшая по МЭК 61107 (20 мс)
+
+	def __init__(self, protocol, meters, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, turnaround=TURNAROUND):
+		self.protocol = protocol
+		self.meters = list(meters)
+		self.backoff_base = backoff_base
+		self.backoff_max = backoff_max
+		self.turnaround = turnaround
+		self.exchange_time = None # время окончания обмена с предыдущим счётчиком
+		self.start_time = None
+		self.polled_count = 0 # успешно опрошено счётчиков
+		self.failed_count = 0
+
+	def wait_turnaround(self):
+		"""Пауза перед обращением к счётчику: не менее turnaround после обмена с предыдущим счётчиком линии"""
+		if self.exchange_time is not None:
+			delay = self.exchange_time+self.turnaround-time.time()
+			if delay > 0:
+				time.sleep(delay)
+
+	def logout(self):
+		"""B0 после ошибки опроса; ошибка посылки не прерывает цикл опроса - она проявится на следующем счётчике"""
+		try:
+			self.protocol.logout()
+		except Exception:
+			pass
+
+	def poll_meter(self, meter):
+		"""Опрашивает счётчик meter; возвращает значения meter.obis_list"""
+		self.wait_turnaround()
+		meter.company, meter.device = self.protocol.connect(device_number=meter.address)
+		if not self.protocol.login(meter.password):
+			raise Mek61107.Mek61107.Mek61107Exception('Access denied')
+		values = meter.read(self.protocol)
+		self.protocol.logout()
+		self.exchange_time = time.time()
+		return values
+
+	def poll(self):
+		"""Один цикл опроса всех счётчиков, для которых не действует пауза после ошибки.
+		Возвращает список [meter, values, error]: values - значения meter.obis_list или None, если ошибка error"""
+		return list(self.iter_poll())
+
+	def iter_poll(self):
+		"""Генератор poll: [meter, values, error] по мере опроса счётчиков"""
+		if self.start_time is None:
+			self.start_time = time.time()
+		for meter in self.meters:
+			now = time.time()
+			if meter.next_poll_time > now:
+				continue
+			try:
+				meter.values = self.poll_meter(meter)
+				meter.failures = 0
+				meter.last_error = None
+				meter.last_poll_time = now
+				self.polled_count += 1
+				yield [meter, meter.values, None]
+			except (Mek61107.Mek61107.Mek61107Exception, EnvironmentError) as e:
+				# ошибка обмена или порта (serial.SerialException, OSError: сбой адаптера) - ошибка счётчика,
+				# остальные счётчики линии опрашиваются; счётчик мог остаться в режиме обмена - вернуть в исходное состояние
+				self.logout()
+				self.exchange_time = time.time()
+				meter.failures += 1
+				meter.last_error = e
+				meter.next_poll_time = time.time()+min(self.backoff_max, self.backoff_base*2**(meter.failures-1))
+				self.failed_count += 1
+				yield [meter, None, e]
+
+	def get_throughput(self):
+		"""Возвращает пропускную способность линии: опрошено счётчиков в минуту с начала опроса"""
+		if self.start_time is None:
+			return 0.
+		elapsed = time.time()-self.start_time
+		if elapsed <= 0:
+			return 0.
+		return self.polled_count*60./elapsed
@@ -0,0 +1,157 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Реестр OBIS кодов счётчиков Нева МТ 3xx: нормализованные коды и разбор значений в целые числа
+
+from datetime import datetime
+import Mek61107
+
+
+class WrongValue(Mek61107.Mek61107.Mek61107Exception):
+	pass
+
+
+NORMALIZED = {} # OBIS коды реестра с номерами архивов в любом виде -> нормализованный код; заполняет Obis
+
+
+def normalize(obis):
+	"""Возвращает OBIS код в виде для передачи счётчику: '00.09.02*FF' -> '000902FF';
+	коды реестра - поиском в NORMALIZED, без разбора строки"""
+	code = NORMALIZED.get(obis)
+	return code if code is not None else obis.replace('.', '').replace('*', '')
+
+
+def split_fixed(buff, decimals):
+	"""Возвращает для списка чисел с фиксированной точкой buff ('000400.84,000309.98')
+	[список без точек ('00040084,00030998'), множитель до decimals знаков после точки]
+	или None, если значения списка разного формата.
+	Формат проверяется срезами строки целиком: значения счётчика одной ширины с точкой в одной позиции"""
+	count = buff.count(',')+1
+	first = buff.split(',', 1)[0]
+	width = len(first)
+	point = first.find('.')
+	if len(buff) != count*(width+1)-1 or buff[width::width+1] != ','*(count-1):
+		return None
+	if point < 0:
+		return [buff, 10**decimals] if buff.count('.') == 0 else None
+	if buff.count('.') != count or buff[point::width+1] != '.'*count:
+		return None
+	fraction = width-point-1
+	if fraction > decimals:
+		return None
+	return [buff.replace('.', ''), 10**(decimals-fraction)]
+
+
+def decode_fixed_value(buff, decimals):
+	"""'000400.84' -> 400840 при decimals=3: целое число единиц 10**-decimals без float;
+	лишние знаки после точки отбрасываются"""
+	integer, point, fraction = buff.strip().partition('.')
+	try:
+		if len(fraction) > decimals:
+			value = int(integer+fraction[:decimals])
+		else:
+			value = int(integer+fraction)*10**(decimals-len(fraction))
+	except ValueError:
+		raise WrongValue('Wrong fixed-point value: '+str(buff))
+	return value
+
+
+def decode_fixed(buff, decimals):
+	"""Возвращает список целых чисел единиц 10**-decimals для списка чисел с фиксированной точкой buff:
+	'000400.84,000309.98' -> [400840, 309980] при decimals=3 (кВт*ч -> Вт*ч).
+	Список одного формата разбирается одним проходом; иначе - по значениям"""
+	if len(buff) == 0:
+		return []
+	fixed = split_fixed(buff, decimals)
+	if fixed is not None:
+		digits, factor = fixed
+		try:
+			values = map(int, digits.split(','))
+		except ValueError:
+			raise WrongValue('Wrong fixed-point value: '+str(buff))
+		return values if factor == 1 else [value*factor for value in values]
+	return [decode_fixed_value(value, decimals) for value in buff.split(',')]
+
+
+def decode_integers(buff):
+	"""'03977,03995' -> [3977, 3995]"""
+	try:
+		return map(int, buff.split(',')) if len(buff) > 0 else []
+	except ValueError:
+		raise WrongValue('Wrong integer value: '+str(buff))
+
+
+def decode_date(buff):
+	"""'ГГММДД' -> datetime.date"""
+	try:
+		return datetime.strptime(buff, '%y%m%d').date()
+	except ValueError:
+		raise WrongValue('Wrong date: '+str(buff))
+
+
+def decode_time(buff):
+	"""'ЧЧММСС' -> datetime.time"""
+	try:
+		return datetime.strptime(buff, '%H%M%S').time()
+	except ValueError:
+		raise WrongValue('Wrong time: '+str(buff))
+
+
+class Obis:
+	"""Известный OBIS код: obis - без номера архива ('0F.80.80'), code - нормализованный ('0F8080'),
+	decode - разбор значения, count - число значений списка (None - не проверяется), unit - единица разбора"""
+
+	def __init__(self, obis, name, decode=None, count=None, unit=''):
+		self.obis = obis
+		self.code = normalize(obis)
+		self.name = name
+		self.decode_func = decode
+		self.count = count
+		self.unit = unit
+		self.codes = [self.code+'{:02X}'.format(index) for index in xrange(256)] # нормализованные коды с номером
+		for index, code in enumerate(self.codes):
+			NORMALIZED[code] = code
+			NORMALIZED[obis+'*{:02X}'.format(index)] = code
+
+	def get_code(self, index=0xFF):
+		"""Возвращает нормализованный код с номером архива index (0xFF - текущее значение)"""
+		return self.codes[index]
+
+	def decode(self, buff):
+		value = buff if self.decode_func is None else self.decode_func(buff)
+		if self.count is not None and len(value) != self.count:
+			raise WrongValue('Wrong {} answer: {}'.format(self.obis, buff))
+		return value
+
+
+KWH = 3 # кВт*ч -> Вт*ч
+
+DATE = Obis('00.09.02', u'Дата', decode_date)
+TIME = Obis('00.09.01', u'Время', decode_time)
+DAY_SCHEDULE = Obis('0A.01.64', u'Суточное тарифное расписание: ЧЧММТТ', lambda buff: buff.split(','))
+YEAR_SCHEDULE = Obis('0B.00.00', u'Годовое расписание особых суток: ММДДТТ', lambda buff: buff.split(','))
+MONTH_ENERGIES = Obis('0F.08.80', u'Активная энергия нарастающим итогом на начало месяца: сумма, T1..T4',
+	lambda buff: decode_fixed(buff, KWH), 5, u'Вт*ч')
+DAY_ENERGIES = Obis('0F.80.80', u'Активная энергия нарастающим итогом на начало суток: сумма, T1..T4',
+	lambda buff: decode_fixed(buff, KWH), 5, u'Вт*ч')
+POWER = Obis('10.07.00', u'Мгновенная активная мощность', lambda buff: decode_fixed_value(buff, 3), unit=u'мВт')
+ID = Obis('60.01.00', u'ID счётчика')
+ADDRESS = Obis('60.01.01', u'Адрес счётчика')
+MODEL = Obis('60.01.04', u'Модель счётчика')
+PLACE = Obis('60.01.0A', u'Место установки')
+TEMPERATURE = Obis('60.09.00', u'Температура', lambda buff: decode_fixed_value(buff, 0), unit=u'°C')
+HALF_HOURS = Obis('63.01.00', u'Профиль нагрузки получасовой: 48 мощностей', decode_integers, 48, u'Вт')
+
+REGISTRY = dict([[obis.code, obis] for obis in (DATE, TIME, DAY_SCHEDULE, YEAR_SCHEDULE, MONTH_ENERGIES, DAY_ENERGIES,
+	POWER, ID, ADDRESS, MODEL, PLACE, TEMPERATURE, HALF_HOURS)])
+
+
+def get(obis):
+	"""Возвращает Obis реестра для OBIS кода obis (с номером архива или без, нормализованного или нет) или None"""
+	return REGISTRY.get(normalize(obis)[:6])
+
+
+def decode(obis, buff):
+	"""Возвращает значение buff OBIS кода obis, разобранное по реестру; неизвестный код - строкой"""
+	entry = get(obis)
+	return buff if entry is None else entry.decode(buff)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Локальный кэш суточных профилей счётчиков: прошедшие сутки не меняются и считываются один раз
+
+import os
+import re
+import json
+from datetime import timedelta
+import Mek61107
+import MeterClock
+
+
+class ProfileCache:
+	"""Кэш суточных значений OBIS кодов (63.01.00*XX, 0F.80.80*XX, ...) по счётчикам и датам.
+
+	Значения хранятся в каталоге directory, по файлу JSON на счётчик: {'ГГГГ-ММ-ДД': {OBIS: значение}}.
+	Номер суток XX (дней назад) считается от даты счётчика (00.09.02*FF), поэтому
+	часы компьютера не влияют на сопоставление дат. Сутки кэшируются, когда они завершились:
+	текущие сутки счётчика считываются всегда.
+
+	Example:
+	cache = ProfileCache.ProfileCache('cache')
+	company, device = protocol.connect()
+	protocol.login(password)
+	for date, values in cache.read_days(protocol, company+device, days_ago=range(128)):
+		print date, values[0] # 63.01.00
+	"""
+
+	OBIS_LIST = ('63.01.00', '0F.80.80') # профиль получасовой; энергия за сутки по тарифам
+	MAX_DAYS_AGO = 127
+
+	def __init__(self, directory):
+		self.directory = directory
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.days = {} # счётчик -> {дата: {OBIS: значение}}
+
+	def get_file_name(self, device):
+		return os.path.join(self.directory, re.sub(r'[^0-9A-Za-z._-]', '_', device)+'.json')
+
+	def load(self, device):
+		"""Возвращает закэшированные сутки счётчика device: {'ГГГГ-ММ-ДД': {OBIS: значение}}"""
+		days = self.days.get(device)
+		if days is None:
+			days = {}
+			file_name = self.get_file_name(device)
+			if os.path.exists(file_name):
+				with open(file_name) as f:
+					days = json.load(f)
+			self.days[device] = days
+		return days
+
+	def save(self, device):
+		file_name = self.get_file_name(device)
+		with open(file_name+'.tmp', 'w') as f:
+			json.dump(self.load(device), f, indent=1, sort_keys=True)
+		os.rename(file_name+'.tmp', file_name)
+
+	def get(self, device, date, obis):
+		"""Возвращает закэшированное значение obis (без номера суток) за дату date или None"""
+		return self.load(device).get(date.isoformat(), {}).get(obis)
+
+	def put(self, device, date, obis, value):
+		self.load(device).setdefault(date.isoformat(), {})[obis] = value
+
+	def read_days(self, protocol, device, dates=None, days_ago=None, obis_list=OBIS_LIST, window=None, clock=None):
+		"""Возвращает список [дата, [значения obis_list]] для дат dates (datetime.date)
+		или для суток days_ago (0..127 дней назад от даты счётчика).
+		Незакэшированные и текущие сутки считываются через protocol.read_many в один проход
+		в одних сутках счётчика: clock (MeterClock, один на сеанс) проверяет смену суток
+		во время считывания.
+		Может вызвать исключения: Mek61107Exception"""
+
+		days = self.load(device)
+		if clock is None:
+			clock = MeterClock.MeterClock(protocol)
+		ret = []
+		requests = [] # [индекс ret, дней назад]
+
+		def get_obis_list(meter_date):
+			del ret[:], requests[:]
+			for date in (dates if days_ago is None else [meter_date-timedelta(days=day) for day in days_ago]):
+				day = (meter_date-date).days
+				if not 0 <= day <= self.MAX_DAYS_AGO:
+					raise Mek61107.Mek61107.Mek61107Exception(
+						'Date {} out of meter profile (meter date {})'.format(date, meter_date))
+				values = days.get(date.isoformat(), {}) if day > 0 else {}
+				values = [values.get(obis) for obis in obis_list]
+				if None in values:
+					requests.append([len(ret), day])
+				ret.append([date, values])
+			return [obis+'*{:02X}'.format(day) for index, day in requests for obis in obis_list]
+
+		meter_date, buff = clock.read(get_obis_list, window=window)
+		for j in xrange(len(requests)):
+			index, day = requests[j]
+			values = buff[j*len(obis_list):(j+1)*len(obis_list)]
+			ret[index][1] = values
+			if day > 0:
+				for obis, value in zip(obis_list, values):
+					self.put(device, ret[index][0], obis, value)
+		if len([day for index, day in requests if day > 0]) > 0:
+			self.save(device)
+		return ret
@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Снимок: считывание списка OBIS кодов и диапазонов архивов за один сеанс одним проходом
+
+import re
+import Mek61107
+import MeterClock
+
+
+class WrongSpec(Mek61107.Mek61107.Mek61107Exception):
+	pass
+
+
+class Snapshot:
+	"""Снимок показаний счётчика по профилю: списку OBIS кодов, в том числе с диапазоном
+	номеров архива (дней, месяцев назад): 'ГГ.ГГ.ГГ*[НН..КК]', номера - шестнадцатеричные, включительно,
+	из одной или двух цифр, как в meter_imitator.py.
+	Например: '60.01.00*FF', '0F.08.80*[00..0C]' или '0F.08.80*[0..C]' (энергия на начало 13 месяцев), '0F.80.80*[00..7F]'.
+
+	Все коды считываются через protocol.read_many одним проходом, повторяющиеся - один раз;
+	с окном read_window больше 1 запросы посылаются без ожидания ответов, с окном 1 - после каждого ответа.
+	Номера архивов отсчитываются от даты счётчика, поэтому профиль с диапазонами считывается
+	в одних сутках счётчика через clock (MeterClock).
+
+	Example:
+	snapshot = Snapshot.Snapshot(['60.01.00*FF', '0F.08.80*[00..0C]'])
+	result = snapshot.read(protocol)
+	print result['values']['0F.08.80*[00..0C]'][0] # энергия на начало текущего месяца
+	"""
+
+	SPEC_RE = re.compile(r'^([0-9A-F]{2}\.[0-9A-F]{2}\.[0-9A-F]{2})\*(?:([0-9A-F]{1,2})|\[([0-9A-F]{1,2})\.\.([0-9A-F]{1,2})\])$')
+
+	def __init__(self, specs):
+		self.specs = [] # [спецификация, OBIS без номера, номера или None - одиночный код]
+		for spec in specs:
+			spec = str(spec).strip().upper()
+			match = self.SPEC_RE.match(spec)
+			if match is None:
+				raise WrongSpec('Wrong OBIS spec: '+spec)
+			obis, index, first, last = match.groups()
+			if index is not None:
+				self.specs.append([spec, obis+'*{:02X}'.format(int(index, 16)), None])
+			else:
+				first, last = int(first, 16), int(last, 16)
+				if first > last:
+					raise WrongSpec('Wrong OBIS range: '+spec)
+				self.specs.append([spec, obis, range(first, last+1)])
+
+	@staticmethod
+	def load(file_name):
+		"""Возвращает Snapshot по файлу профиля: спецификация на строку, после '#' - комментарий"""
+		with open(file_name) as f:
+			return Snapshot([line for line in [line.split('#')[0].strip() for line in f] if len(line) > 0])
+
+	def get_obis_list(self):
+		"""Возвращает OBIS коды профиля без повторов в порядке профиля"""
+		ret = []
+		codes = set()
+		for spec, obis, numbers in self.specs:
+			for code in [obis] if numbers is None else [obis+'*{:02X}'.format(i) for i in numbers]:
+				if code not in codes:
+					codes.add(code)
+					ret.append(code)
+		return ret
+
+	def is_archive(self):
+		return len([spec for spec in self.specs if spec[2] is not None]) > 0
+
+	def read(self, protocol, clock=None, window=None):
+		"""Считывает профиль. Возвращает {'date': дата счётчика (datetime.date; None без диапазонов),
+		'values': {спецификация: значение или список значений по номерам диапазона}}.
+		Может вызвать исключения: Mek61107Exception"""
+
+		obis_list = self.get_obis_list()
+		date = None
+		if self.is_archive():
+			if clock is None:
+				clock = MeterClock.MeterClock(protocol)
+			date, values = clock.read(lambda date: obis_list, window=window)
+		else:
+			values = protocol.read_many(obis_list, window=window)
+		return self.get_result(date, values)
+
+	def get_result(self, date, values):
+		"""Возвращает результат read по значениям values OBIS кодов get_obis_list"""
+		values = dict(zip(self.get_obis_list(), values))
+		ret = {}
+		for spec, obis, numbers in self.specs:
+			if numbers is None:
+				ret[spec] = values[obis]
+			else:
+				ret[spec] = [values[obis+'*{:02X}'.format(i)] for i in numbers]
+		return {'date': date, 'values': ret}
@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Синтетические данные имитатора: профили, энергии по тарифам и мощность, вычисляемые по запросу
+
+import math
+import zlib
+import random
+from datetime import date, datetime
+import Mek61107
+import Tariffs
+
+
+EPOCH = date(2015, 1, 1).toordinal() # сутки начала отсчёта энергии
+DEFAULT_SCHEDULE = '070001,230002' # суточное расписание (0A.01.64*FF): T1 с 07:00, T2 с 23:00
+CURRENT = 0xFF # номер архива текущего значения
+
+
+class WrongGenerator(Mek61107.Mek61107.Mek61107Exception):
+	pass
+
+
+INDEXES = [chr(i) for i in xrange(256)] # продолжения хэша для последовательности чисел одного ключа
+
+
+def get_random(*keys):
+	"""Возвращает random.Random, инициализированный по ключам keys: одинаковые ключи - одинаковые числа
+	при любом порядке запросов и между запусками; только для параметров счётчика - один раз на счётчик"""
+	return random.Random(zlib.crc32('/'.join([str(key) for key in keys])) & 0xFFFFFFFF)
+
+
+def get_uniforms(count, *keys):
+	"""Возвращает count чисел из [0, 1), определяемых ключами keys, как get_random, но по crc32
+	без создания random.Random: значения суток вычисляются при каждом запросе"""
+	seed = zlib.crc32('/'.join([str(key) for key in keys]))
+	return [(zlib.crc32(INDEXES[i], seed) & 0xFFFFFFFF)/4294967296. for i in xrange(count)]
+
+
+def shift_month(day, months):
+	"""Возвращает первое число месяца на months месяцев раньше месяца day"""
+	month = day.year*12+day.month-1-months
+	return date(month//12, month%12+1, 1)
+
+
+def format_energies(energies):
+	"""[сумма, T1..T4] Вт*ч -> '000400.84,000309.98,...' кВт*ч"""
+	return ','.join(['{:06}.{:02}'.format(energy//1000, energy%1000//10) for energy in energies])
+
+
+def format_profile(profile):
+	"""48 мощностей, Вт -> '03977,03995,...'"""
+	return ','.join(['{:05}'.format(power) for power in profile])
+
+
+class MeterData:
+	"""Синтетические данные счётчика key (например, company+id): хранятся только параметры счётчика,
+	каждое значение вычисляется при запросе по хэшу (get_uniforms) ключа счётчика и суток,
+	поэтому данные парка счётчиков за любые сутки не занимают памяти и согласованы:
+	- энергия тарифа на начало суток - E0 + rate*(сутки-EPOCH) + колебание суток (до 0.4 rate),
+	  поэтому растёт каждые сутки и считается без суммирования предыдущих суток;
+	- профиль суток - получасовые мощности, распределяющие приращение энергии каждого тарифа
+	  суток по получасам тарифа (day_buff - суточное расписание 'ЧЧММTT,...') по форме суточной нагрузки;
+	  получасы текущих суток с текущего - нулевые;
+	- мгновенная мощность - мощность текущего получаса с колебанием по минутам.
+
+	Example:
+	data = Synthetic.MeterData('TPCNEVAMT324.2303')
+	print data.get_energies(date.today()), data.get_profile(date.today())
+	"""
+
+	FLUCTUATION = .4 # колебание суточного расхода энергии относительно среднего
+	NOISE = .3 # колебание мощности получаса относительно формы нагрузки
+	POWER_NOISE = .1 # колебание мгновенной мощности
+
+	def __init__(self, key, day_buff=DEFAULT_SCHEDULE):
+		self.key = key
+		self.day_indexes = Tariffs.TariffSchedule.compile_day(Tariffs.TariffSchedule.get_entries(day_buff))
+		r = get_random(key)
+		rate = r.randint(3000, 15000) # средний расход, Вт*ч в сутки
+		start = r.randint(1000, 20000)*1000 # энергия на начало EPOCH, Вт*ч
+		self.rates = [0]*Tariffs.TARIFFS
+		for tariff in self.day_indexes:
+			self.rates[tariff-1] += rate//Tariffs.HALF_HOURS
+		self.starts = [start*rate_t//max(1, sum(self.rates)) for rate_t in self.rates]
+		peak = r.uniform(17., 21.) # час наибольшей нагрузки
+		self.load = [1.5+math.cos((i/2.-peak)*math.pi/12.) for i in xrange(Tariffs.HALF_HOURS)] # средняя форма нагрузки
+		self.zones = [[i for i in xrange(Tariffs.HALF_HOURS) if self.day_indexes[i] == tariff+1]
+			for tariff in xrange(Tariffs.TARIFFS)] # получасы тарифов
+
+	def get_tariff_energy(self, tariff, day):
+		"""Энергия тарифа tariff (0..3) на начало суток day (номер date.toordinal), Вт*ч"""
+		rate = self.rates[tariff]
+		if rate == 0:
+			return self.starts[tariff]
+		fluctuation = int(rate*self.FLUCTUATION*get_uniforms(1, self.key, 'energy', tariff, day)[0])
+		return self.starts[tariff]+rate*(day-EPOCH)+fluctuation
+
+	def get_energies(self, day_date):
+		"""Возвращает [сумма, T1..T4] энергии на начало суток day_date, Вт*ч"""
+		energies = [self.get_tariff_energy(tariff, day_date.toordinal()) for tariff in xrange(Tariffs.TARIFFS)]
+		return [sum(energies)]+energies
+
+	def get_shape(self, day):
+		"""Форма нагрузки получасов суток day: положительные веса"""
+		return [load*(1+self.NOISE*(2*u-1)) for load, u in zip(self.load, get_uniforms(len(self.load), self.key, 'shape', day))]
+
+	def get_full_profile(self, day_date):
+		"""Возвращает 48 мощностей получасов суток day_date, Вт, без учёта текущего времени"""
+		day = day_date.toordinal()
+		shape = self.get_shape(day)
+		profile = [0]*Tariffs.HALF_HOURS
+		for tariff, half_hours in enumerate(self.zones):
+			if len(half_hours) == 0:
+				continue
+			energy = self.get_tariff_energy(tariff, day+1)-self.get_tariff_energy(tariff, day)
+			factor = 2.*energy/sum([shape[i] for i in half_hours]) # Вт*ч за получас -> Вт
+			for i in half_hours:
+				profile[i] = int(factor*shape[i]+.5)
+		return profile
+
+	def get_profile(self, day_date, now=None):
+		"""Возвращает 48 мощностей получасов суток day_date, Вт; получасы текущих суток с текущего - 0"""
+		now = datetime.now() if now is None else now
+		profile = self.get_full_profile(day_date)
+		if day_date >= now.date():
+			current = Tariffs.HALF_HOURS if day_date > now.date() else (now.hour*60+now.minute)//30
+			profile[current:] = [0]*(Tariffs.HALF_HOURS-current)
+		return profile
+
+	def get_current_energies(self, now=None):
+		"""Возвращает [сумма, T1..T4] текущей энергии, Вт*ч"""
+		now = datetime.now() if now is None else now
+		energies = self.get_energies(now.date())[1:]
+		profile = self.get_full_profile(now.date())
+		current = (now.hour*60+now.minute)//30
+		for i in xrange(current):
+			energies[self.day_indexes[i]-1] += profile[i]//2
+		return [sum(energies)]+energies
+
+	def get_power(self, now=None):
+		"""Возвращает мгновенную мощность, Вт"""
+		now = datetime.now() if now is None else now
+		power = self.get_full_profile(now.date())[(now.hour*60+now.minute)//30]
+		u = get_uniforms(1, self.key, 'power', now.toordinal(), now.hour, now.minute)[0]
+		return power*(1+self.POWER_NOISE*(2*u-1))
+
+
+def get_day(index, now):
+	return date.fromordinal(now.toordinal()-(0 if index == CURRENT else index))
+
+
+def generate_profile(data, index, now):
+	"""63.01.00*NN: профиль суток NN суток назад"""
+	return format_profile(data.get_profile(get_day(index, now), now))
+
+
+def generate_day_energies(data, index, now):
+	"""0F.80.80*NN: энергия на начало суток NN суток назад; FF - текущая"""
+	if index == CURRENT:
+		return format_energies(data.get_current_energies(now))
+	return format_energies(data.get_energies(get_day(index, now)))
+
+
+def generate_month_energies(data, index, now):
+	"""0F.08.80*NN: энергия на начало месяца NN месяцев назад; FF - текущая"""
+	if index == CURRENT:
+		return format_energies(data.get_current_energies(now))
+	return format_energies(data.get_energies(shift_month(now.date(), index)))
+
+
+def generate_power(data, index, now):
+	"""10.07.00*FF: мгновенная мощность, Вт"""
+	return '{:07.1f}'.format(data.get_power(now))
+
+
+GENERATORS = {
+	'profile': generate_profile,
+	'day_energies': generate_day_energies,
+	'month_energies': generate_month_energies,
+	'power': generate_power,
+}
+
+
+def get_generator(name):
+	"""Возвращает генератор значения по имени GENERATORS: generator(MeterData, номер архива, datetime) -> строка"""
+	try:
+		return GENERATORS[name]
+	except KeyError:
+		raise WrongGenerator('Unknown generator: {}; expected: {}'.format(name, ', '.join(sorted(GENERATORS))))
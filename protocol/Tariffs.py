@@ -0,0 +1,286 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+# Расчёт получасовых показаний по тарифам из суточных профилей счётчика
+
+import os
+import json
+import time
+import array
+import bisect
+import hashlib
+from datetime import date
+from Mek61107 import numpy, Mek61107
+import Obis
+
+
+HALF_HOURS = 48 # получасов в сутках
+TARIFFS = 4 # T1..T4
+ENERGIES = TARIFFS+1 # сумма, T1..T4
+
+
+class WrongProfile(Mek61107.Mek61107Exception):
+	pass
+
+
+def is_numpy(use_numpy):
+	return numpy is not None and use_numpy
+
+
+def make_profiles(buffs, use_numpy=True):
+	"""Возвращает профили суток (значения 63.01.00*XX: 48 получасовых мощностей, Вт) buffs
+	в виде целых: numpy массив days×48 или, без numpy, array('l') длиной days*48"""
+	for buff in buffs:
+		if buff.count(',') != HALF_HOURS-1:
+			raise WrongProfile('Wrong 63.01.00 answer: '+str(buff))
+	buff = ','.join(buffs)
+	if is_numpy(use_numpy):
+		# разбор текста целиком в C; ошибка разбора даёт меньшее число значений
+		ret = numpy.fromstring(buff, dtype=numpy.int64, sep=',')
+		if len(ret) != len(buffs)*HALF_HOURS:
+			raise WrongProfile('Wrong 63.01.00 answer: '+buff)
+		return ret.reshape((len(buffs), HALF_HOURS))
+	try:
+		return array.array('l', [int(value) for value in buff.split(',')]) if len(buff) > 0 else array.array('l')
+	except ValueError:
+		raise WrongProfile('Wrong 63.01.00 answer: '+buff)
+
+
+def make_energies(buffs, use_numpy=True):
+	"""Возвращает энергии на начало суток (значения 0F.80.80*XX: сумма, T1..T4, кВт*ч) buffs
+	в Вт*ч: numpy массив days×5 или, без numpy, array('l') длиной days*5"""
+	for buff in buffs:
+		if buff.count(',') != ENERGIES-1:
+			raise WrongProfile('Wrong 0F.80.80 answer: '+str(buff))
+	buff = ','.join(buffs)
+	fixed = Obis.split_fixed(buff, Obis.KWH) if len(buff) > 0 else None
+	if is_numpy(use_numpy) and fixed is not None:
+		# значения одного формата: целые без точки в C, без float
+		ret = numpy.fromstring(fixed[0], dtype=numpy.int64, sep=',')
+		if len(ret) != len(buffs)*ENERGIES:
+			raise WrongProfile('Wrong 0F.80.80 answer: '+buff)
+		return (ret*fixed[1]).reshape((len(buffs), ENERGIES))
+	try:
+		values = Obis.decode_fixed(buff, Obis.KWH)
+	except Obis.WrongValue:
+		raise WrongProfile('Wrong 0F.80.80 answer: '+buff)
+	if is_numpy(use_numpy):
+		return numpy.array(values, dtype=numpy.int64).reshape((len(buffs), ENERGIES))
+	return array.array('l', values)
+
+
+def make_tariff_indexes(day_tariff_indexes, day_tariffs, use_numpy=True):
+	"""Возвращает номера тарифов (1..4) получасов суток: numpy массив days×48 или array('b') длиной days*48.
+	day_tariff_indexes -- номера тарифов 48 получасов обычных суток;
+	day_tariffs -- для каждых суток: None - обычные сутки, иначе - номер тарифа всех получасов суток"""
+	if len(day_tariff_indexes) != HALF_HOURS:
+		raise WrongProfile('Can\'t build day tariff table')
+	for tariff in list(day_tariff_indexes)+[tariff for tariff in day_tariffs if tariff is not None]:
+		if not (0 < tariff <= TARIFFS):
+			raise WrongProfile('Tariff index out of range (1..4): '+str(tariff))
+	if is_numpy(use_numpy):
+		ret = numpy.empty((len(day_tariffs), HALF_HOURS), dtype=numpy.int8)
+		ret[:] = numpy.array(day_tariff_indexes, dtype=numpy.int8)
+		for day, tariff in enumerate(day_tariffs):
+			if tariff is not None:
+				ret[day] = tariff
+		return ret
+	ordinary = array.array('b', day_tariff_indexes)
+	ret = array.array('b')
+	for tariff in day_tariffs:
+		ret.extend(ordinary if tariff is None else array.array('b', [tariff])*HALF_HOURS)
+	return ret
+
+
+def accumulate(energies, profiles, tariff_indexes, use_numpy=True):
+	"""Возвращает энергии нарастающим итогом на конец каждого получаса, Вт*ч: [сумма, T1..T4]:
+	numpy массив days×48×5 или array('l') длиной days*48*5.
+	energies -- make_energies; profiles -- make_profiles; tariff_indexes -- make_tariff_indexes.
+	Энергия получаса - половина мощности (целочисленно), она добавляется к сумме и к тарифу получаса."""
+	if is_numpy(use_numpy):
+		half_hours = numpy.asarray(profiles)//2
+		days = half_hours.shape[0]
+		increments = numpy.zeros((days, HALF_HOURS, ENERGIES), dtype=numpy.int64)
+		increments[:, :, 0] = half_hours
+		for tariff in xrange(1, ENERGIES):
+			increments[:, :, tariff] = numpy.where(numpy.asarray(tariff_indexes) == tariff, half_hours, 0)
+		ret = numpy.cumsum(increments, axis=1)
+		ret += numpy.asarray(energies).reshape((days, 1, ENERGIES))
+		return ret
+	days = len(profiles)//HALF_HOURS
+	ret = array.array('l', [0])*(days*HALF_HOURS*ENERGIES)
+	index = 0
+	for day in xrange(days):
+		t = energies[day*ENERGIES:(day+1)*ENERGIES].tolist()
+		for half_hour_index in xrange(day*HALF_HOURS, (day+1)*HALF_HOURS):
+			half_hour = profiles[half_hour_index]//2
+			t[0] += half_hour
+			t[tariff_indexes[half_hour_index]] += half_hour
+			ret[index] = t[0]
+			ret[index+1] = t[1]
+			ret[index+2] = t[2]
+			ret[index+3] = t[3]
+			ret[index+4] = t[4]
+			index += ENERGIES
+	return ret
+
+
+def to_lists(values, day):
+	"""Возвращает результат accumulate для суток day (индекс) списком [[сумма, T1..T4]*48]"""
+	if numpy is not None and isinstance(values, numpy.ndarray):
+		return values[day].tolist()
+	start = day*HALF_HOURS*ENERGIES
+	return [values[i:i+ENERGIES].tolist() for i in xrange(start, start+HALF_HOURS*ENERGIES, ENERGIES)]
+
+
+class WrongSchedule(Mek61107.Mek61107Exception):
+	pass
+
+
+class TariffSchedule:
+	"""Тарифное расписание счётчика, скомпилированное в таблицы для поиска за O(1):
+	- годовое (0B.00.00*FF: 'ММДДTT,...', TT - тариф особых суток, 7F - обычные сутки)
+	  - таблица 366 суток: тариф всех получасов особых суток или 0 - обычные сутки;
+	- суточное (0A.01.64*FF: 'ЧЧММTT,...', TT - тариф с указанного времени)
+	  - номера тарифов 48 получасов обычных суток.
+	Пустые записи ('000000') не используются. hash - хэш значений расписания.
+
+	Example:
+	schedule = Tariffs.TariffSchedule(*protocol.read_many(Tariffs.TariffSchedule.OBIS_LIST))
+	print schedule.get_day_tariff(date), schedule.day_indexes
+	"""
+
+	OBIS_LIST = ('0B.00.00*FF', '0A.01.64*FF') # годовое и суточное расписание
+	ORDINARY_DAY = 0x7F
+
+	def __init__(self, year_buff, day_buff):
+		self.year_buff = year_buff
+		self.day_buff = day_buff
+		self.hash = self.get_hash(year_buff, day_buff)
+		self.year_table = array.array('b', [0])*366
+		for entry in self.get_entries(year_buff):
+			month, day, tariff = int(entry[:2]), int(entry[2:4]), int(entry[4:], 16)
+			try:
+				day_of_year = self.get_day_of_year(date(2000, month, day))
+			except ValueError:
+				raise WrongSchedule('Wrong year schedule entry: '+entry)
+			if tariff != self.ORDINARY_DAY:
+				if not (0 < tariff <= TARIFFS):
+					raise WrongSchedule('Tariff index out of range (1..4): '+entry)
+				self.year_table[day_of_year] = tariff
+		self.day_indexes = self.compile_day(self.get_entries(day_buff))
+
+	@staticmethod
+	def get_hash(year_buff, day_buff):
+		return hashlib.sha1(year_buff+'\n'+day_buff).hexdigest()
+
+	@staticmethod
+	def get_entries(buff):
+		"""Возвращает отсортированные непустые записи расписания 'XXXXTT'"""
+		ret = []
+		for entry in buff.split(','):
+			if len(entry) == 0:
+				continue
+			try:
+				if len(entry) != 6:
+					raise ValueError()
+				if int(entry, 16) == 0:
+					continue
+			except ValueError:
+				raise WrongSchedule('Wrong schedule entry: '+entry)
+			ret.append(entry)
+		return sorted(ret)
+
+	@staticmethod
+	def compile_day(entries):
+		"""Возвращает array('b') тарифов 48 получасов по записям 'ЧЧММTT': тариф получаса -
+		тариф последней записи, время которой приходится на получас или раньше (переключение не на границе
+		получаса действует с получаса, в который оно попадает: 07:15 - с получаса 07:00);
+		до первой записи - тариф последней записи суток"""
+		if len(entries) == 0:
+			return array.array('b', [1])*HALF_HOURS
+		times, tariffs = [], []
+		for entry in entries:
+			hours, minutes, tariff = int(entry[:2]), int(entry[2:4]), int(entry[4:])
+			if hours > 23 or minutes > 59:
+				raise WrongSchedule('Wrong day schedule entry: '+entry)
+			if not (0 < tariff <= TARIFFS):
+				raise WrongSchedule('Tariff index out of range (1..4): '+entry)
+			times.append(hours*60+minutes)
+			tariffs.append(tariff)
+		return array.array('b', [tariffs[bisect.bisect_right(times, 30*half_hour+29)-1] for half_hour in xrange(HALF_HOURS)])
+
+	@staticmethod
+	def get_day_of_year(day):
+		"""Возвращает номер суток в году 0..365, одинаковый для високосного и обычного года"""
+		return DAYS_BEFORE_MONTH[day.month-1]+day.day-1
+
+	def get_day_tariff(self, day):
+		"""Возвращает тариф всех получасов особых суток day (date) или None - обычные сутки"""
+		return self.year_table[self.get_day_of_year(day)] or None
+
+	def get_tariff_indexes(self, days, use_numpy=True):
+		"""Возвращает номера тарифов получасов суток days (date); см. make_tariff_indexes"""
+		return make_tariff_indexes(self.day_indexes, [self.get_day_tariff(day) for day in days], use_numpy=use_numpy)
+
+
+DAYS_BEFORE_MONTH = [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335] # високосный год
+
+
+class TariffScheduleCache:
+	"""Кэш тарифных расписаний счётчиков в файле cache_file (JSON): {счётчик: {time, hash, year, day}}.
+	Расписание считывается со счётчика не чаще max_age, с. hash - хэш значений записи: запись,
+	значения которой не соответствуют хэшу (файл изменён или повреждён), не используется;
+	по хэшу находится уже скомпилированное расписание, changed - расписание счётчика изменилось
+	при последнем get. Одинаковые расписания разных счётчиков компилируются один раз.
+
+	Example:
+	schedules = Tariffs.TariffScheduleCache('schedules.json')
+	schedule = schedules.get(protocol, company+device)
+	"""
+
+	MAX_AGE = 24*3600 # с
+
+	def __init__(self, cache_file=None, max_age=MAX_AGE):
+		self.cache_file = cache_file
+		self.max_age = max_age
+		self.cache = {}
+		if cache_file is not None and os.path.exists(cache_file):
+			with open(cache_file) as f:
+				self.cache = json.load(f)
+		self.schedules = {} # hash -> TariffSchedule
+		self.changed = False
+
+	def save(self):
+		if self.cache_file is None:
+			return
+		with open(self.cache_file+'.tmp', 'w') as f:
+			json.dump(self.cache, f, indent=1, sort_keys=True)
+		os.rename(self.cache_file+'.tmp', self.cache_file)
+
+	def compile(self, year_buff, day_buff, key=None):
+		"""Возвращает TariffSchedule значений расписания, скомпилированный один раз для одинаковых значений;
+		key - хэш значений, если уже известен"""
+		if key is None:
+			key = TariffSchedule.get_hash(year_buff, day_buff)
+		schedule = self.schedules.get(key)
+		if schedule is None:
+			schedule = self.schedules[key] = TariffSchedule(year_buff, day_buff)
+		return schedule
+
+	def get(self, protocol, device, now=None):
+		"""Возвращает TariffSchedule счётчика device: из кэша или считанный через protocol.read_many"""
+		if now is None:
+			now = time.time()
+		entry = self.cache.get(device)
+		if entry is not None and entry.get('hash') != TariffSchedule.get_hash(entry['year'], entry['day']):
+			entry = None
+		self.changed = False
+		if entry is not None and 0 <= now-entry['time'] < self.max_age:
+			return self.compile(entry['year'], entry['day'], entry['hash'])
+		year_buff, day_buff = protocol.read_many(TariffSchedule.OBIS_LIST)
+		schedule = self.compile(year_buff, day_buff)
+		self.changed = entry is not None and entry['hash'] != schedule.hash
+		self.cache[device] = {'time': now, 'hash': schedule.hash, 'year': year_buff, 'day': day_buff}
+		self.save()
+		return schedule
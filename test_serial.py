@@ -1,48 +1,56 @@
 #!/usr/bin/env python2
 # -*- coding: UTF-8 -*-
 
-import sys, traceback
+import sys, os, traceback, json
 from datetime import datetime, timedelta
 import serial
-import time
 import argparse
-from protocol import NevaMt3xx
+from protocol import Mek61107, NevaMt3xx, Capture, Metrics, ProfileCache, Tariffs, MeterClock, Export, Snapshot, Archive, Obis
 
 
 VERBOSE_LEVEL = 0
+DIAGNOSTICS = sys.stdout # вывод диагностики; stderr, если в stdout идёт выгрузка --format
 
 def dump(message, level=0, datetime_stamp=False, ignore_verbose_level=False):
 	if VERBOSE_LEVEL <= level and not ignore_verbose_level:
 		return
 	if datetime_stamp:
-		print datetime.now().isoformat()+' '+'\t'*level+message
+		print >>DIAGNOSTICS, datetime.now().isoformat()+' '+'\t'*level+message
 	else:
-		print datetime.now().strftime('%H:%M:%S.%f ')+'\t'*level+message
+		print >>DIAGNOSTICS, datetime.now().strftime('%H:%M:%S.%f ')+'\t'*level+message
 
 def dump_rcv(buff, message='', level=0):
 	if VERBOSE_LEVEL <= level:
 		return
 	if len(message) > 0:
-		print datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' >> '+message+': '+buff.decode('latin').encode('unicode_escape')
+		print >>DIAGNOSTICS, datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' >> '+message+': '+buff.decode('latin').encode('unicode_escape')
 	else:
-		print datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' >> '+buff.decode('latin').encode('unicode_escape')
+		print >>DIAGNOSTICS, datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' >> '+buff.decode('latin').encode('unicode_escape')
 
 def dump_snd(buff, message='', level=0):
 	if VERBOSE_LEVEL <= level:
 		return
 	if len(message) > 0:
-		print datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' << '+message+': '+buff.decode('latin').encode('unicode_escape')
+		print >>DIAGNOSTICS, datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' << '+message+': '+buff.decode('latin').encode('unicode_escape')
 	else:
-		print datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' << '+buff.decode('latin').encode('unicode_escape')
+		print >>DIAGNOSTICS, datetime.now().strftime('%H:%M:%S.%f')+'\t'*level+' << '+buff.decode('latin').encode('unicode_escape')
 
-class log:
+class log(NevaMt3xx.LogBase):
 	def log_rcv(self, data):
 		dump_rcv(data)
 	def log_snd(self, data):
 		dump_snd(data)
+	def log_rcv_frame(self, cmd):
+		if VERBOSE_LEVEL > 0:
+			dump_rcv(str(cmd))
+	def log_snd_frame(self, cmd):
+		if VERBOSE_LEVEL > 0:
+			dump_snd(str(cmd))
 
 DEFAULT_COM_PORT = 'COM1' if sys.platform.startswith('win') else 'ttyUSB0'
 DEFAULT_PASSWORD = '00000000'
+DEFAULT_TIMEOUT = 2
+EXPORT_DAYS = 8 # days read and exported in one batch
 
 def set_defaultencoding_globally(encoding='utf-8'):
 	assert sys.getdefaultencoding() in ('ascii', 'mbcs', encoding)
@@ -58,15 +66,55 @@ def pase_args():
 		help=u'com порт для работы со счётчиком; по умолчанию: '+str(DEFAULT_COM_PORT))
 	parser.add_argument('--password',metavar='PASSWORD',default=DEFAULT_PASSWORD,
 		help=u'пароль для работы со счётчиком; по умолчанию: "'+str(DEFAULT_PASSWORD)+'"')
+	parser.add_argument('--address',metavar='ADDRESS',default='',
+		help=u'адрес счётчика на линии RS-485; по умолчанию: без адреса')
 	parser.add_argument('--obis',metavar='OBIS',nargs='*',
 		help=u'OBIS код для передачи счётчику; например, дата: ГГММДД: "00.09.02*FF"')
+	parser.add_argument('--snapshot',metavar='SPEC',nargs='*',
+		help=u'считать за один проход OBIS коды и диапазоны архивов, вывести JSON; например:\n'
+			u'"60.01.00*FF" "0F.08.80*[00..0C]" "0F.80.80*[00..7F]"; @FILE - файл со списком, по коду на строку')
+	parser.add_argument('--window',metavar='COUNT',type=int,default=1,
+		help=u'число запросов OBIS, посылаемых счётчику без ожидания ответа; по умолчанию: 1 -\n'
+			u'каждый запрос после ответа на предыдущий: линия полудуплексная, запрос во время ответа может\n'
+			u'потеряться; больше 1 - только для счётчиков и модемов, принимающих запросы во время ответа')
+	parser.add_argument('--timeout',metavar='SECONDS',type=float,default=DEFAULT_TIMEOUT,
+		help=u'таймаут ответа счётчика, с; с --retries - наибольший; по умолчанию: '+str(DEFAULT_TIMEOUT))
+	parser.add_argument('--retries',metavar='COUNT',type=int,
+		help=u'повторов запроса OBIS при ошибке BCC, NAK или отсутствии ответа;\n'
+			u'таймаут ответа при этом подбирается по измеренному времени ответа счётчика; по умолчанию: без повторов')
+	parser.add_argument('--inter-byte-timeout',metavar='SECONDS',type=float,
+		help=u'межсимвольный таймаут приёма, с; например: 0.02; по умолчанию: не задан - читаются накопленные портом данные')
+	parser.add_argument('--max-baudrate',metavar='BAUDRATE',type=int,
+		help=u'наибольшая скорость обмена, поддерживаемая адаптером; по умолчанию: скорость, сообщённая счётчиком')
+	parser.add_argument('--baudrate-cache',metavar='FILE',
+		help=u'файл подобранных скоростей обмена счётчиков (JSON)')
 	parser.add_argument('-i','--id',action='store_true',help=u'показать идентификатор счётчика')
 	parser.add_argument('--half-hours',metavar='DAYS_AGO',type=int,
 		help=u'считать получасовой профайл глубиной дней: 0..127')
+	parser.add_argument('--monts',metavar='MONTS_AGO',type=int,
+		help=u'считать энергию по тарифам на начало месяцев глубиной месяцев: 0..12')
 	parser.add_argument('--calc-half-hours',metavar='DAYS_AGO',type=int,
 		help=u'считать получасовой профайл и рассчитать по тарифам глубиной дней: 0..127')
+	parser.add_argument('--format',choices=('table',)+Export.FORMATS,default='table',
+		help=u'формат вывода --half-hours и --calc-half-hours: table - таблица; csv, jsonl, columnar (двоичный) -\n'
+			u'выгрузка строк по мере считывания суток; по умолчанию: table')
+	parser.add_argument('--output',metavar='FILE',
+		help=u'файл выгрузки --format; по умолчанию: stdout, диагностика -v - в stderr; columnar - только в файл')
+	parser.add_argument('--archive',metavar='DIR',
+		help=u'каталог архива: завершённые сутки --half-hours и --calc-half-hours\n'
+			u'дописываются в сжатый архив с индексом по датам, сутки без изменений - не дописываются')
+	parser.add_argument('--cache',metavar='DIR',
+		help=u'каталог кэша суточных профилей: прошедшие сутки считываются со счётчика один раз')
+	parser.add_argument('--capture',metavar='FILE',
+		help=u'записать обмен со счётчиком в двоичный файл')
+	parser.add_argument('--replay',metavar='FILE',
+		help=u'воспроизвести обмен, записанный --capture, вместо работы со счётчиком')
+	parser.add_argument('--metrics',metavar='SECONDS',type=float,nargs='?',const=0,
+		help=u'вывести метрики обмена в stderr по завершении, а с SECONDS - и с этим периодом')
 	parser.add_argument('-v',action='count',default=0,help='verbose level: -v, -vv or -vvv (bytes); по умолчанию: -v')
 	args = parser.parse_args()
+	if args.format == 'columnar' and args.output is None:
+		parser.error(u'--format columnar: двоичная выгрузка только в файл --output')
 	if VERBOSE_LEVEL > 0:
 		dump('arguments:')
 	for attribute, value in sorted(args.__dict__.items()):
@@ -82,7 +130,7 @@ def connect(protocol):
 	global VERBOSE_LEVEL
 	dump('Connect')
 	VERBOSE_LEVEL += 1
-	company, device = protocol.connect()
+	company, device = protocol.connect(device_number=args.address)
 	VERBOSE_LEVEL -= 1
 	if args.id:
 		print '{}\n{}'.format(company, device)
@@ -93,68 +141,60 @@ def login(protocol, password):
 	global VERBOSE_LEVEL
 	dump('Login')
 	VERBOSE_LEVEL += 1
-	cmd = protocol.receive()
-	if not cmd.is_command or cmd.command != 'P0':
-		raise Exception('Command "P0" expected')
-	protocol.send(NevaMt3xx.NevaMt3xx.Command('P1', '('+password+')'))
-	cmd = protocol.receive()
+	is_ack = protocol.login(password)
 	VERBOSE_LEVEL -= 1
-	dump('done' if cmd.is_ack else 'FAIL')
-	return cmd.is_ack
+	dump('done' if is_ack else 'FAIL')
+	return is_ack
 
 def logout(protocol):
 	dump('Logout')
 	global VERBOSE_LEVEL
 	VERBOSE_LEVEL += 1
-	protocol.send(NevaMt3xx.NevaMt3xx.Command('B0', ''))
-	time.sleep(.5)
-	protocol.send(NevaMt3xx.NevaMt3xx.Command('B0', ''))
+	protocol.logout()
 	VERBOSE_LEVEL -= 1
 	dump('done')
 
 def read_obis(protocol, obis):
 	dump('OBIS '+obis)
-	obis = obis.replace('.', '').replace('*', '')
 	global VERBOSE_LEVEL
 	VERBOSE_LEVEL += 1
-	protocol.send(NevaMt3xx.NevaMt3xx.Command('R1', obis+'()'))
-	cmd = protocol.receive()
-	if not cmd.is_message:
-		raise Exception('OBIS {} expected'.format(obis))
-	if not cmd.data.startswith(obis+'('):
-		raise Exception('Wrong OBIS, expected {}: {}'.format(obis, cmd.data))
+	value = protocol.read_obis(obis)
 	VERBOSE_LEVEL -= 1
-	dump(cmd.data[len(obis):].strip('()'))
-	return cmd.data[len(obis):].strip('()')
+	dump(value)
+	return value
+
+def read_many(protocol, obis_list):
+	dump('OBIS '+', '.join(obis_list))
+	global VERBOSE_LEVEL
+	VERBOSE_LEVEL += 1
+	values = protocol.read_many(obis_list)
+	VERBOSE_LEVEL -= 1
+	for value in values:
+		dump(value)
+	return values
 
 def write_obis(protocol, obis, data):
 	dump('OBIS '+obis+': '+data)
-	obis = obis.replace('.', '').replace('*', '')
 	global VERBOSE_LEVEL
 	VERBOSE_LEVEL += 1
-	protocol.send(NevaMt3xx.NevaMt3xx.Command('W1', obis+'('+data+')'))
-	cmd = protocol.receive()
-	if cmd.is_message:
-		raise Exception('Write OBIS {} error: {}'.format(obis, cmd.data))
-	if cmd.is_nak or cmd.is_command:
-		raise Exception('Write OBIS {} error'.format(obis))
+	cmd = protocol.write_obis(obis, data)
 	VERBOSE_LEVEL -= 1
 	dump(str(cmd))
 
-def read_half_hours(days_ago=0):
-	'''
-	days_ago -- 0..127
-	returns list of day 48 half hour energies, W
-	'''
+def get_half_hours_obis(days_ago=0):
+	'''days_ago -- 0..127'''
 	if 0 <= days_ago <= 127:
-		buff = read_obis(protocol, '63.01.00*'+'{:02X}'.format(days_ago)) # Профиль нагрузки активной энергии получасовой: Х.Х.ХХ,...,Х.Х.ХХ (кВт, по 48 параметров: первые..последние 30 минут)
-		half_hour_energies = buff.split(',')
-		if len(half_hour_energies) != 48:
-			raise Exception('Wrong 63.01.00 answer: '+str(buff))
-		return half_hour_energies
+		return '63.01.00*'+'{:02X}'.format(days_ago) # Профиль нагрузки активной энергии получасовой: Х.Х.ХХ,...,Х.Х.ХХ (кВт, по 48 параметров: первые..последние 30 минут)
 	else:
 		raise Exception('days_ago exceeded: '+str(days_ago))
 
+def get_half_hours(buff):
+	'''returns list of day 48 half hour energies, W'''
+	half_hour_energies = buff.split(',')
+	if len(half_hour_energies) != 48:
+		raise Exception('Wrong 63.01.00 answer: '+str(buff))
+	return half_hour_energies
+
 def print_half_hours(half_hour_energies, date_stamp=datetime.now(), rows_delimiter='   '):
 
 	def get_day_print(half_hour_energies, date_stamp):
@@ -192,121 +232,90 @@ def print_half_hours(half_hour_energies, date_stamp=datetime.now(), rows_delimit
 		for line in get_day_print(half_hour_energies, date_stamp):
 			print line
 
-def read_day_tariffs_energies(days_ago=0):
+def get_monts_energies(buff):
+	'''returns list of month tariffs enirgies, Wh: [sum, T1, T2, T3, T4]'''
+	return Obis.MONTH_ENERGIES.decode(buff)
+
+def format_energies(energies):
+	'''[sum, T1, T2, T3, T4], Wh -> kWh string'''
+	return ', '.join(['{}.{:03}'.format(energy//1000, energy%1000) for energy in energies])
+
+def read_snapshot(specs, clock=None):
 	'''
-	days_ago -- 0..127
-	returns list of day tariffs enirgies, kWh: [sum, T1, T2, T3, T4]
+	specs -- OBIS codes & archive ranges, e.g. ['60.01.00*FF', '0F.08.80*[00..0C]'], or '@FILE' with them
+	returns Snapshot.read result: {'date': meter date, 'values': {spec: value or list of values}}
 	'''
-	if 0 <= days_ago <= 127:
-		buff = read_obis(protocol, '0F.80.80*'+'{:02X}'.format(days_ago))
-		day_energies = buff.split(',')
-		if len(day_energies) != 5:
-			raise Exception('Wrong 0F.80.80 answer: '+str(buff))
-		return day_energies
-	else:
-		raise Exception('days_ago exceeded: '+str(days_ago))
+	snapshot = Snapshot.Snapshot([])
+	for spec in specs:
+		snapshot.specs += (Snapshot.Snapshot.load(spec[1:]) if spec.startswith('@') else Snapshot.Snapshot([spec])).specs
+	dump('Snapshot '+', '.join([spec[0] for spec in snapshot.specs]))
+	global VERBOSE_LEVEL
+	VERBOSE_LEVEL += 1
+	result = snapshot.read(protocol, clock)
+	VERBOSE_LEVEL -= 1
+	return result
 
-def read_monts(monts_ago=0):
-	'''monts_ago -- 0..12'''
-	if 0 <= monts_ago <= 12:
-		buff = read_obis(protocol, '0F.08.80*'+'{:02X}'.format(monts_ago)) # Активная энергия нарастающим итогом: XXXXX.X.XX,...,ХХХХХ.Х.ХХ (кВт/ч, по 5 параметров: параметров энергия Т0-суммарный тариф,Т1,Т2,Т3,Т4)
-		mounts_energies = buff.split(',')
-		if len(mounts_energies) != 5:
-			raise Exception('Wrong 0F.08.80 answer: '+str(buff))
-		return mounts_energies
-	else:
-		raise Exception('monts_ago exceeded: '+str(days_ago))
-
-def calculate_half_hours(start=datetime.now(), stop=None, days_ago=0):
-	'''returns list of list of 48 day's energies: [ [[sum, T1, T2, T3, T4]*48]*days ]'''
-	def get_shedule_tariffs(obis, table_count):
-		'''returns list of date sorted year tariff shedule: ['MMDDTT' (TT - tariff number 1..; 7F - ordinary day)]'''
-		buff = read_obis(protocol, obis)
-		ret = buff.split(',')
-		if len(ret) != table_count:
-			Exception('Incorrect OBIS {}: {}'.format(obis, buff))
-		ret = [tariff for tariff in ret if int(tariff) != 0] # remove empty (not used)
-		ret = sorted(ret) # sort by date
-		return ret
-	def get_year_shedule_tariff(year_tariffs_shedule, day):
-		for year_day in year_tariffs_shedule:
-			if year_day.startswith(day):
-				return year_day[-2:] if int(year_day[-2:], 16) != 0x7F else None
-		return None
-	def get_day_shedule_tariffs(day_tariffs_shedule):
-		'''returns list of 48 (one per half hour) day tariff indexes'''
-		if len(day_tariffs_shedule) == 0:
-			return [1]*48
-		if len(day_tariffs_shedule) == 1:
-			return [int(day_tariffs_shedule[0][-2:])]*48
+def read_days(dates, obis_list, cache=None, clock=None):
+	'''
+	dates -- datetime.date of the days in the meter profile (0..127 days ago)
+	obis_list -- day OBIS codes without the days ago suffix, e.g. ['0F.80.80', '63.01.00']
+	cache -- ProfileCache: read the days not cached yet only
+	clock -- MeterClock of the session: all days are read in one batch within one meter day
+	returns list of the days values: [ [obis_list values]*days ]
+	'''
+	if cache is not None:
+		return [values for date, values in cache.read_days(protocol, protocol.device, dates=dates, obis_list=obis_list, clock=clock)]
+
+	def get_days_obis(meter_date):
 		ret = []
-		tariffs_index, next_tariff_index = len(day_tariffs_shedule)-1, 0
-		for half_hour_index in xrange(48):
-			half_hour = 30*half_hour_index # day minutes: 0..1410 = 00:00..23:30
-			half_hour = '{:02}{:02}'.format(half_hour/60, half_hour%60)
-			if next_tariff_index < len(day_tariffs_shedule) and day_tariffs_shedule[next_tariff_index].startswith(half_hour):
-				tariffs_index = next_tariff_index
-				next_tariff_index += 1
-			ret.append(int(day_tariffs_shedule[tariffs_index][-2:]))
-		return ret
-	def get_tariffs_half_hours(request_date):
-		'''returns list of day 48 half hours of list datetime & energies: [ [sum, T1, T2, T3, T4]*48 ]'''
-		half_hours = []
-		meter_date = datetime.date(datetime.strptime(read_obis(protocol, '00.09.02*FF'), '%y%m%d')) # ГГММДД
-		# print 'request_date: ', request_date, '; meter_date: ', meter_date
-		for date_changed_tries_counter in xrange(3):
+		for request_date in dates:
 			i = (meter_date-request_date).days
-			if i < 0:
-				Exception('Can\'t work at future: request date {}; meter date {}'.format(request_date, meter_date))
-			# print 'days_ago: '+str(i)
-			# get list of day tariffs enirgies, kWh: [sum, T1, T2, T3, T4]
-			day_tariffs_energies = read_day_tariffs_energies(i)
-			day_tariffs_energies = [long(float(e)*1000) for e in day_tariffs_energies] # kWh -> Wh
-			# print 'day_tariffs_energies = ', day_tariffs_energies
-			# get list of day 48 half hour energies, W
-			day_half_hours = read_half_hours(i)
-			# print 'half_hours = ', day_half_hours
-			day = datetime.now().strftime('%m%d')
-			tariff_index = get_year_shedule_tariff(year_tariffs_shedule, day)
-			if tariff_index is not None:
-				# special day - tried all day half hours as one tariff
-				for half_hour in day_half_hours:
-					tariff_index = long(tariff_index)
-					if not (0 < tariff_index <= 4):
-						raise Exception('Tariff index out of range (1..4): '+str(tariff_index))
-					half_hour = long(half_hour)/2
-					day_tariffs_energies[0] += half_hour # sum
-					day_tariffs_energies[tariff_index] += half_hour # Tx
-					half_hours.append(day_tariffs_energies[:])
-			else:
-				if len(day_tariff_indexes) != len(day_half_hours):
-					raise Exception('Can\'t build day tariff table')
-				for tariff_index, half_hour in zip(day_tariff_indexes, day_half_hours):
-					if not (0 < tariff_index <= 4):
-						raise Exception('Tariff index out of range (1..4): '+str(tariff_index))
-					half_hour = long(half_hour)/2
-					day_tariffs_energies[0] += half_hour # sum
-					day_tariffs_energies[tariff_index] += half_hour # Tx
-					# print 'half_hour, tariff_index = ', half_hour, tariff_index
-					half_hours.append(day_tariffs_energies[:])
-			# Check whether the meter date changed
-			meter_date2 = datetime.date(datetime.strptime(read_obis(protocol, '00.09.02*FF'), '%y%m%d')) # ГГММДД
-			if meter_date == meter_date2:
-				break
-			half_hours = []
-			if date_changed_tries_counter > 1:
-				Exception('Can\'t read date')
-			meter_date = meter_date2
-		return half_hours
+			if not 0 <= i <= 127:
+				raise Exception('Date out of meter profile: request date {}; meter date {}'.format(request_date, meter_date))
+			ret += [obis+'*{:02X}'.format(i) for obis in obis_list]
+		return ret
 
+	buff = clock.read(get_days_obis)[1]
+	return [buff[i:i+len(obis_list)] for i in xrange(0, len(buff), len(obis_list))]
+
+def iter_half_hours(days_ago=0, cache=None, clock=None, days=EXPORT_DAYS, archive=None):
+	'''
+	days_ago -- 0..127
+	days -- days read in one batch
+	archive -- Archive.Archive: the completed days read (before the meter date) are appended to it
+	yields rows [datetime, half hour energy, W] from days_ago to today by batches of days
+	'''
+	if clock is None:
+		clock = MeterClock.MeterClock(protocol)
+	meter_date = clock.now().date()
+	dates = [meter_date-timedelta(days=i) for i in xrange(days_ago, -1, -1)]
+	for i in xrange(0, len(dates), days):
+		for date, values in zip(dates[i:i+days], read_days(dates[i:i+days], ['63.01.00'], cache, clock)):
+			half_hours = Obis.HALF_HOURS.decode(values[0])
+			if archive is not None and date < meter_date:
+				archive.put(protocol.device, date, half_hours)
+			for half_hour, energy in enumerate(half_hours):
+				yield [datetime(date.year, date.month, date.day)+timedelta(minutes=30*half_hour), energy]
+
+def iter_calculated_days(start=datetime.now(), stop=None, days_ago=0, cache=None, schedules=None, clock=None, days=EXPORT_DAYS,
+	archive=None):
+	'''
+	the same as calculate_half_hours, but reads the days by batches of days, from stop to start
+	archive -- Archive.Archive (48 rows of 5 columns): the completed days calculated (before the meter date) are appended to it
+	yields [date, [[datetime, sum, T1, T2, T3, T4]*48]] for each day
+	'''
+	if clock is None:
+		clock = MeterClock.MeterClock(protocol)
 	# get half hours & using it according to the tariff table
-	# get list of date sorted year tariff shedule: ['MMDDTT' (TT - tariff number 1..; 7F - ordinary day)]
-	year_tariffs_shedule = get_shedule_tariffs('0B.00.00*FF', 32)
-	# print 'year_tariffs_shedule = ', year_tariffs_shedule
-	# get list of 48 (one per half hour) day tariff indexes
-	day_tariff_indexes = get_day_shedule_tariffs(get_shedule_tariffs('0A.01.64*FF', 8))
-	# print 'day_tariff_indexes = ', day_tariff_indexes
-	half_hours = []
+	# year (special days) & day (48 half hours) tariff shedule
+	if schedules is not None:
+		dump('Tariff shedule')
+		shedule = schedules.get(protocol, protocol.device)
+		if schedules.changed:
+			dump('Tariff shedule changed: '+shedule.hash)
+	else:
+		shedule = Tariffs.TariffSchedule(*read_many(protocol, Tariffs.TariffSchedule.OBIS_LIST))
+	# print 'day_tariff_indexes = ', list(shedule.day_indexes)
 	if stop is None:
 		if days_ago == 0:
 			stop = datetime(start.year, start.month, start.day, 23, 59, 59)
@@ -315,103 +324,232 @@ def calculate_half_hours(start=datetime.now(), stop=None, days_ago=0):
 	# print 'start:', start, '; stop:', stop
 	start_date = datetime.date(start)
 	stop_date = datetime.date(stop)
-	date = start_date
-	while date >= stop_date:
-		# get list (48 half hour) of list (5: sum, T1, T2, T3, T4)
-		start_half_hour_index, stop_half_hour_index = 0, 47 # indexes, inclusive
-		half_hours2 = get_tariffs_half_hours(date) # [ [sum, T1, T2, T3, T4]*48 ]
-		# add datetime: [ [sum, T1, T2, T3, T4]*48 ] -> [ [datetime, sum, T1, T2, T3, T4]*48 ]
-		half_hours2 = [[datetime(date.year, date.month, date.day, hh_index/2, hh_index*30%60)]+hh for hh, hh_index in zip(half_hours2, xrange(len(half_hours2)))]
-		# print 'len(half_hours2): ', len(half_hours2), '; half_hours2: ', half_hours2
-		if date == start_date:
-			t = start-datetime(date.year, date.month, date.day)
-			start_half_hour_index = t.seconds/1800 + (1 if t.seconds%1800 > 0 else 0)
-			# print 'start_half_hour_index:', start_half_hour_index, '; t.seconds: ', t.seconds
-		if date == stop_date:
-			t = stop-datetime(date.year, date.month, date.day)
-			stop_half_hour_index = t.seconds/1800
-			# print 'stop_half_hour_index:', stop_half_hour_index, '; t.seconds: ', t.seconds
-		half_hours.append(half_hours2[start_half_hour_index:stop_half_hour_index+1])
-		# print 'half_hours2: ', half_hours2[start_half_hour_index:stop_half_hour_index+1]
-		date -= timedelta(days=1)
+	dates = [stop_date+timedelta(days=i) for i in xrange((start_date-stop_date).days+1)]
+	for batch_index in xrange(0, len(dates), days):
+		batch_dates = dates[batch_index:batch_index+days]
+		dump('Profile '+str(batch_dates[0])+'..'+str(batch_dates[-1]))
+		buffs = read_days(batch_dates, ['0F.80.80', '63.01.00'], cache, clock)
+		# all days [sum, T1, T2, T3, T4] at the end of each half hour, Wh, in one pass
+		# (special days of the year shedule - all day half hours as one tariff)
+		energies = Tariffs.accumulate(
+			Tariffs.make_energies([buff[0] for buff in buffs]),
+			Tariffs.make_profiles([buff[1] for buff in buffs]),
+			shedule.get_tariff_indexes(batch_dates))
+		meter_date = clock.now().date()
+		for date, day_index in zip(batch_dates, xrange(len(batch_dates))):
+			# get list (48 half hour) of list (5: sum, T1, T2, T3, T4)
+			start_half_hour_index, stop_half_hour_index = 0, 47 # indexes, inclusive
+			half_hours2 = Tariffs.to_lists(energies, day_index) # [ [sum, T1, T2, T3, T4]*48 ]
+			if archive is not None and date < meter_date:
+				archive.put(protocol.device, date, [e for hh in half_hours2 for e in hh])
+			# add datetime: [ [sum, T1, T2, T3, T4]*48 ] -> [ [datetime, sum, T1, T2, T3, T4]*48 ]
+			half_hours2 = [[datetime(date.year, date.month, date.day, hh_index/2, hh_index*30%60)]+hh for hh, hh_index in zip(half_hours2, xrange(len(half_hours2)))]
+			# print 'len(half_hours2): ', len(half_hours2), '; half_hours2: ', half_hours2
+			if date == start_date:
+				t = start-datetime(date.year, date.month, date.day)
+				start_half_hour_index = t.seconds/1800 + (1 if t.seconds%1800 > 0 else 0)
+				# print 'start_half_hour_index:', start_half_hour_index, '; t.seconds: ', t.seconds
+			if date == stop_date:
+				t = stop-datetime(date.year, date.month, date.day)
+				stop_half_hour_index = t.seconds/1800
+				# print 'stop_half_hour_index:', stop_half_hour_index, '; t.seconds: ', t.seconds
+			yield [date, half_hours2[start_half_hour_index:stop_half_hour_index+1]]
+
+def calculate_half_hours(start=datetime.now(), stop=None, days_ago=0, cache=None, schedules=None, clock=None, archive=None):
+	'''
+	cache -- ProfileCache: read the days not cached yet only
+	schedules -- Tariffs.TariffScheduleCache: read the tariff schedule when it's expired only
+	clock -- MeterClock of the session: the meter date is read once, not for every day
+	returns list of list of 48 day's energies: [ [[sum, T1, T2, T3, T4]*48]*days ]
+	'''
+	# all days in one batch
+	half_hours = [day_half_hours for date, day_half_hours in
+		iter_calculated_days(start, stop, days_ago, cache, schedules, clock, days=128, archive=archive)]
+	half_hours.reverse()
 	return half_hours
 
+def iter_calculated_half_hours(start=datetime.now(), stop=None, days_ago=0, cache=None, schedules=None, clock=None, days=EXPORT_DAYS,
+	archive=None):
+	'''yields rows [datetime, sum, T1, T2, T3, T4] (Wh) from stop to start by batches of days'''
+	for date, day_half_hours in iter_calculated_days(start, stop, days_ago, cache, schedules, clock, days, archive):
+		for row in day_half_hours:
+			yield row
+
+def export(rows, columns, format, file_name=None):
+	'''writes rows to file_name (stdout by default) as they are read'''
+	f = sys.stdout if file_name is None else open(file_name, 'wb')
+	try:
+		writer = Export.get_writer(format, f, columns)
+		writer.write_rows(rows)
+		writer.close()
+	finally:
+		if file_name is not None:
+			f.close()
+
+
+if __name__ == '__main__':
+	args = pase_args()
+	VERBOSE_LEVEL = args.v
+	if args.format != 'table' and args.output is None:
+		DIAGNOSTICS = sys.stderr
+
+	if not sys.platform.startswith('win') and args.port.find('/') < 0:
+		args.port = '/dev/'+args.port
+
+	dump('START', datetime_stamp=True)
+	dump('Open '+str(args.port if args.replay is None else args.replay))
+
+	if args.replay is not None:
+		# воспроизведение записанного обмена вместо счётчика
+		port = Capture.ReplayPort(args.replay)
+		now = datetime.fromtimestamp(port.start_time)
+	else:
+		port = serial.Serial(
+			port=args.port,
+			baudrate=9600,
+			timeout=args.timeout,
+			bytesize=serial.SEVENBITS,
+			parity=serial.PARITY_EVEN,
+			stopbits=serial.STOPBITS_ONE,
+			inter_byte_timeout=args.inter_byte_timeout)
+		now = datetime.now()
+
+	if not port.is_open:
+		port.open()
+
+	capture = None
+	metrics = None
+	profile_archive, calculated_archive = None, None
+	try:
+		l = log() if args.v > 1 else None
+		if args.capture is not None:
+			capture = l = Capture.CaptureLog(args.capture, log=l, log_bytes=args.v > 2)
+		baudrate_policy = None
+		if args.baudrate_cache is not None or args.max_baudrate is not None:
+			baudrates = [b for b in port.BAUDRATES if args.max_baudrate is None or b <= args.max_baudrate]
+			baudrate_policy = NevaMt3xx.BaudratePolicy(baudrates, args.baudrate_cache)
+		if args.metrics is not None:
+			metrics = Metrics.Metrics()
+			if args.metrics > 0:
+				metrics.start_dump(args.metrics, sys.stderr)
+		retry_policy = None
+		if args.retries is not None:
+			retry_policy = NevaMt3xx.RetryPolicy(max_timeout=args.timeout, retries=args.retries)
+		protocol = NevaMt3xx.NevaMt3xx_com(port, l, args.v > 2 or args.capture is not None,
+			baudrate_policy=baudrate_policy, metrics=metrics, retry_policy=retry_policy)
+		protocol.read_window = args.window
+		while True:
+			try:
+				connect(protocol)
+				if not login(protocol, args.password):
+					raise Exception('Access denied')
+				protocol.confirm_baudrate()
+				break
+			except (Mek61107.Mek61107.WrongBcc, Mek61107.Mek61107.SohOrStxExpected) as e:
+				# ошибка обмена на выбранной скорости - повтор на меньшей
+				if not protocol.fallback_baudrate():
+					raise
+				dump('Baudrate {} fail: {}'.format(port.baudrate, repr(e)))
+				logout(protocol)
+
+		if args.obis is not None:
+			for value in read_many(protocol, args.obis):
+				print value
+
+		# buff = read_obis(protocol, '00.09.02*FF') # Дата: ГГММДД
+		# buff = read_obis(protocol, '60.01.01*FF') # Адрес счетчика: XXXXXXXX
+		# buff = read_obis(protocol, '60.01.00*FF') # ID счетчика: XXXXXXXXXXXX
+		# buff = read_obis(protocol, '60.01.04*FF') # Модель счетчика: XXXXXXXX
+		# buff = read_obis(protocol, '60.01.0A*FF') # Место установки: XXXXXXXXXXXXXXXX
+		# buff = read_obis(protocol, '60.09.00*FF') # Температура (НЕВА МТ323, НЕВА MT314 XXSR): XXX
+
+		clock = MeterClock.MeterClock(protocol) # дата и время счётчика: считываются один раз за сеанс
+		if args.archive is not None:
+			profile_archive = Archive.Archive(args.archive, '63.01.00')
+			calculated_archive = Archive.Archive(args.archive, 'calculated', Tariffs.HALF_HOURS, Tariffs.ENERGIES)
+
+		cache, schedules = None, None
+		if args.cache is not None:
+			cache = ProfileCache.ProfileCache(args.cache)
+			schedules = Tariffs.TariffScheduleCache(os.path.join(args.cache, 'tariff_schedules.json'))
+
+		if args.snapshot is not None:
+			result = read_snapshot(args.snapshot, clock)
+			print json.dumps({'date': None if result['date'] is None else result['date'].isoformat(),
+				'values': result['values']}, indent=1, sort_keys=True)
+
+		if args.monts is not None:
+			if 0 <= args.monts <= 12:
+				result = read_snapshot(['0F.08.80*[00..{:02X}]'.format(args.monts)], clock)
+				for buff, monts_ago in zip(result['values'].values()[0], xrange(args.monts+1)):
+					month = result['date'].year*12+result['date'].month-1-monts_ago
+					print '{}.{:02} {}'.format(month/12, month%12+1, format_energies(get_monts_energies(buff)))
+			else:
+				raise Exception('monts not in range 0..12: '+str(args.monts))
 
-args = pase_args()
-VERBOSE_LEVEL = args.v
-
-if not sys.platform.startswith('win') and args.port.find('/') < 0:
-	args.port = '/dev/'+args.port
-
-dump('START', datetime_stamp=True)
-dump('Open '+str(args.port))
-
-port = serial.Serial(
-	port=args.port,
-	baudrate=9600,
-	timeout=2,
-	bytesize=serial.SEVENBITS,
-	parity=serial.PARITY_EVEN,
-	stopbits=serial.STOPBITS_ONE)
-
-if not port.is_open:
-	port.open()
-
-try:
-	l = log() if args.v > 1 else None
-	protocol = NevaMt3xx.NevaMt3xx_com(port, l, args.v > 2)
-	connect(protocol)
-	if not login(protocol, args.password):
-		raise Exception('Access denied')
-
-	if args.obis is not None:
-		for obis in args.obis:
-			print read_obis(protocol, obis)
-
-	# buff = read_obis(protocol, '00.09.02*FF') # Дата: ГГММДД
-	# buff = read_obis(protocol, '60.01.01*FF') # Адрес счетчика: XXXXXXXX
-	# buff = read_obis(protocol, '60.01.00*FF') # ID счетчика: XXXXXXXXXXXX
-	# buff = read_obis(protocol, '60.01.04*FF') # Модель счетчика: XXXXXXXX
-	# buff = read_obis(protocol, '60.01.0A*FF') # Место установки: XXXXXXXXXXXXXXXX
-	# buff = read_obis(protocol, '60.09.00*FF') # Температура (НЕВА МТ323, НЕВА MT314 XXSR): XXX
-
-	if args.half_hours is not None:
-		if 0 <= args.half_hours <= 127:
-			half_hours = []
-			for i in xrange(0, args.half_hours+1):
-				half_hours.append(read_half_hours(i))
-			print_half_hours(half_hours, datetime.now())
-		else:
-			raise Exception('half-hours not in range 0..127: '+str(args.half_hours))
-
-	elif args.calc_half_hours is not None:
-		if 0 <= args.calc_half_hours <= 127:
-			start = datetime.now()
-			start = datetime(start.year, start.month, start.day)
-			if args.calc_half_hours == 0:
-				stop = start
+		if args.half_hours is not None:
+			if 0 <= args.half_hours <= 127:
+				if args.format != 'table':
+					export(iter_half_hours(args.half_hours, cache, clock, archive=profile_archive), ['time', 'energy'],
+						args.format, args.output)
+				else:
+					if cache is not None:
+						days = cache.read_days(protocol, protocol.device, days_ago=range(args.half_hours+1), obis_list=['63.01.00'],
+							clock=clock)
+						meter_date = days[0][0]
+						half_hours = [get_half_hours(values[0]) for date, values in days]
+					else:
+						dump('OBIS 63.01.00*00..{:02X}'.format(args.half_hours))
+						meter_date, half_hours = clock.read(lambda date: [get_half_hours_obis(i) for i in xrange(0, args.half_hours+1)])
+						half_hours = [get_half_hours(buff) for buff in half_hours]
+					if profile_archive is not None:
+						for day_half_hours, days_ago in zip(half_hours[1:], xrange(1, len(half_hours))):
+							profile_archive.put(protocol.device, meter_date-timedelta(days=days_ago), [int(e) for e in day_half_hours])
+					print_half_hours(half_hours, datetime.combine(meter_date, datetime.min.time()))
 			else:
-				stop = start-timedelta(days=args.calc_half_hours)
-			stop = datetime(stop.year, stop.month, stop.day, 23, 59, 59)
-			# print 'start: ', start, 'stop: ', stop
-			half_hours = calculate_half_hours(start=start, stop=stop)
-			# print 'half_hours: ', half_hours
-			for half_hour, half_hour_index in zip(half_hours, xrange(len(half_hours))):
-				hh = 30*(half_hour_index%48) # day minutes: 0..1410 = 00:00..23:30
-				hh = '{:02}:{:02}'.format(hh/60, hh%60)
-			# add missing half hours into the list for correct print
-			half_hours[0] = ['']*(48-len(half_hours[0]))+half_hours[0]
-			# print half_hours[0]
-			print_half_hours(half_hours, rows_delimiter=' | ')
-		else:
-			raise Exception('calc-half-hours not in range 0..127: '+str(args.calc_half_hours))
-
-	# write_obis(protocol, '60.01.01*FF', '00009144') # Адрес счетчика: XXXXXXXX
-	logout(protocol)
-except Exception as e:
-	print u'ERROR: '+str(e)
-	exc_type, exc_value, exc_traceback = sys.exc_info()
-	traceback.print_tb(exc_traceback, file=sys.stderr)
-	sys.exit(-1)
-if port.isOpen():
-	port .close()
+				raise Exception('half-hours not in range 0..127: '+str(args.half_hours))
+
+		elif args.calc_half_hours is not None:
+			if 0 <= args.calc_half_hours <= 127:
+				start = datetime(now.year, now.month, now.day)
+				if args.calc_half_hours == 0:
+					stop = start
+				else:
+					stop = start-timedelta(days=args.calc_half_hours)
+				stop = datetime(stop.year, stop.month, stop.day, 23, 59, 59)
+				# print 'start: ', start, 'stop: ', stop
+				if args.format != 'table':
+					export(iter_calculated_half_hours(start=start, stop=stop, cache=cache, schedules=schedules, clock=clock,
+						archive=calculated_archive),
+						['time', 'sum', 'T1', 'T2', 'T3', 'T4'], args.format, args.output)
+				else:
+					half_hours = calculate_half_hours(start=start, stop=stop, cache=cache, schedules=schedules, clock=clock,
+						archive=calculated_archive)
+					# print 'half_hours: ', half_hours
+					for half_hour, half_hour_index in zip(half_hours, xrange(len(half_hours))):
+						hh = 30*(half_hour_index%48) # day minutes: 0..1410 = 00:00..23:30
+						hh = '{:02}:{:02}'.format(hh/60, hh%60)
+					# add missing half hours into the list for correct print
+					half_hours[0] = ['']*(48-len(half_hours[0]))+half_hours[0]
+					# print half_hours[0]
+					print_half_hours(half_hours, rows_delimiter=' | ')
+			else:
+				raise Exception('calc-half-hours not in range 0..127: '+str(args.calc_half_hours))
+
+		# write_obis(protocol, '60.01.01*FF', '00009144') # Адрес счетчика: XXXXXXXX
+		logout(protocol)
+	except Exception as e:
+		print >>DIAGNOSTICS, u'ERROR: '+str(e)
+		exc_type, exc_value, exc_traceback = sys.exc_info()
+		traceback.print_tb(exc_traceback, file=sys.stderr)
+		sys.exit(-1)
+	finally:
+		if capture is not None:
+			capture.close()
+		for archive in (profile_archive, calculated_archive):
+			if archive is not None:
+				archive.close()
+		if metrics is not None:
+			sys.stderr.write(metrics.dump())
+	if port.isOpen():
+		port .close()